@@ -4,17 +4,34 @@ Set up the environment as described in the README.md file, then run this app wit
 
     streamlit run app.py
 """
-import configparser
+import dataclasses
+import os
 import re
+import threading
+import time
 import streamlit as st
+import compaction
 import github as gh
+import history
 import llm
+import service
+import settings
+import summarize
+import tracing
+from cache import MemoryCache
+
+_EXAMPLE_URLS = [
+    "https://github.com/openai/openai-python/issues/488 (simple example)",
+    "https://github.com/openai/openai-python/issues/650 (also simple, but more code blocks)",
+    "https://github.com/scikit-learn/scikit-learn/issues/9354 (large issue, smaller models summarize it in chunks)",
+    "https://github.com/microsoft/semantic-kernel/issues/2039 (large comments, GPT-4 summarizes it better)",
+    "https://github.com/qjebbs/vscode-plantuml/issues/255 (large number of comments)",
+]
 
 
 def get_default_settings():
     """Reads settings from the .ini file."""
-    config = configparser.ConfigParser()
-    config.read("llm.ini")
+    config = settings.read_config()
     model = config["LLM"]["model"]
     prompt = config["LLM"]["prompt"]
     return prompt, model
@@ -27,8 +44,22 @@ def display_settings_section():
             st.session_state.prompt, st.session_state.model = get_default_settings()
 
         st.session_state.prompt = st.text_area("Prompt", st.session_state.prompt, height=300)
-        models = llm.models()
+        # The "auto" model chooses the cheapest model that fits the issue and responds in time
+        models = [llm.AUTO_MODEL] + llm.models()
         st.session_state.model = st.selectbox("Select model", models, index=models.index(st.session_state.model))
+        st.session_state.use_cache = st.checkbox(
+            "Reuse the previous summary if the issue, prompt, and model didn't change", value=True
+        )
+
+        if "compaction" not in st.session_state:
+            st.session_state.compaction = compaction.load_config()
+        c = st.session_state.compaction  # Shorter name to make the code easier to read
+        st.write("Remove text that costs tokens without helping the LLM summarize the issue:")
+        c.strip_quoted_replies = st.checkbox("Quoted replies", value=c.strip_quoted_replies)
+        c.remove_template_boilerplate = st.checkbox("Issue template instructions", value=c.remove_template_boilerplate)
+        c.collapse_long_blocks = st.checkbox("Long code blocks and tracebacks", value=c.collapse_long_blocks)
+        c.fold_bot_and_plus_one_comments = st.checkbox("Bot and +1 comments", value=c.fold_bot_and_plus_one_comments)
+        c.deduplicate = st.checkbox("Repeated comments and lines", value=c.deduplicate)
 
 
 def get_issue_to_show():
@@ -36,22 +67,15 @@ def get_issue_to_show():
     if "issue_url" not in st.session_state:
         st.session_state.issue_url = ""
 
-    example_urls = [
-        "https://github.com/openai/openai-python/issues/488 (simple example)",
-        "https://github.com/openai/openai-python/issues/650 (also simple, but more code blocks)",
-        "https://github.com/scikit-learn/scikit-learn/issues/9354 (large issue, requires GPT-4's large context window)",
-        "https://github.com/microsoft/semantic-kernel/issues/2039 (large comments, GPT-4 summarizes it better)",
-        "https://github.com/qjebbs/vscode-plantuml/issues/255 (large number of comments)",
-    ]
     selected_url = st.selectbox(
         "Choose an example URL from this list or type your own below",
-        example_urls,
+        _EXAMPLE_URLS,
         placeholder="Pick from this list or enter an URL below",
         index=None,
     )
     if selected_url:
         # Discard the comment text after the URL to make it valid
-        st.session_state.issue_url = selected_url.split(" (")[0]
+        st.session_state.issue_url = _example_url(selected_url)
 
     st.session_state.issue_url = st.text_input(
         "Enter GitHub issue URL",
@@ -61,7 +85,69 @@ def get_issue_to_show():
     )
 
 
-def get_github_data(issue_url: str) -> tuple[dict, dict]:
+def _example_url(example: str) -> str:
+    """Get the URL of an example issue, without the description after it."""
+    return example.split(" (")[0]
+
+
+@st.cache_resource
+def _summary_cache() -> MemoryCache:
+    """Get the summaries shared by all sessions of the app.
+
+    Streamlit runs this file again for every interaction, creating new module variables each time - st.cache_resource
+    creates the cache once per process instead.
+    """
+    config = settings.read_config()
+    max_entries = config.getint("App", "summary_cache_entries", fallback=100)
+    ttl = config.getfloat("App", "summary_cache_minutes", fallback=24 * 60) * 60
+    return MemoryCache(max_entries, ttl)
+
+
+@st.cache_resource
+def _start_prewarm() -> threading.Thread:
+    """Summarize the example issues in a background thread, once per process (see _prewarm())."""
+    thread = threading.Thread(target=_prewarm, args=(_summary_cache(),), name="prewarm", daemon=True)
+    thread.start()
+    return thread
+
+
+def _prewarm(cache: MemoryCache):
+    """Summarize the example issues with the default settings, so they're in the cache when someone picks one."""
+    prompt, model = get_default_settings()
+    config = compaction.load_config()
+    for example in _EXAMPLE_URLS:
+        issue_url = _example_url(example)
+        key = service.request_key(issue_url, model, prompt, config, True)
+        if cache.get(key) is not None:
+            continue
+        try:
+            with history.issue_context(issue_url):
+                settings.load_env()
+                service_url = os.getenv("SUMMARY_SERVICE_URL")
+                if service_url:
+                    result = service.summarize_remote(service_url, issue_url, model, prompt, config)
+                else:
+                    result = service.summarize_issue(issue_url, model, prompt, config)
+        except Exception as err:  # Not fatal - the issue is summarized when someone asks for it
+            print(f"Could not summarize {issue_url} in advance: {err}")
+            continue
+        cache.put(key, {**result, "generated_at": time.time()})
+
+
+def _request_refresh():
+    """Ask for a new summary instead of the one in the cache, in the next run of the app (see main())."""
+    st.session_state.refresh = True
+
+
+def show_cache_status(result: dict):
+    """Show that the summary came from the cache, and when it was generated."""
+    minutes = int((time.time() - result["generated_at"]) // 60)
+    age = "less than a minute" if minutes < 1 else f"{minutes} minute{'s' if minutes > 1 else ''}"
+    st.info(f"Served from cache, generated {age} ago.")
+    st.button("Refresh", on_click=_request_refresh, help="Get the issue from GitHub again and summarize it")
+
+
+def get_github_data(issue_url: str) -> tuple[dict, list]:
     """Get the issue and comments from GitHub."""
     with st.spinner("Waiting for GitHub response..."):
         issue = gh.get_issue(issue_url)
@@ -69,24 +155,82 @@ def get_github_data(issue_url: str) -> tuple[dict, dict]:
         return issue, comments
 
 
-def get_llm_response(model: str, prompt: str, issue: str, comments: str) -> llm.LLMResponse:
-    """Get the LLM response for the issue and comments."""
-    with st.spinner(f"Waiting for {model} response..."):
-        # Format the issue and comments into a text format to make it easier for the LLM to understand
-        # and to save tokens.
-        text_format = f"{issue}\n\n{comments}"
+def get_summary_from_service(service_url: str, use_cache: bool) -> dict:
+    """Get the summary from the summary service (see service.py) instead of running all steps in the app.
+
+    The service shares the work with other users who ask for the same summary at the same time.
+
+    Args:
+        service_url (str): URL of the summary service.
+        use_cache (bool): Let the service reuse cached responses - False to make a new summary.
 
-        response = llm.chat_completion(model, prompt, text_format)
-        return response
+    Returns:
+        dict: The summary, as returned by service.summarize_issue().
+    """
+    with st.spinner("Waiting for the summary service..."):
+        result = service.summarize_remote(
+            service_url,
+            st.session_state.issue_url,
+            st.session_state.model,
+            st.session_state.prompt,
+            st.session_state.compaction,
+            use_cache,
+        )
+    if result["coalesced"]:
+        st.info("Another user requested this summary at about the same time - showing the same summary.")
+    return result
+
+
+def _from_result(result: dict, trace: tracing.Trace) -> tuple:
+    """Get the data to show from a summary made by the service or stored in the cache.
+
+    Returns:
+        tuple: The same data the app gets when it runs the steps: the issue, comments, parsed issue, parsed comments,
+        compaction report, and the LLM response (complete, as a single token).
+    """
+    # Show the steps that made the summary with the steps the app runs
+    trace.spans.extend(tracing.Span(**span) for span in result["spans"])
+    response = llm.LLMResponse(**result["response"])
+    report = compaction.CompactionReport(**result["compaction"])
+    stream = llm.StreamedCompletion(response, iter([response.llm_response]))
+    return result["issue"], result["comments"], result["parsed_issue"], result["parsed_comments"], report, stream
+
+
+def get_llm_response(
+    model: str, prompt: str, issue: dict, comments: list, parsed_issue: str, parsed_comments: str, use_cache: bool
+) -> llm.StreamedCompletion:
+    """Get the LLM response for the issue and comments.
+
+    The response is streamed - it's requested when the caller starts reading the tokens.
+    """
+    # Format the issue and comments into a text format to make it easier for the LLM to understand
+    # and to save tokens.
+    text_format = f"{parsed_issue}\n\n{parsed_comments}"
+
+    response = summarize.summarize_issue_stream(model, prompt, issue, comments, text_format, use_cache)
+    model = response.response.model  # The model chosen for the issue, if it was chosen automatically
+    if response.response.routing_reason:
+        st.info(f"Using {model}: {response.response.routing_reason}.")
+    if not summarize.fits_context(model, prompt, text_format):
+        st.info(
+            f"The issue is too large for {model}'s context window. Summarizing it in chunks, then combining the"
+            " summaries (may take longer and lose some details)."
+        )
+    return response
 
 
-def show_github_raw_data(issue: dict, comments: dict):
+def show_github_raw_data(issue: dict, comments: list):
     """Show the GitHub issue and comments as we got from the API."""
     # Show a link to the issue in GitHub
     # Prefer the issue URL from GitHub - fall back to the user's input if we don't have it
     issue_url = issue.get("html_url", st.session_state.issue_url)
     st.link_button("Open the issue in GitHub", issue_url)
 
+    stats = gh.cache_stats()
+    st.write(
+        f"GitHub cache: {stats.hits:,} hits, {stats.misses:,} misses ({stats.hit_rate:.0%} of requests not downloaded)"
+    )
+
     st.write("This is the data as we got from from the GitHub API.")
     st.subheader("GitHub Issue")
     st.json(issue, expanded=False)
@@ -94,8 +238,9 @@ def show_github_raw_data(issue: dict, comments: dict):
     st.json(comments, expanded=False)
 
 
-def show_github_post_processed_data(issue: str, comments: str):
+def show_github_post_processed_data(issue: str, comments: str, report: compaction.CompactionReport):
     """Show the GitHub issue and comments after we have post-processed them."""
+    st.write(f"Compaction: {report}")
     with st.expander("Click to show/hide the post-processed GitHub data", expanded=False):
         st.write("This is the data after we have post-processed to use with the LLM.")
         st.subheader("GitHub Issue")
@@ -104,9 +249,13 @@ def show_github_post_processed_data(issue: str, comments: str):
         st.text(comments)
 
 
-def show_llm_raw_data(response: llm.LLMResponse):
-    """Show the raw data to/from the LLM."""
+def show_llm_raw_data(response: llm.LLMResponse, trace: tracing.Trace):
+    """Show the raw data to/from the LLM and the time spent in each step."""
     r = response  # Shorter name to make the code easier to read
+    if r.routing_reason:
+        st.write(f"Model {r.model} chosen automatically: {r.routing_reason}")
+    if r.cached:
+        st.write(f"Served from cache - saved US ${r.cost_saved:.4f}")
     st.write(
         (
             f"Total tokens: {r.total_tokens:,} (input: {r.input_tokens:,}, output: {r.output_tokens:,})"
@@ -115,7 +264,18 @@ def show_llm_raw_data(response: llm.LLMResponse):
     )
 
     tokens_sec = r.total_tokens / r.elapsed_time
-    st.write(f"Elapsed time: {r.elapsed_time:.2f} seconds ({tokens_sec:,.1f} tokens/sec)")
+    st.write(
+        f"Elapsed time: {r.elapsed_time:.2f} seconds ({tokens_sec:,.1f} tokens/sec)"
+        f" - first token after {r.time_to_first_token:.2f} seconds"
+    )
+
+    with st.expander("Click to show/hide the time spent in each step", expanded=False):
+        st.table(
+            [
+                {"Step": span.name, "Time (seconds)": f"{span.duration:.3f}", "Details": _format_attributes(span)}
+                for span in trace.spans
+            ]
+        )
 
     with st.expander("Click to show/hide the raw data we sent to and received from the LLM", expanded=False):
         st.subheader("Raw LLM response")
@@ -128,14 +288,42 @@ def show_llm_raw_data(response: llm.LLMResponse):
         st.text(r.llm_response)
 
 
-def show_llm_response(response: llm.LLMResponse):
-    """Show the formatted LLM response."""
-    # Change markdown heading 1 to heading 3 to make it smaller
-    # Ensure it's a heading by replacing only if it's at the start of the line
-    txt = re.sub(r"^# ", r"### ", response.llm_response, flags=re.MULTILINE)
+def _format_attributes(span: tracing.Span) -> str:
+    """Format the attributes of a span to show them in a table."""
+    return ", ".join(
+        f"{name}: {value:,.4f}" if isinstance(value, float) else f"{name}: {value}"
+        for name, value in span.attributes.items()
+    )
+
+
+def show_llm_response(response: llm.StreamedCompletion) -> llm.LLMResponse:
+    """Show the formatted LLM response as it's generated.
+
+    Returns:
+        llm.LLMResponse: The complete LLM response, once all tokens have been shown.
+    """
+    model = response.response.model  # The model chosen for the issue, if it was chosen automatically
+    st.header(f"Summary from {model}")
+    placeholder = st.empty()
+
+    text = ""
+    last_update = 0.0
+    with st.spinner(f"Waiting for {model} response..."), tracing.span("render"):
+        for token in response:
+            text += token
+            # Redrawing the markdown is not free - limit the number of updates for long responses
+            if time.time() - last_update > 0.1:
+                placeholder.markdown(_smaller_headings(text))
+                last_update = time.time()
+    placeholder.markdown(_smaller_headings(text))
 
-    st.header(f"Summary from {st.session_state.model}")
-    st.write(txt)
+    return response.response
+
+
+def _smaller_headings(text: str) -> str:
+    """Change markdown heading 1 to heading 3 to make it smaller."""
+    # Ensure it's a heading by replacing only if it's at the start of the line
+    return re.sub(r"^# ", r"### ", text, flags=re.MULTILINE)
 
 
 def main():
@@ -145,22 +333,82 @@ def main():
 
     display_settings_section()
     get_issue_to_show()
-    if st.button(f"Generate summary with {st.session_state.model}"):
+    if settings.read_config().getboolean("App", "prewarm_examples", fallback=True):
+        _start_prewarm()
+
+    # Set by the refresh button of a summary from the cache (see show_cache_status())
+    refresh = st.session_state.pop("refresh", False)
+    if st.button(f"Generate summary with {st.session_state.model}") or refresh:
         try:
-            issue, comments = get_github_data(st.session_state.issue_url)
-            parsed_issue = gh.parse_issue(issue)
-            parsed_comments = gh.parse_comments(comments)
-            response = get_llm_response(st.session_state.model, st.session_state.prompt, parsed_issue, parsed_comments)
-
-            tabs = st.tabs(["LLM data", "Raw GitHub data", "Parsed GitHub data"])
-            with tabs[0]:
-                show_llm_raw_data(response)
-            with tabs[1]:
-                show_github_raw_data(issue, comments)
-            with tabs[2]:
-                show_github_post_processed_data(parsed_issue, parsed_comments)
-
-            show_llm_response(response)
+            # Record the time spent in each step to show the breakdown with the LLM data
+            with tracing.trace() as trace, history.issue_context(st.session_state.issue_url):
+                # Summaries are shared by all sessions - reuse one made for the same issue and settings
+                cache = _summary_cache()
+                key = service.request_key(
+                    st.session_state.issue_url,
+                    st.session_state.model,
+                    st.session_state.prompt,
+                    st.session_state.compaction,
+                    st.session_state.use_cache,
+                )
+                # Refreshing makes a new summary - don't reuse any cached data for it
+                use_cache = st.session_state.use_cache and not refresh
+                result = cache.get(key) if use_cache else None
+                settings.load_env()
+                service_url = os.getenv("SUMMARY_SERVICE_URL")
+                if result is not None:
+                    show_cache_status(result)
+                    issue, comments, parsed_issue, parsed_comments, report, stream = _from_result(result, trace)
+                    # Nothing was paid for this summary - it cost the session that made it
+                    stream.response.cached = True
+                    stream.response.cost_saved = stream.response.cost
+                    stream.response.cost = 0.0
+                elif service_url:
+                    result = get_summary_from_service(service_url, use_cache)
+                    cache.put(key, {**result, "generated_at": time.time()})
+                    issue, comments, parsed_issue, parsed_comments, report, stream = _from_result(result, trace)
+                else:
+                    issue, comments = get_github_data(st.session_state.issue_url)
+                    # Keep the original data to show it, compact a copy to send to the LLM
+                    compact_issue, compact_comments, report = compaction.compact(
+                        issue, comments, st.session_state.compaction
+                    )
+                    parsed_issue = gh.parse_issue(compact_issue)
+                    parsed_comments = gh.parse_comments(compact_comments)
+                    stream = get_llm_response(
+                        st.session_state.model,
+                        st.session_state.prompt,
+                        compact_issue,
+                        compact_comments,
+                        parsed_issue,
+                        parsed_comments,
+                        use_cache,
+                    )
+
+                # Reserve the space for the tabs above the summary - we fill them after the summary is complete
+                tabs_container = st.container()
+                response = show_llm_response(stream)
+                if result is None:
+                    # Store the summary in the same format as the service's, once it's complete
+                    result = {
+                        "issue": issue,
+                        "comments": comments,
+                        "parsed_issue": parsed_issue,
+                        "parsed_comments": parsed_comments,
+                        "compaction": dataclasses.asdict(report),
+                        "response": dataclasses.asdict(response),
+                        "spans": [dataclasses.asdict(span) for span in trace.spans],
+                    }
+                    cache.put(key, {**result, "generated_at": time.time()})
+
+                with tabs_container:
+                    tabs = st.tabs(["LLM data", "Raw GitHub data", "Parsed GitHub data"])
+                    with tabs[0]:
+                        show_llm_raw_data(response, trace)
+                    with tabs[1]:
+                        show_github_raw_data(issue, comments)
+                    with tabs[2]:
+                        show_github_post_processed_data(parsed_issue, parsed_comments, report)
         except Exception as err:
             st.error(err)
 
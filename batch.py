@@ -0,0 +1,600 @@
+#! python
+"""Summarize many GitHub issues without user interaction.
+
+Each issue goes through the same steps as in the CLI and the Streamlit app: get the issue and comments from GitHub,
+parse them, and get the summary from the LLM. Many issues are processed at the same time, with separate limits for the
+number of concurrent requests to GitHub and to the LLM (they have different rate limits).
+
+The results are written to a JSONL file as each issue completes, so a long run that is interrupted still has the
+results of the issues it finished.
+
+Usage:
+
+    python batch.py issues.txt --output summaries.jsonl
+    python batch.py https://github.com/openai/openai-python/issues/488 https://github.com/openai/openai-python/issues/650
+
+With --openai-batch, the summaries are requested with the OpenAI Batch API, which costs half as much but may take up to
+24 hours. If the command is interrupted while waiting, save the results later with the batch ID it shows:
+
+    python batch.py issues.txt --openai-batch --output summaries.jsonl
+    python batch.py --openai-batch-id <batch ID> --output summaries.jsonl
+
+With --dedup, near-duplicate issues (e.g. the same crash reported many times) are summarized once: the other issues in
+the group are linked to the summary of the first one (see dedup.py).
+
+Files have one issue URL per line. Empty lines and lines starting with "#" are ignored.
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+import requests
+
+import cli
+import compaction
+import dedup
+import github
+import history
+import llm
+import store
+import summarize
+import tracing
+
+# Minimum number of GitHub REST API requests per issue: the issue and the first page of comments
+_REST_REQUESTS_PER_ISSUE = 2
+# Compaction of the issues compared to find near-duplicates (whatever the rules in llm.ini): the template boilerplate
+# makes all issues look alike
+_DEDUP_COMPACTION = compaction.CompactionConfig(remove_template_boilerplate=True)
+
+
+@dataclass
+class BatchResult:
+    """Summary of a batch run."""
+
+    issues: int = 0
+    errors: int = 0
+    elapsed_time: float = 0.0
+    cost: float = 0.0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    latencies: list[float] = field(default_factory=list)  # Time to process each issue, from start to end
+    duplicates: int = 0  # Issues linked to the summary of a near-duplicate issue instead of summarized
+    cost_saved_by_dedup: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Calculate the number of issues processed per second."""
+        return self.issues / self.elapsed_time if self.elapsed_time else 0.0
+
+    def add(self, record: dict):
+        """Add the result of one issue (the record saved to the output file)."""
+        self.issues += 1
+        if "duplicate_of" in record:
+            self.duplicates += 1
+            self.cost_saved_by_dedup += record["cost_saved"]
+            return
+        self.latencies.append(record["elapsed_time"])
+        if "error" in record:
+            self.errors += 1
+        else:
+            self.cost += record["cost"]
+            self.input_tokens += record["input_tokens"]
+            self.output_tokens += record["output_tokens"]
+
+
+def read_issue_urls(sources: list[str]) -> list[str]:
+    """Get the issue URLs from a list of URLs and files with URLs (one per line)."""
+    urls = []
+    for source in sources:
+        if os.path.isfile(source):
+            with open(source, encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        urls.append(line)
+        else:
+            urls.append(source)
+    return urls
+
+
+@contextmanager
+def _limit(semaphore: threading.Semaphore, name: str) -> Iterator[None]:
+    """Hold a concurrency limit in the block, recording the time waiting for it as a step."""
+    with tracing.span(f"queue_{name}"):
+        semaphore.acquire()
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+def _get_issue_from_github(
+    url: str, model: str, prompt: str, github_limit: threading.Semaphore, incremental: bool, graphql: bool
+) -> tuple[dict, list, dict | None]:
+    """Get the issue and comments to summarize from GitHub, and the previous summary in incremental mode."""
+    previous = None
+    with _limit(github_limit, "github"):
+        if incremental:
+            issue = github.get_issue(url)
+            comments, previous = summarize.get_new_comments(model, prompt, issue)
+        elif graphql:
+            issue, comments = github.get_issue_and_comments_graphql(url)
+        else:
+            issue = github.get_issue(url)
+            comments = github.get_issue_comments(issue)
+    return issue, comments, previous
+
+
+def _get_issue_from_store(
+    url: str, model: str, prompt: str, issue_store: store.IssueStore, incremental: bool
+) -> tuple[dict, list, dict | None]:
+    """Get the issue and comments to summarize from the local store (no GitHub requests)."""
+    issue = issue_store.get_issue(url)
+    if issue is None:
+        raise ValueError("Issue not in the local store -- ingest its repository first (see store.py)")
+    comments = issue_store.get_issue_comments(issue)
+    previous = None
+    if incremental:
+        comments, previous = summarize.get_new_comments(model, prompt, issue, comments)
+    return issue, comments, previous
+
+
+def _response_fields(response: llm.LLMResponse) -> dict:
+    """Get the fields of the LLM response to save in the result record."""
+    return {
+        "model": response.model,  # The model that created the summary (may differ from the requested one)
+        "routing_reason": response.routing_reason,
+        "summary": response.llm_response,
+        "input_tokens": response.input_tokens,
+        "output_tokens": response.output_tokens,
+        "cost": response.cost,
+        "cached": response.cached,
+        "llm_elapsed_time": response.elapsed_time,
+    }
+
+
+def _write_record(f, record: dict):
+    """Write a result record to the output file."""
+    f.write(json.dumps(record) + "\n")
+    f.flush()  # Keep the results of completed issues if the run is interrupted
+
+
+def _summarize_issue(
+    url: str,
+    model: str,
+    prompt: str,
+    github_limit: threading.Semaphore,
+    llm_limit: threading.Semaphore,
+    incremental: bool,
+    graphql: bool,
+    compaction_config: compaction.CompactionConfig,
+    issue_store: store.IssueStore | None,
+) -> dict:
+    """Run all steps for one issue and return the result record to save."""
+    start_time = time.time()
+    record = {"url": url, "model": model}
+    try:
+        with tracing.trace() as trace, history.issue_context(url):
+            if issue_store:
+                issue, comments, previous = _get_issue_from_store(url, model, prompt, issue_store, incremental)
+            else:
+                issue, comments, previous = _get_issue_from_github(
+                    url, model, prompt, github_limit, incremental, graphql
+                )
+
+            issue, comments, report = compaction.compact(issue, comments, compaction_config)
+            record["tokens_saved_by_compaction"] = report.tokens_saved
+
+            with _limit(llm_limit, "llm"):
+                if incremental:
+                    # Start over from the local store, not GitHub, if there are too many new comments
+                    all_comments = issue_store.get_issue_comments(issue) if issue_store else None
+                    response = summarize.summarize_issue_incremental(
+                        model, prompt, issue, comments, previous, all_comments=all_comments
+                    )
+                else:
+                    response = summarize.summarize_issue(model, prompt, issue, comments)
+
+            record.update(_response_fields(response))
+    except Exception as ex:  # Record the error and continue with the other issues
+        record["error"] = f"{type(ex).__name__}: {ex}"
+    record["elapsed_time"] = time.time() - start_time
+    # Time spent in each step, to find out where the time goes in slow issues
+    steps = {}
+    for span in trace.spans:
+        steps[span.name] = steps.get(span.name, 0.0) + span.duration
+    record["steps"] = steps
+    return record
+
+
+def _get_issue_text(url: str, github_limit: threading.Semaphore, issue_store: store.IssueStore | None) -> str | None:
+    """Get the text to compare an issue with the others (see _find_duplicates()), or None if there was an error."""
+    try:
+        if issue_store:
+            issue = issue_store.get_issue(url)
+            if issue is None:
+                return None
+        else:
+            with _limit(github_limit, "github"):
+                issue = github.get_issue(url)
+    except Exception:  # The error is recorded when the issue is summarized
+        return None
+    issue, _, _ = compaction.compact(issue, [], _DEDUP_COMPACTION)
+    # Only the title and body - the submitter and the dates are different in every report of the same problem
+    return f"{issue['title']}\n{issue['body'] or ''}"
+
+
+def _find_duplicates(
+    urls: list[str], github_limit: threading.Semaphore, workers: int, issue_store: store.IssueStore | None
+) -> dict[str, str]:
+    """Find the near-duplicate issues.
+
+    Gets only the issues (not the comments). The issues summarized later are requested again, but as conditional
+    requests (see github.py): GitHub confirms the issue didn't change, without counting them against the rate limit.
+
+    Returns:
+        dict[str, str]: The URL of the issue to link to, by the URL of each near-duplicate issue.
+    """
+    with ThreadPoolExecutor(workers) as executor:
+        texts = executor.map(lambda url: _get_issue_text(url, github_limit, issue_store), urls)
+        return dedup.find_duplicates({url: text for url, text in zip(urls, texts) if text is not None})
+
+
+def _duplicate_record(url: str, representative: dict) -> dict:
+    """Create the result record of a near-duplicate issue, linked to the summary of its representative.
+
+    The record has no summary - a summary of another issue would have its title, submitter, and dates. The summary is
+    in the record of the representative (the URL in "duplicate_of").
+    """
+    return {
+        "url": url,
+        "model": representative["model"],
+        "duplicate_of": representative["url"],
+        "summary": "",
+        "input_tokens": 0,
+        "output_tokens": 0,
+        "cost": 0.0,
+        # Estimated as the cost of the representative - the issues are about the same size
+        "cost_saved": max(0.0, representative["cost"]),
+        "cached": False,
+        "elapsed_time": 0.0,
+    }
+
+
+def run_batch(
+    urls: list[str],
+    output: str,
+    model: str,
+    prompt: str,
+    github_workers: int = 4,
+    llm_workers: int = 4,
+    incremental: bool = False,
+    graphql: bool = False,
+    issue_store: store.IssueStore | None = None,
+    deduplicate: bool = False,
+) -> BatchResult:
+    """Summarize a list of GitHub issues and save the results to a JSONL file.
+
+    Args:
+        urls (list[str]): The issue URLs.
+        output (str): The JSONL file to write the results to. Results are appended to the file.
+        model (str): The LLM model to use.
+        prompt (str): The LLM prompt.
+        github_workers (int): Maximum number of issues being fetched from GitHub at the same time.
+        llm_workers (int): Maximum number of LLM requests at the same time.
+        incremental (bool): Update the previous summary of each issue with the comments added since then, instead of
+        summarizing all comments again.
+        graphql (bool): Get the issues and comments with the GitHub GraphQL API (needs GITHUB_TOKEN). Not used in
+        incremental mode, which needs the REST API to get only the new comments.
+        issue_store (store.IssueStore): Get the issues and comments from this local store instead of GitHub.
+        deduplicate (bool): Summarize only one issue of each group of near-duplicate issues, and link the others to its
+        summary (record field "duplicate_of"). If it fails, the others are summarized. Not used in incremental mode.
+
+    Returns:
+        BatchResult: Statistics for the run.
+    """
+    result = BatchResult()
+    github_limit = threading.Semaphore(github_workers)
+    llm_limit = threading.Semaphore(llm_workers)
+    write_lock = threading.Lock()
+    compaction_config = compaction.load_config()
+
+    def process(url: str) -> dict:
+        record = _summarize_issue(
+            url, model, prompt, github_limit, llm_limit, incremental, graphql, compaction_config, issue_store
+        )
+        with write_lock:
+            _write_record(f, record)
+            result.add(record)
+        return record
+
+    start_time = time.time()
+    duplicates = {}
+    if deduplicate and not incremental:
+        urls = list(dict.fromkeys(urls))  # Repeated URLs are duplicates too
+        duplicates = _find_duplicates(urls, github_limit, github_workers, issue_store)
+    # Enough threads to keep both stages busy - the semaphores limit the concurrency of each stage
+    with open(output, "a", encoding="utf-8") as f, ThreadPoolExecutor(github_workers + llm_workers) as executor:
+        unique_urls = [url for url in urls if url not in duplicates]
+        # Consume the results to surface unexpected errors (expected errors are recorded in the output file)
+        records = dict(zip(unique_urls, executor.map(process, unique_urls)))
+
+        failed = []
+        for url, representative in duplicates.items():
+            if "error" in records[representative]:
+                failed.append(url)
+            else:
+                with write_lock:
+                    record = _duplicate_record(url, records[representative])
+                    _write_record(f, record)
+                    result.add(record)
+        list(executor.map(process, failed))
+    result.elapsed_time = time.time() - start_time
+    return result
+
+
+def _prepare_openai_batch_request(
+    url: str,
+    model: str,
+    prompt: str,
+    github_limit: threading.Semaphore,
+    graphql: bool,
+    compaction_config: compaction.CompactionConfig,
+    issue_store: store.IssueStore | None,
+) -> tuple[dict, llm.BatchRequest | None]:
+    """Get an issue and create its request for the OpenAI Batch API.
+
+    Returns:
+        tuple: The result record and the request. If the issue doesn't need a batch request, the request is None and
+        the record is complete: the summary is in the cache, the issue is too large for one request (it's summarized
+        now, in chunks), or there was an error.
+    """
+    start_time = time.time()
+    record = {"url": url, "model": model}
+    request = None
+    try:
+        if issue_store:
+            issue, comments, _ = _get_issue_from_store(url, model, prompt, issue_store, False)
+        else:
+            issue, comments, _ = _get_issue_from_github(url, model, prompt, github_limit, False, graphql)
+        issue, comments, report = compaction.compact(issue, comments, compaction_config)
+        record["tokens_saved_by_compaction"] = report.tokens_saved
+
+        user_input = f"{github.parse_issue(issue)}\n{github.parse_comments(comments)}"
+        model, record["routing_reason"] = summarize.choose_model(model, prompt, user_input)
+        record["model"] = model
+        response = llm.get_cached_response(model, prompt, user_input)
+        if response is None and not summarize.fits_context(model, prompt, user_input):
+            with history.issue_context(url):
+                response = summarize.summarize_issue(model, prompt, issue, comments, user_input)
+        if response is None:
+            request = llm.BatchRequest(url, model, prompt, user_input)
+        else:
+            record.update(_response_fields(response))
+    except Exception as ex:  # Record the error and continue with the other issues
+        record["error"] = f"{type(ex).__name__}: {ex}"
+    record["elapsed_time"] = time.time() - start_time
+    return record, request
+
+
+def run_openai_batch(
+    urls: list[str],
+    output: str,
+    model: str,
+    prompt: str,
+    github_workers: int = 4,
+    graphql: bool = False,
+    issue_store: store.IssueStore | None = None,
+    poll_interval: float = 60.0,
+) -> BatchResult:
+    """Summarize a list of GitHub issues with the OpenAI Batch API and save the results to a JSONL file.
+
+    The Batch API costs half as much as regular requests, but it may take up to 24 hours to complete. Use it when the
+    summaries are not needed right away (e.g. in nightly jobs).
+
+    The issues are fetched from GitHub and written to a batch file (next to the output file), which is submitted to
+    OpenAI. This function waits for the batch to complete and saves the results. If it's interrupted while waiting,
+    get the results later with ingest_openai_batch() and the batch ID it shows.
+
+    Issues that don't need a batch request are saved right away: summaries that are in the cache, issues that are too
+    large for one request (summarized in chunks with regular requests), and errors.
+
+    Args:
+        urls (list[str]): The issue URLs.
+        output (str): The JSONL file to write the results to. Results are appended to the file.
+        model (str): The LLM model to use.
+        prompt (str): The LLM prompt.
+        github_workers (int): Maximum number of issues being fetched from GitHub at the same time.
+        graphql (bool): Get the issues and comments with the GitHub GraphQL API (needs GITHUB_TOKEN).
+        issue_store (store.IssueStore): Get the issues and comments from this local store instead of GitHub.
+        poll_interval (float): Seconds between checks of the batch status.
+
+    Returns:
+        BatchResult: Statistics for the run.
+    """
+    start_time = time.time()
+    result = BatchResult()
+    github_limit = threading.Semaphore(github_workers)
+    compaction_config = compaction.load_config()
+    urls = list(dict.fromkeys(urls))  # The URLs identify the requests in the batch - they must be unique
+
+    def prepare(url: str) -> tuple[dict, llm.BatchRequest | None]:
+        return _prepare_openai_batch_request(url, model, prompt, github_limit, graphql, compaction_config, issue_store)
+
+    with ThreadPoolExecutor(github_workers) as executor:
+        prepared = list(executor.map(prepare, urls))
+
+    batch_requests = [request for _, request in prepared if request]
+    with open(output, "a", encoding="utf-8") as f:
+        for record, request in prepared:
+            if not request:
+                _write_record(f, record)
+                result.add(record)
+    if batch_requests:
+        batch_file = f"{os.path.splitext(output)[0]}-openai-batch.jsonl"
+        llm.write_batch_file(batch_file, batch_requests)
+        batch_id = llm.submit_batch(batch_file)
+        print(f"Submitted {len(batch_requests)} requests in {batch_file} to OpenAI - batch ID: {batch_id}")
+        llm.wait_for_batch(batch_id, poll_interval, progress=_show_openai_batch_status)
+        ingest_openai_batch(batch_id, output, result)
+
+    result.elapsed_time = time.time() - start_time
+    return result
+
+
+def _show_openai_batch_status(status: dict):
+    """Show the progress of an OpenAI batch."""
+    counts = status.get("request_counts") or {}
+    print(
+        f"Batch {status['id']}: {status['status']} - {counts.get('completed', 0)} of {counts.get('total', 0)} requests"
+        f" completed, {counts.get('failed', 0)} failed"
+    )
+
+
+def ingest_openai_batch(batch_id: str, output: str, result: BatchResult | None = None) -> BatchResult:
+    """Save the results of an OpenAI batch submitted by run_openai_batch() to a JSONL file.
+
+    Args:
+        batch_id (str): The batch ID.
+        output (str): The JSONL file to write the results to. Results are appended to the file.
+        result (BatchResult): Statistics to add the results to. None to create new statistics.
+
+    Returns:
+        BatchResult: Statistics for the results.
+    """
+    result = result or BatchResult()
+    status = llm.get_batch_status(batch_id)
+    if status["status"] not in ("completed", "expired", "cancelled"):
+        # Expired and cancelled batches may have partial results
+        raise ValueError(f"Batch {batch_id} has no results (status: {status['status']})")
+
+    responses, errors = llm.get_batch_results(batch_id)
+    with open(output, "a", encoding="utf-8") as f:
+        for url, response in responses.items():
+            record = {"url": url, "model": response.model, "batch_id": batch_id, **_response_fields(response)}
+            record["elapsed_time"] = response.elapsed_time
+            _write_record(f, record)
+            result.add(record)
+        for url, error in errors.items():
+            record = {"url": url, "batch_id": batch_id, "error": error, "elapsed_time": 0.0}
+            _write_record(f, record)
+            result.add(record)
+    return result
+
+
+def check_rate_limit(issues: int, graphql: bool = False):
+    """Show the GitHub rate limit quota and warn if it's not enough for the batch.
+
+    Requests are paced to stay within the quota, but issues fail if the quota runs out for too long.
+    """
+    resource = "graphql" if graphql else "core"
+    try:
+        state = github.rate_limit_state(resource, refresh=True)
+    except requests.RequestException as ex:
+        print(f"Could not get the GitHub rate limit ({ex}) - continuing without checking it")
+        return
+
+    needed = issues * (1 if graphql else _REST_REQUESTS_PER_ISSUE)
+    print(
+        f"GitHub {resource} quota: {state.remaining:,} of {state.limit:,} left,"
+        f" resets in {state.seconds_until_reset / 60:.0f} minutes"
+    )
+    if needed > state.remaining:
+        print(
+            f"WARNING: the batch needs at least {needed:,} requests - some issues may fail with rate limit errors."
+            " Set GITHUB_TOKEN for a higher limit, or run the batch again after the reset (use --incremental to skip"
+            " the issues that didn't change)."
+        )
+
+
+def show_batch_result(result: BatchResult):
+    """Show the statistics for a batch run."""
+    r = result  # Shorter name for convenience
+    print(f"Issues: {r.issues} ({r.errors} errors) in {r.elapsed_time:.1f} seconds ({r.throughput:.2f} issues/sec)")
+    p50, p95, p99, p100 = (tracing.percentile(r.latencies, pct) for pct in (50, 95, 99, 100))
+    print(f"Latency per issue: p50 {p50:.2f}s, p95 {p95:.2f}s, p99 {p99:.2f}s, max {p100:.2f}s")
+    print(f"Input tokens: {r.input_tokens:,}, output tokens: {r.output_tokens:,} - cost: US ${r.cost:.4f}")
+    if r.duplicates:
+        print(
+            f"Near-duplicates: {r.duplicates} issues linked to the summary of a similar issue - saved"
+            f" {r.duplicates} LLM calls, about US ${r.cost_saved_by_dedup:.4f}"
+        )
+
+
+def main():
+    """Run the batch summarization from the command line."""
+    parser = argparse.ArgumentParser(description="Summarize GitHub issues in batch.")
+    parser.add_argument("sources", nargs="*", help="issue URLs or files with one issue URL per line")
+    parser.add_argument("-o", "--output", default="summaries.jsonl", help="JSONL file to append the results to")
+    parser.add_argument("--model", help="LLM model (default: the model in llm.ini)")
+    parser.add_argument("--github-workers", type=int, default=4, help="concurrent GitHub requests")
+    parser.add_argument("--llm-workers", type=int, default=4, help="concurrent LLM requests")
+    parser.add_argument("--incremental", action="store_true", help="update previous summaries with new comments only")
+    parser.add_argument("--graphql", action="store_true", help="get issues with the GitHub GraphQL API (needs a token)")
+    parser.add_argument("--store", help="get the issues from this local store (see store.py) instead of GitHub")
+    parser.add_argument(
+        "--openai-batch", action="store_true", help="use the OpenAI Batch API (half the cost, up to 24 hours to finish)"
+    )
+    parser.add_argument(
+        "--dedup", action="store_true", help="summarize near-duplicate issues once and link the others to the summary"
+    )
+    parser.add_argument("--openai-batch-id", help="save the results of a batch submitted before (no sources needed)")
+    parser.add_argument("--metrics", help="file to save the metrics to, in the Prometheus text format")
+    parser.add_argument("--spans", help="JSONL file to append the spans (timing of each step) to")
+    args = parser.parse_args()
+    if args.openai_batch_id:
+        result = ingest_openai_batch(args.openai_batch_id, args.output)
+        print(f"Saved the results of batch {args.openai_batch_id} to {args.output}")
+        show_batch_result(result)
+        return
+    if not args.sources:
+        parser.error("the sources are required (unless --openai-batch-id is used)")
+    if args.openai_batch and args.incremental:
+        parser.error("--incremental is not supported with --openai-batch")
+    if args.dedup and (args.openai_batch or args.incremental):
+        parser.error("--dedup is not supported with --openai-batch or --incremental")
+
+    model, prompt = cli.get_model_and_prompt()
+    model = args.model or model
+    urls = read_issue_urls(args.sources)
+    print(f"Summarizing {len(urls)} issues with {model}, saving to {args.output}")
+    issue_store = store.IssueStore(args.store) if args.store else None
+    if not issue_store:
+        check_rate_limit(len(urls), args.graphql)
+
+    if args.openai_batch:
+        result = run_openai_batch(urls, args.output, model, prompt, args.github_workers, args.graphql, issue_store)
+    else:
+        result = run_batch(
+            urls,
+            args.output,
+            model,
+            prompt,
+            args.github_workers,
+            args.llm_workers,
+            args.incremental,
+            args.graphql,
+            issue_store,
+            args.dedup,
+        )
+    show_batch_result(result)
+    if not issue_store:
+        state = github.rate_limit_state("graphql" if args.graphql else "core")
+        print(f"GitHub quota left: {state.remaining:,} ({state.retries} requests retried after hitting a rate limit)")
+
+    if args.metrics:
+        with open(args.metrics, "w", encoding="utf-8") as f:
+            f.write(tracing.export_prometheus())
+    if args.spans:
+        tracing.export_jsonl(args.spans)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,694 @@
+#! python
+"""Benchmark the steps of summarizing issues against local stand-ins for the GitHub and OpenAI APIs.
+
+The real services are too slow and variable to tell whether a change makes the code faster. This benchmark starts two
+local HTTP servers instead:
+
+- A fake GitHub REST API with synthetic issues. Issue N has N % 10,000 comments (e.g. issue 5000 has 5,000 comments
+  and issue 10050 has 50), served 100 per page with the same pagination, Link and ETag headers as GitHub. It also
+  answers the GraphQL queries of github.py with the same issues, in pages of 100 comments with cursors.
+- A fake OpenAI API that answers chat completions after a fixed time with a summary of the requested length. It also
+  has the files and batches endpoints of the Batch API, completing each batch as soon as it's created.
+
+Both add a configurable latency to each request. The scenarios call the same functions the app and batch.py use
+(get_issue(), get_issue_comments(), get_issue_and_comments_graphql(), parse_issue(), parse_comments(),
+chat_completion(), run_batch(), and run_openai_batch()) and report the throughput, the latency percentiles, and the
+peak memory (measured in a separate run, because tracing the allocations slows down the code).
+
+The benchmark runs in a temporary directory with a copy of llm.ini, so it doesn't use or fill the caches and the call
+history of the real runs. The caches are cleared before each run, unless --warm is used. The fake servers run in the
+same process, so compare results from the same machine and settings only.
+
+Usage:
+
+    python bench.py --save-baseline bench_baseline.json
+    python bench.py --baseline bench_baseline.json
+    python bench.py --scenarios get_issue_comments parse --iterations 10 --github-latency 0.05
+
+With --baseline, the results are compared with the saved ones and the exit code is 1 if any scenario got slower (or
+used more memory) by more than the tolerance.
+"""
+
+import argparse
+import contextlib
+import dataclasses
+import email.parser
+import email.policy
+import functools
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections.abc import Callable
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import ClassVar
+from urllib.parse import parse_qs, urlparse
+
+import batch
+import cli
+import github
+import llm
+import summarize
+import tracing
+
+_REPO = "bench/repo"
+# Issue N has N % _ISSUE_STRIDE comments, so that there are many issues with the same number of comments
+_ISSUE_STRIDE = 10_000
+_COMMENTS_PER_PAGE = 100
+_COMMENT_COUNTS = (0, 100, 1000, 5000)
+# Issue used for the scenarios with one issue - a typical size
+_TYPICAL_COMMENTS = 100
+_BATCH_ISSUES = 20
+_BATCH_COMMENTS = 50
+_START_TIME = 1_700_000_000  # Creation time of the synthetic issues (Unix time)
+
+_DEFAULT_ITERATIONS = 5
+_DEFAULT_TOLERANCE = 0.10  # 10%
+# Changes in time smaller than this (seconds) are noise, even if they are large relative to very fast scenarios
+_MIN_TIME_CHANGE = 0.001
+
+
+def _timestamp(offset_minutes: int) -> str:
+    """Get an ISO 8601 time a number of minutes after the creation of the synthetic issues."""
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(_START_TIME + offset_minutes * 60))
+
+
+def _comment_body(number: int, index: int) -> str:
+    """Get the body of a synthetic comment, with the mix of text, code, and logs found in real issues."""
+    text = (
+        f"Comment {index} on issue {number}. I can reproduce this with the latest version. It happens when the "
+        "client reads a large response and the connection is slow. Setting a longer timeout doesn't help."
+    )
+    if index % 10 == 3:
+        text += "\n\n```python\nclient = Client(timeout=30)\nfor item in client.stream(request):\n    print(item)\n```"
+    elif index % 10 == 7:
+        frames = "\n".join(f'  File "module{i}.py", line {i * 10}, in function{i}' for i in range(12))
+        text += f"\n\n```\nTraceback (most recent call last):\n{frames}\nTimeoutError: read timed out\n```"
+    elif index % 10 == 9:
+        text = "+1"
+    return text
+
+
+@functools.lru_cache(maxsize=1024)
+def _issue_json(base_url: str, owner: str, name: str, number: int) -> bytes:
+    """Get a synthetic issue, as the GitHub API returns it."""
+    repo_url = f"{base_url}/repos/{owner}/{name}"
+    issue = {
+        "url": f"{repo_url}/issues/{number}",
+        "repository_url": repo_url,
+        "comments_url": f"{repo_url}/issues/{number}/comments",
+        "html_url": f"https://github.com/{owner}/{name}/issues/{number}",
+        "id": number,
+        "number": number,
+        "title": f"Streaming responses time out on slow connections (issue {number})",
+        "body": "\n\n".join(_comment_body(number, i) for i in range(4)),
+        "user": {"login": "reporter"},
+        "labels": [{"name": "bug"}, {"name": "needs triage"}],
+        "state": "open",
+        "author_association": "NONE",
+        "comments": number % _ISSUE_STRIDE,
+        "created_at": _timestamp(0),
+        "updated_at": _timestamp(number % _ISSUE_STRIDE),
+    }
+    return json.dumps(issue).encode("utf-8")
+
+
+@functools.lru_cache(maxsize=1024)
+def _comments_json(base_url: str, owner: str, name: str, number: int, page: int) -> bytes:
+    """Get one page of the comments of a synthetic issue, as the GitHub API returns it."""
+    issue_url = f"{base_url}/repos/{owner}/{name}/issues/{number}"
+    first = (page - 1) * _COMMENTS_PER_PAGE
+    last = min(first + _COMMENTS_PER_PAGE, number % _ISSUE_STRIDE)
+    comments = [
+        {
+            "id": number * _ISSUE_STRIDE + i,
+            "issue_url": issue_url,
+            "html_url": f"https://github.com/{owner}/{name}/issues/{number}#issuecomment-{i}",
+            "user": {"login": f"user{i % 37}", "type": "User"},
+            "author_association": "NONE",
+            "body": _comment_body(number, i),
+            "created_at": _timestamp(i + 1),
+            "updated_at": _timestamp(i + 1),
+        }
+        for i in range(first, last)
+    ]
+    return json.dumps(comments).encode("utf-8")
+
+
+def _graphql_json(base_url: str, owner: str, name: str, number: int, cursor: str | None) -> bytes:
+    """Answer a GraphQL query of github.py: the issue and the first page of comments, or the page after `cursor`.
+
+    Made from the same synthetic data as the REST API, to compare the results of both APIs. The cursor is the number of
+    the next page.
+    """
+    page = int(cursor or "1")
+    comments = json.loads(_comments_json(base_url, owner, name, number, page))
+    total = number % _ISSUE_STRIDE
+    connection = {
+        "totalCount": total,
+        "pageInfo": {"hasNextPage": page * _COMMENTS_PER_PAGE < total, "endCursor": str(page + 1)},
+        "nodes": [
+            {
+                "databaseId": comment["id"],
+                "body": comment["body"],
+                "createdAt": comment["created_at"],
+                "updatedAt": comment["updated_at"],
+                "authorAssociation": comment["author_association"],
+                "author": {"login": comment["user"]["login"], "__typename": comment["user"]["type"]},
+            }
+            for comment in comments
+        ],
+    }
+    if cursor:
+        return json.dumps({"data": {"repository": {"issue": {"comments": connection}}}}).encode("utf-8")
+
+    issue = json.loads(_issue_json(base_url, owner, name, number))
+    node = {
+        "number": issue["number"],
+        "title": issue["title"],
+        "body": issue["body"],
+        "url": issue["html_url"],
+        "state": issue["state"].upper(),
+        "createdAt": issue["created_at"],
+        "updatedAt": issue["updated_at"],
+        "authorAssociation": issue["author_association"],
+        "author": {"login": issue["user"]["login"]},
+        "labels": {"nodes": [{"name": label["name"]} for label in issue["labels"]]},
+        "comments": connection,
+    }
+    return json.dumps({"data": {"repository": {"issue": node}}}).encode("utf-8")
+
+
+class _FakeGitHub(BaseHTTPRequestHandler):
+    """Fake GitHub API: issues and their comments with the REST API (see _issue_json() and _comments_json()) and with
+    the GraphQL API (see _graphql_json())."""
+
+    protocol_version = "HTTP/1.1"  # Keep the connections open, as GitHub does
+    disable_nagle_algorithm = True  # Send the responses right away, without waiting for the client to acknowledge
+    base_url = ""
+    latency = 0.0
+
+    def log_message(self, format, *args):
+        """Don't log the requests."""
+
+    def do_GET(self):
+        """Handle GET requests (issues and comments)."""
+        time.sleep(self.latency)
+        url = urlparse(self.path)
+        match = re.fullmatch(r"/repos/([^/]+)/([^/]+)/issues/(\d+)(/comments)?", url.path)
+        if not match:
+            self._send(404, b'{"message": "Not Found"}')
+            return
+
+        owner, name, number = match.group(1), match.group(2), int(match.group(3))
+        headers = {}
+        if match.group(4):
+            query = parse_qs(url.query)
+            page = int(query.get("page", ["1"])[0])
+            last_page = max(1, math.ceil((number % _ISSUE_STRIDE) / _COMMENTS_PER_PAGE))
+            body = _comments_json(self.base_url, owner, name, number, page)
+            if page < last_page:
+                page_url = f"{self.base_url}{url.path}?per_page={_COMMENTS_PER_PAGE}&page="
+                headers["Link"] = f'<{page_url}{page + 1}>; rel="next", <{page_url}{last_page}>; rel="last"'
+        else:
+            body = _issue_json(self.base_url, owner, name, number)
+
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        if self.headers.get("If-None-Match") == etag:
+            self._send(304, b"", {"ETag": etag})
+        else:
+            self._send(200, body, {"ETag": etag, **headers})
+
+    def do_POST(self):
+        """Handle POST requests (GraphQL queries)."""
+        time.sleep(self.latency)
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        if urlparse(self.path).path != "/graphql":
+            self._send(404, b'{"message": "Not Found"}')
+            return
+        variables = request["variables"]
+        body = _graphql_json(
+            self.base_url, variables["owner"], variables["name"], variables["number"], variables.get("cursor")
+        )
+        self._send(200, body)
+
+    def _send(self, status: int, body: bytes, headers: dict | None = None):
+        """Send a response."""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _FakeOpenAI(BaseHTTPRequestHandler):
+    """Fake OpenAI API: chat completions (not streamed), answering with a summary in the requested sections, and the
+    files and batches endpoints of the Batch API."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    latency = 0.0
+    output_tokens = 0
+    # Uploaded and generated files (content by ID) and batches (batch object by ID), shared by all requests
+    files: ClassVar[dict[str, bytes]] = {}
+    batches: ClassVar[dict[str, dict]] = {}
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        """Don't log the requests."""
+
+    def do_POST(self):
+        """Handle POST requests (chat completions, file uploads, and new batches)."""
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = urlparse(self.path).path
+        if path.endswith("/chat/completions"):
+            request = json.loads(body)
+            if request.get("stream"):
+                self._send(400, {"error": {"message": "Only chat completions without streaming are supported"}})
+                return
+            time.sleep(self.latency)
+            self._send(200, self._completion(request))
+        elif path.endswith("/files"):
+            self._send(200, self._upload_file(body))
+        elif path.endswith("/batches"):
+            time.sleep(self.latency)
+            self._send(200, self._create_batch(json.loads(body)))
+        else:
+            self._send(404, {"error": {"message": f"Unknown endpoint: {path}"}})
+
+    def do_GET(self):
+        """Handle GET requests (batch status and file contents)."""
+        path = urlparse(self.path).path
+        batch = re.search(r"/batches/([^/]+)$", path)
+        content = re.search(r"/files/([^/]+)/content$", path)
+        if batch and batch.group(1) in self.batches:
+            self._send(200, self.batches[batch.group(1)])
+        elif content and content.group(1) in self.files:
+            self._send_bytes(200, self.files[content.group(1)], "application/octet-stream")
+        else:
+            self._send(404, {"error": {"message": f"Not found: {path}"}})
+
+    def _completion(self, request: dict) -> dict:
+        """Create the chat completion for a request."""
+        headings = "# Issue\n- Streaming times out\n# Summary\nReads time out.\n# Details\n"
+        text = headings + llm.truncate_to_tokens("The client times out. " * self.output_tokens, self.output_tokens)
+        text += "\n# Comments\n| Date | Author | Summary |\n"
+        input_tokens = sum(llm.estimate_tokens(message["content"]) for message in request["messages"])
+        return {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": input_tokens,
+                "completion_tokens": self.output_tokens,
+                "total_tokens": input_tokens + self.output_tokens,
+            },
+        }
+
+    def _add_file(self, content: bytes, filename: str, purpose: str) -> dict:
+        """Store a file and get its file object."""
+        with self.lock:
+            file_id = f"file-bench-{len(self.files)}"
+            self.files[file_id] = content
+        return {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+
+    def _upload_file(self, body: bytes) -> dict:
+        """Store a file uploaded as multipart/form-data (the "file" and "purpose" fields)."""
+        header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode()
+        form = email.parser.BytesParser(policy=email.policy.default).parsebytes(header + body)
+        fields = {part.get_param("name", header="content-disposition"): part for part in form.iter_parts()}
+        file = fields["file"]
+        purpose = fields["purpose"].get_payload(decode=True).decode()
+        return self._add_file(file.get_payload(decode=True), file.get_filename() or "upload.jsonl", purpose)
+
+    def _create_batch(self, request: dict) -> dict:
+        """Create a batch and run its requests right away - the batch is completed when it's returned."""
+        lines = [json.loads(line) for line in self.files[request["input_file_id"]].decode().splitlines() if line]
+        results = [
+            {
+                "id": f"batch-req-{i}",
+                "custom_id": line["custom_id"],
+                "response": {"status_code": 200, "request_id": f"req-{i}", "body": self._completion(line["body"])},
+                "error": None,
+            }
+            for i, line in enumerate(lines)
+        ]
+        output = "".join(json.dumps(result) + "\n" for result in results).encode()
+        output_file = self._add_file(output, "batch_output.jsonl", "batch_output")
+        now = int(time.time())
+        with self.lock:
+            batch_id = f"batch-bench-{len(self.batches)}"
+            self.batches[batch_id] = {
+                "id": batch_id,
+                "object": "batch",
+                "endpoint": request["endpoint"],
+                "input_file_id": request["input_file_id"],
+                "completion_window": request["completion_window"],
+                "status": "completed",
+                "output_file_id": output_file["id"],
+                "created_at": now,
+                "completed_at": now,
+                "request_counts": {"total": len(results), "completed": len(results), "failed": 0},
+            }
+        return self.batches[batch_id]
+
+    def _send(self, status: int, data: dict):
+        """Send a JSON response."""
+        self._send_bytes(status, json.dumps(data).encode("utf-8"), "application/json")
+
+    def _send_bytes(self, status: int, body: bytes, content_type: str):
+        """Send a response."""
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _start_server(handler: type[BaseHTTPRequestHandler]) -> tuple[ThreadingHTTPServer, str]:
+    """Start a server on a free local port, in a background thread.
+
+    Returns:
+        tuple: The server and its URL.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def _issue_url(comments: int, index: int = 0) -> str:
+    """Get the URL of a synthetic issue with a number of comments (use a different index to get different issues)."""
+    return f"https://github.com/{_REPO}/issues/{index * _ISSUE_STRIDE + comments}"
+
+
+@dataclass
+class Scenario:
+    """Something to measure: `setup` runs once (not measured) and returns the function to measure."""
+
+    name: str
+    setup: Callable[[], Callable[[], None]]
+    operations: int = 1  # Operations in each run (e.g. issues in a batch), to calculate the throughput
+
+
+@dataclass
+class ScenarioResult:
+    """Measurements of one scenario. Times in seconds."""
+
+    name: str
+    runs: int
+    throughput: float  # Operations per second
+    p50: float
+    p95: float
+    p99: float
+    max: float
+    peak_memory_mb: float
+
+
+def _scenarios(model: str, prompt: str) -> list[Scenario]:
+    """Get all scenarios."""
+
+    def get_issue():
+        return lambda: github.get_issue(_issue_url(_TYPICAL_COMMENTS))
+
+    def get_issue_comments(count: int):
+        issue = github.get_issue(_issue_url(count))
+        return lambda: github.get_issue_comments(issue)
+
+    def get_issue_and_comments_graphql(count: int):
+        url = _issue_url(count)
+        # Check that both APIs give the same data to summarize
+        issue = github.get_issue(url)
+        rest = (github.parse_issue(issue), github.parse_comments(github.get_issue_comments(issue)))
+        issue, comments = github.get_issue_and_comments_graphql(url)
+        if (github.parse_issue(issue), github.parse_comments(comments)) != rest:
+            raise ValueError(f"The GraphQL and REST APIs return different data for {url}")
+        return lambda: github.get_issue_and_comments_graphql(url)
+
+    def parse(count: int):
+        issue = github.get_issue(_issue_url(count))
+        comments = github.get_issue_comments(issue)
+        return lambda: (github.parse_issue(issue), github.parse_comments(comments))
+
+    def chat_completion():
+        issue = github.get_issue(_issue_url(_TYPICAL_COMMENTS))
+        user_input = f"{github.parse_issue(issue)}\n{github.parse_comments(github.get_issue_comments(issue))}"
+        chosen_model, _ = summarize.choose_model(model, prompt, user_input)
+        return lambda: llm.chat_completion(chosen_model, prompt, user_input, use_cache=False)
+
+    def summarize_issue():
+        def run():
+            issue = github.get_issue(_issue_url(_TYPICAL_COMMENTS))
+            comments = github.get_issue_comments(issue)
+            summarize.summarize_issue(model, prompt, issue, comments)
+
+        return run
+
+    def run_batch():
+        urls = [_issue_url(_BATCH_COMMENTS, i + 1) for i in range(_BATCH_ISSUES)]
+        return lambda: batch.run_batch(urls, "bench-summaries.jsonl", model, prompt)
+
+    def run_openai_batch():
+        urls = [_issue_url(_BATCH_COMMENTS, i + 1) for i in range(_BATCH_ISSUES)]
+
+        def run():
+            # Hide the progress messages - the fake batch is completed right away
+            with contextlib.redirect_stdout(None):
+                batch.run_openai_batch(urls, "bench-openai-batch.jsonl", model, prompt, poll_interval=0)
+
+        return run
+
+    scenarios = [Scenario("get_issue", get_issue)]
+    scenarios += [
+        Scenario(f"get_issue_comments[{n}]", functools.partial(get_issue_comments, n)) for n in _COMMENT_COUNTS
+    ]
+    scenarios += [
+        Scenario(f"get_issue_and_comments_graphql[{n}]", functools.partial(get_issue_and_comments_graphql, n))
+        for n in _COMMENT_COUNTS
+    ]
+    scenarios += [Scenario(f"parse[{n}]", functools.partial(parse, n)) for n in _COMMENT_COUNTS]
+    scenarios += [
+        Scenario("chat_completion", chat_completion),
+        Scenario("summarize_issue", summarize_issue),
+        Scenario("run_batch", run_batch, operations=_BATCH_ISSUES),
+        Scenario("run_openai_batch", run_openai_batch, operations=_BATCH_ISSUES),
+    ]
+    return scenarios
+
+
+def _clear_caches():
+    """Delete the caches (in the temporary directory) to measure the runs that download everything."""
+    shutil.rmtree(".cache", ignore_errors=True)
+
+
+def run_scenario(scenario: Scenario, runs: int, warm: bool = False) -> ScenarioResult:
+    """Measure a scenario.
+
+    Args:
+        scenario (Scenario): The scenario.
+        runs (int): Number of measured runs.
+        warm (bool): Keep the caches between runs (after a first run that is not measured), to measure the runs that
+        find the data in the caches, e.g. GitHub answers "not modified". Otherwise, the caches are cleared before each
+        run.
+
+    Returns:
+        ScenarioResult: The measurements.
+    """
+    _clear_caches()
+    run = scenario.setup()
+    if warm:
+        run()
+
+    latencies = []
+    for _ in range(runs):
+        if not warm:
+            _clear_caches()
+        start_time = time.perf_counter()
+        run()
+        latencies.append(time.perf_counter() - start_time)
+
+    # Peak memory in a separate run - tracing the allocations slows down the code
+    if not warm:
+        _clear_caches()
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    p50, p95, p99, p100 = (tracing.percentile(latencies, pct) for pct in (50, 95, 99, 100))
+    return ScenarioResult(
+        name=scenario.name,
+        runs=runs,
+        throughput=scenario.operations * runs / sum(latencies),
+        p50=p50,
+        p95=p95,
+        p99=p99,
+        max=p100,
+        peak_memory_mb=peak / 1_000_000,
+    )
+
+
+def compare(results: list[ScenarioResult], baseline: dict, tolerance: float) -> dict[str, list[str]]:
+    """Compare results with a baseline saved by save_baseline().
+
+    Returns:
+        dict: The regressions of each scenario (slower, less throughput, or more memory than the tolerance allows),
+        e.g. {"parse[1000]": ["p50 +25%"]}. Changes in time under a millisecond are ignored as noise. Scenarios not in
+        the baseline are skipped.
+    """
+    regressions = {}
+    for r in results:
+        base = baseline["results"].get(r.name)
+        if base is None:
+            continue
+        problems = []
+        for name in ("p50", "p95"):
+            if getattr(r, name) - base[name] > _MIN_TIME_CHANGE and _change(getattr(r, name), base[name]) > tolerance:
+                problems.append(f"{name} {_change(getattr(r, name), base[name]):+.0%}")
+        # Less throughput is a regression only if each operation takes noticeably longer
+        if (
+            base["throughput"]
+            and 1 / r.throughput - 1 / base["throughput"] > _MIN_TIME_CHANGE
+            and _change(r.throughput, base["throughput"]) < -tolerance
+        ):
+            problems.append(f"throughput {_change(r.throughput, base['throughput']):+.0%}")
+        if _change(r.peak_memory_mb, base["peak_memory_mb"]) > tolerance:
+            problems.append(f"peak_memory_mb {_change(r.peak_memory_mb, base['peak_memory_mb']):+.0%}")
+        if problems:
+            regressions[r.name] = problems
+    return regressions
+
+
+def _change(value: float, base: float) -> float:
+    """Get the relative change of a value from the baseline (e.g. 0.1 for 10% more)."""
+    return (value - base) / base if base else 0.0
+
+
+def save_baseline(path: str, results: list[ScenarioResult], config: dict):
+    """Save the results as a baseline to compare future runs with."""
+    data = {"config": config, "results": {r.name: dataclasses.asdict(r) for r in results}}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+
+
+def show_results(results: list[ScenarioResult], baseline: dict | None = None):
+    """Show the results as a table, with the changes from the baseline if there is one."""
+    header = ["Scenario", "Ops/sec", "p50", "p95", "p99", "Max", "Peak MB"]
+    if baseline:
+        header += ["vs baseline (p50, ops/sec, memory)"]
+    lines = [header]
+    for r in results:
+        line = [r.name, f"{r.throughput:,.2f}", *(f"{v * 1000:,.1f}ms" for v in (r.p50, r.p95, r.p99, r.max))]
+        line.append(f"{r.peak_memory_mb:,.2f}")
+        base = baseline["results"].get(r.name) if baseline else None
+        if base:
+            changes = (_change(r.p50, base["p50"]), _change(r.throughput, base["throughput"]))
+            changes += (_change(r.peak_memory_mb, base["peak_memory_mb"]),)
+            line.append(", ".join(f"{c:+.0%}" for c in changes))
+        elif baseline:
+            line.append("(new)")
+        lines.append(line)
+    widths = [max(len(line[i]) if i < len(line) else 0 for line in lines) for i in range(len(header))]
+    for line in lines:
+        print("  ".join(value.ljust(width) for value, width in zip(line, widths)).rstrip())
+
+
+def main():
+    """Run the benchmark from the command line."""
+    parser = argparse.ArgumentParser(description="Benchmark the summarization steps against local fake services.")
+    parser.add_argument("--scenarios", nargs="*", help="run only the scenarios that start with these names")
+    parser.add_argument("--iterations", type=int, default=_DEFAULT_ITERATIONS, help="measured runs of each scenario")
+    parser.add_argument("--warm", action="store_true", help="keep the caches between runs")
+    parser.add_argument("--github-latency", type=float, default=0.0, help="seconds added to each GitHub request")
+    parser.add_argument("--openai-latency", type=float, default=0.0, help="seconds added to each OpenAI request")
+    parser.add_argument("--output-tokens", type=int, default=300, help="tokens in each fake OpenAI response")
+    parser.add_argument("--model", help="LLM model (default: the model in llm.ini)")
+    parser.add_argument("--baseline", help="JSON file with the results to compare with")
+    parser.add_argument("--save-baseline", help="JSON file to save the results to, as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=_DEFAULT_TOLERANCE, help="allowed change (0.1 = 10%%)")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    # Resolve the paths before moving to the temporary directory
+    save_path = os.path.abspath(args.save_baseline) if args.save_baseline else None
+    config = {
+        "iterations": args.iterations,
+        "warm": args.warm,
+        "github_latency": args.github_latency,
+        "openai_latency": args.openai_latency,
+        "output_tokens": args.output_tokens,
+    }
+    if baseline and baseline["config"] != config:
+        print(f"Warning: the baseline was measured with different settings: {baseline['config']}")
+
+    _FakeGitHub.latency = args.github_latency
+    _FakeOpenAI.latency = args.openai_latency
+    _FakeOpenAI.output_tokens = args.output_tokens
+    github_server, _FakeGitHub.base_url = _start_server(_FakeGitHub)
+    openai_server, openai_url = _start_server(_FakeOpenAI)
+    os.environ["GITHUB_API_URL"] = _FakeGitHub.base_url
+    os.environ["GITHUB_GRAPHQL_URL"] = f"{_FakeGitHub.base_url}/graphql"
+    os.environ["GITHUB_TOKEN"] = "bench"  # Required by the GraphQL API (the fake doesn't check it)
+    os.environ["OPENAI_BASE_URL"] = f"{openai_url}/v1"
+    os.environ["OPENAI_API_KEY"] = "bench"
+
+    # Use a copy of the settings in a temporary directory, to keep the caches and the history of the real runs
+    original_dir = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix="bench-")
+    if os.path.exists("llm.ini"):
+        shutil.copy("llm.ini", work_dir)
+    os.chdir(work_dir)
+    try:
+        model, prompt = cli.get_model_and_prompt()
+        model = args.model or model
+        results = []
+        for scenario in _scenarios(model, prompt):
+            if args.scenarios and not any(scenario.name.startswith(name) for name in args.scenarios):
+                continue
+            print(f"Running {scenario.name}...", file=sys.stderr)
+            results.append(run_scenario(scenario, args.iterations, args.warm))
+    finally:
+        os.chdir(original_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+        github_server.shutdown()
+        openai_server.shutdown()
+
+    show_results(results, baseline)
+    if save_path:
+        save_baseline(save_path, results, config)
+        print(f"Saved the results to {save_path}")
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for name, problems in regressions.items():
+            print(f"Regression in {name}: {', '.join(problems)}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
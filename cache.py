@@ -0,0 +1,207 @@
+"""Small caches, shared by the modules that need to remember results.
+
+DiskCache remembers results across runs. Each entry is a JSON file named after the hash of its key. The file
+modification time doubles as the last access time, which is all we need for least-recently-used (LRU) eviction. The
+cache is safe to use from multiple threads in the same process. Multiple processes sharing the directory are also safe
+(writes are atomic), but they may evict more or less than the limit while they race.
+
+MemoryCache keeps results in memory, for values that are only useful while the process runs (or can't be stored as
+JSON). It's also safe to use from multiple threads.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+
+@dataclass
+class CacheStats:
+    """Cache hit/miss counters."""
+
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """Calculate the fraction of lookups that were hits."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class DiskCache:
+    """A key-value cache stored in a directory, with a maximum number of entries and an optional time to live.
+
+    Values must be JSON-serializable.
+    """
+
+    def __init__(self, directory: str, max_entries: int = 1000, ttl: float | None = None):
+        """Create the cache.
+
+        Args:
+            directory (str): Directory to store the entries. It is created if it doesn't exist.
+            max_entries (int): Maximum number of entries. The least recently used entries are evicted first.
+            ttl (float): Time to live in seconds, counted from when the entry was stored. None means no expiration.
+        """
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        """Get the path of the file that holds the entry for a key."""
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def _count(self, hit: bool):
+        """Update the hit/miss counters."""
+        with self._lock:
+            if hit:
+                self.stats.hits += 1
+            else:
+                self.stats.misses += 1
+
+    def get(self, key: str) -> Any:
+        """Get the value for a key, or None if the key is not in the cache (or the entry expired)."""
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            # Not in the cache, or a corrupted entry (e.g. the disk filled up) - both are misses
+            self._count(hit=False)
+            return None
+
+        if entry.get("key") != key or (self.ttl is not None and time.time() - entry["stored_at"] > self.ttl):
+            self.delete(key)
+            self._count(hit=False)
+            return None
+
+        # Mark as recently used for the LRU eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self._count(hit=True)
+        return entry["value"]
+
+    def put(self, key: str, value: Any):
+        """Store the value for a key, replacing the previous value, if any."""
+        os.makedirs(self.directory, exist_ok=True)
+        entry = {"key": key, "stored_at": time.time(), "value": value}
+
+        # Write to a temporary file and rename it to avoid leaving partial entries behind
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        self._evict()
+
+    def delete(self, key: str):
+        """Remove the entry for a key, if it exists."""
+        try:
+            os.unlink(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        """Remove all entries."""
+        for path in self._entry_paths():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def __len__(self) -> int:
+        return len(self._entry_paths())
+
+    def _entry_paths(self) -> list[str]:
+        """Get the paths of all entries in the cache."""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return [os.path.join(self.directory, name) for name in names if name.endswith(".json")]
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache is within the size limit."""
+        paths = self._entry_paths()
+        excess = len(paths) - self.max_entries
+        if excess <= 0:
+            return
+
+        def mtime(path: str) -> float:
+            try:
+                return os.path.getmtime(path)
+            except OSError:
+                return 0.0
+
+        for path in sorted(paths, key=mtime)[:excess]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+class MemoryCache:
+    """An in-memory key-value cache, with a maximum number of entries and an optional time to live."""
+
+    def __init__(self, max_entries: int = 1000, ttl: float | None = None):
+        """Create the cache.
+
+        Args:
+            max_entries (int): Maximum number of entries. The least recently used entries are evicted first.
+            ttl (float): Time to live in seconds, counted from when the entry was stored. None means no expiration.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: str) -> Any:
+        """Get the value for a key, or None if the key is not in the cache (or the entry expired)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)  # Mark as recently used for the LRU eviction
+            self.stats.hits += 1
+            return entry[1]
+
+    def put(self, key: str, value: Any):
+        """Store the value for a key, replacing the previous value, if any."""
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str):
+        """Remove the entry for a key, if it exists."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
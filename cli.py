@@ -14,7 +14,7 @@ Some test data to use:
      - https://github.com/scikit-learn/scikit-learn
      - 27435
 
-    Large issue - needs GPT-4's large context window
+    Large issue - needs GPT-4o's large context window or summarizing in chunks
      - https://github.com/scikit-learn/scikit-learn/issues/9354
 
     This one has several comments. The large list of comments seems to cause the LLM to stop summarizing
@@ -24,9 +24,13 @@ Some test data to use:
     - https://github.com/qjebbs/vscode-plantuml/issues/255
 """
 
-import configparser
+import compaction
 import github
+import history
 import llm
+import settings
+import summarize
+import tracing
 
 
 def get_option():
@@ -36,6 +40,8 @@ def get_option():
     print("2. Show the raw GitHub issue data")
     print("3. Show the parsed GitHub issue data")
     print("4. Get and show the LLM response")
+    print("5. Update the previous LLM response with new comments (or get a new one)")
+    print("6. Show performance metrics (Prometheus format)")
     print("9. Exit")
     choice = input("Enter your choice: ")
     return choice
@@ -48,32 +54,58 @@ def get_github_data(repository, issue_number):
     return issue, comments
 
 
-def get_llm_answer(parsed_issue, parsed_comments):
+def get_llm_answer(issue, comments, parsed_issue, parsed_comments):
     """Get the LLM answer."""
     # Always read the config file to allow for changes without restarting the CLI
     model, prompt = get_model_and_prompt()
-    print(f"Using model: {model}")
     user_input = f"{parsed_issue}\n{parsed_comments}"
-    response = llm.chat_completion(model, prompt, user_input)
+    model, routing_reason = summarize.choose_model(model, prompt, user_input)
+    print(f"Using model: {model}" + (f" (chosen automatically: {routing_reason})" if routing_reason else ""))
+    if not summarize.fits_context(model, prompt, user_input):
+        print("The issue is too large for the model's context window - summarizing it in chunks")
+    # Stream the response to show it as it's generated - the LLM may take several seconds to complete it
+    response = summarize.summarize_issue_stream(model, prompt, issue, comments, user_input)
     return response
 
 
+def get_llm_update(issue):
+    """Get the LLM answer by updating the previous answer with the comments added since then."""
+    model, prompt = get_model_and_prompt()
+    print(f"Using model: {model}")
+    comments, previous = summarize.get_new_comments(model, prompt, issue)
+    if previous:
+        print(f"Updating the previous summary with {len(comments)} new or edited comments")
+    issue, comments, _ = compaction.compact(issue, comments, compaction.load_config())
+    response = summarize.summarize_issue_incremental(model, prompt, issue, comments, previous)
+    # Show it the same way as a streamed response
+    return llm.StreamedCompletion(response, iter([response.llm_response]))
+
+
 def show_llm_response(response):
-    """Show the LLM response and other data."""
-    r = response  # Shorter name for convenience
-    print(f"LLM Response:\n{r.llm_response}")
+    """Show the LLM response as it's generated, then the other data."""
+    print("LLM Response:")
+    with tracing.span("render"):
+        for token in response:
+            print(token, end="", flush=True)
+        print()
+
+    r = response.response  # Shorter name for convenience, now that the stream is complete
     print("-------------------------------")
     print(f"Model: {r.model}")
+    if r.routing_reason:
+        print(f"Chosen automatically: {r.routing_reason}")
+    if r.cached:
+        print(f"Served from cache - saved US ${r.cost_saved:.2f}")
     print(f"Input tokens: {r.input_tokens}, output tokens: {r.output_tokens} - cost: US ${r.cost:.2f}")
     tokens_sec = (r.input_tokens + r.output_tokens) / r.elapsed_time
     print(f"Elapsed time: {r.elapsed_time:.2f} seconds ({tokens_sec:.1f} tokens/sec)")
+    print(f"Time to first token: {r.time_to_first_token:.2f} seconds")
 
 
 def get_model_and_prompt():
     """Get the model and prompt from the config file."""
-    # Always read the config file to allow for changes without restarting the CLI
-    config = configparser.ConfigParser()
-    config.read("llm.ini")
+    # Get the config file from the settings module, which reads it again when it changes (no need to restart the CLI)
+    config = settings.read_config()
     model = config["LLM"]["model"]
     prompt = config["LLM"]["prompt"]
     return model, prompt
@@ -84,6 +116,7 @@ def main():
     repository = ""
     issue_number = 0
     issue, comments, parsed_issue, parsed_comments = None, None, None, None
+    compact_issue, compact_comments = None, None
 
     while True:
         try:
@@ -97,14 +130,18 @@ def main():
                 if not issue:
                     print("GitHub returned and empty issue")
                     continue
-                parsed_issue = github.parse_issue(issue)
-                parsed_comments = github.parse_comments(comments)
-                print("Done")
+                # Keep the original data to show it, compact a copy to send to the LLM
+                compact_issue, compact_comments, report = compaction.compact(issue, comments, compaction.load_config())
+                print(f"Compaction: {report}")
+                parsed_issue = github.parse_issue(compact_issue)
+                parsed_comments = github.parse_comments(compact_comments)
+                stats = github.cache_stats()
+                print(f"Done (GitHub cache: {stats.hits} hits, {stats.misses} misses)")
                 continue
 
             # Don't run options that require GitHub data if we don't have it
             # Note that we check only the issue because not having comments is not an error
-            if choice in ("2", "3", "4") and not issue:
+            if choice in ("2", "3", "4", "5") and not issue:
                 print("Retrieve the GitHub issue data first")
                 continue
 
@@ -120,8 +157,16 @@ def main():
                 print(f"Comments:\n{parsed_comments}")
             elif choice == "4":
                 print("Getting response from LLM (may take a few seconds)...")
-                response = get_llm_answer(parsed_issue, parsed_comments)
-                show_llm_response(response)
+                with history.issue_context(issue["html_url"]):
+                    response = get_llm_answer(compact_issue, compact_comments, parsed_issue, parsed_comments)
+                    show_llm_response(response)
+            elif choice == "5":
+                print("Getting response from LLM (may take a few seconds)...")
+                with history.issue_context(issue["html_url"]):
+                    response = get_llm_update(issue)
+                    show_llm_response(response)
+            elif choice == "6":
+                print(tracing.export_prometheus())
             elif choice == "9":
                 print("Exiting...")
                 break
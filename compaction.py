@@ -0,0 +1,302 @@
+"""Remove text from issues and comments that costs tokens without helping the LLM summarize them.
+
+Issues and comments have a lot of text that doesn't add information for a summary: quoted replies (the text is already
+in an earlier comment), issue template instructions, long logs and stack traces, comments from bots, "+1" comments,
+and repeated text. This module removes or shortens that text before we parse the issue and comments.
+
+Each rule can be turned on and off in the [Compaction] section of llm.ini. The compaction report shows how many tokens
+each rule saved, to help decide which rules are worth it for a given set of issues.
+
+The rules work on copies of the GitHub data, so the original data is still available (e.g. to show it to the user).
+"""
+
+import re
+from dataclasses import dataclass, field
+
+import github
+import llm
+import settings
+import tracing
+
+# Issue templates add instructions in HTML comments - they are not shown on GitHub, but are in the API response
+_HTML_COMMENT = re.compile(r"<!--.*?-->", re.DOTALL)
+# Issue forms add "_No response_" to optional fields that were left empty
+_EMPTY_FORM_FIELD = re.compile(r"^#{1,6} [^\n]*\n+_No response_\s*$", re.MULTILINE)
+# Replies by email start with "On <date>, <person> wrote:" before the quoted text
+_EMAIL_REPLY_HEADER = re.compile(r"^On .+ wrote:\s*$")
+# Markdown quotes: ">" followed by a space or the end of the line ("> > " when nested), but not the ">>>" prompt of
+# Python sessions (reproduction code)
+_QUOTED_LINE = re.compile(r"^\s*(?!>>>)>+(\s|$)")
+_PLUS_ONE = re.compile(r"^(\+1|:\+1:|👍|same here|same issue|same problem|me too|any updates?)[\s.!?]*$", re.IGNORECASE)
+_FENCE = re.compile(r"^\s*(```|~~~)")
+_TRACEBACK_START = "Traceback (most recent call last):"
+
+
+@dataclass
+class CompactionConfig:
+    """The compaction rules to apply. All rules are off by default."""
+
+    strip_quoted_replies: bool = False
+    remove_template_boilerplate: bool = False
+    collapse_long_blocks: bool = False
+    fold_bot_and_plus_one_comments: bool = False
+    deduplicate: bool = False
+    # Code blocks and tracebacks longer than this are collapsed to their first and last lines
+    max_block_lines: int = 30
+    # Number of lines to keep at the start and at the end of a collapsed block
+    keep_block_lines: int = 8
+
+
+@dataclass
+class CompactionReport:
+    """Number of tokens (estimated) before and after compaction, and how many tokens each rule saved."""
+
+    tokens_before: int = 0
+    tokens_after: int = 0
+    tokens_saved_by_rule: dict[str, int] = field(default_factory=dict)
+
+    @property
+    def tokens_saved(self) -> int:
+        """Calculate the total number of tokens saved."""
+        return self.tokens_before - self.tokens_after
+
+    def __str__(self) -> str:
+        # A rule can add tokens (e.g. a note longer than the text it replaces) - show it as a negative saving
+        rules = ", ".join(f"{rule} {-tokens:+,}" for rule, tokens in self.tokens_saved_by_rule.items())
+        return f"{self.tokens_before:,} -> {self.tokens_after:,} tokens ({rules or 'no rules enabled'})"
+
+
+def load_config(path: str = "llm.ini") -> CompactionConfig:
+    """Read the compaction rules from the [Compaction] section of the .ini file."""
+    config = settings.read_config(path)
+    if "Compaction" not in config:
+        return CompactionConfig()
+
+    section = config["Compaction"]
+    defaults = CompactionConfig()
+    return CompactionConfig(
+        strip_quoted_replies=section.getboolean("strip_quoted_replies", defaults.strip_quoted_replies),
+        remove_template_boilerplate=section.getboolean(
+            "remove_template_boilerplate", defaults.remove_template_boilerplate
+        ),
+        collapse_long_blocks=section.getboolean("collapse_long_blocks", defaults.collapse_long_blocks),
+        fold_bot_and_plus_one_comments=section.getboolean(
+            "fold_bot_and_plus_one_comments", defaults.fold_bot_and_plus_one_comments
+        ),
+        deduplicate=section.getboolean("deduplicate", defaults.deduplicate),
+        max_block_lines=section.getint("max_block_lines", defaults.max_block_lines),
+        keep_block_lines=section.getint("keep_block_lines", defaults.keep_block_lines),
+    )
+
+
+def _split_code_blocks(text: str) -> list[tuple[bool, list[str]]]:
+    """Split markdown text into segments of lines, flagging the segments that are fenced code blocks.
+
+    The fences are part of the code block segments. An unterminated code block extends to the end of the text.
+    """
+    segments = []
+    lines, in_code = [], False
+    for line in text.split("\n"):
+        if _FENCE.match(line):
+            if in_code:
+                lines.append(line)
+                segments.append((True, lines))
+                lines, in_code = [], False
+                continue
+            if lines:
+                segments.append((False, lines))
+            lines, in_code = [], True
+        lines.append(line)
+    if lines:
+        segments.append((in_code, lines))
+    return segments
+
+
+def _join_code_blocks(segments: list[tuple[bool, list[str]]]) -> str:
+    """Join segments created by _split_code_blocks() back into text."""
+    return "\n".join("\n".join(lines) for _, lines in segments)
+
+
+def _collapse_lines(lines: list[str], config: CompactionConfig) -> list[str]:
+    """Keep only the first and last lines of a long block."""
+    if len(lines) <= config.max_block_lines or len(lines) <= 2 * config.keep_block_lines:
+        return lines
+    omitted = len(lines) - 2 * config.keep_block_lines
+    return [
+        *lines[: config.keep_block_lines],
+        f"[... {omitted} lines omitted ...]",
+        *lines[-config.keep_block_lines :],
+    ]
+
+
+def _strip_quoted_replies(text: str, _: CompactionConfig) -> str:
+    """Remove quoted text ("> " lines) and the "On <date>, <person> wrote:" lines of email replies."""
+    segments = []
+    for is_code, lines in _split_code_blocks(text):
+        if not is_code:
+            lines = [line for line in lines if not _QUOTED_LINE.match(line)]
+            lines = [line for line in lines if not _EMAIL_REPLY_HEADER.match(line)]
+        segments.append((is_code, lines))
+    return _join_code_blocks(segments)
+
+
+def _remove_template_boilerplate(text: str, _: CompactionConfig) -> str:
+    """Remove issue template instructions (HTML comments) and empty issue form fields."""
+    text = _HTML_COMMENT.sub("", text)
+    text = _EMPTY_FORM_FIELD.sub("", text)
+    # Removing the text above leaves many blank lines behind
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
+
+
+def _collapse_long_blocks(text: str, config: CompactionConfig) -> str:
+    """Collapse long code blocks and tracebacks to their first and last lines."""
+    segments = []
+    for is_code, lines in _split_code_blocks(text):
+        if is_code:
+            # Keep the fences - the LLM needs to know where the code starts and ends
+            lines = [lines[0], *_collapse_lines(lines[1:-1], config), lines[-1]] if len(lines) > 2 else lines
+        else:
+            lines = _collapse_tracebacks(lines, config)
+        segments.append((is_code, lines))
+    return _join_code_blocks(segments)
+
+
+def _collapse_tracebacks(lines: list[str], config: CompactionConfig) -> list[str]:
+    """Collapse Python tracebacks that are not in code blocks.
+
+    A traceback starts with "Traceback (most recent call last):", followed by indented lines, and ends with the
+    (not indented) exception line.
+    """
+    result = []
+    i = 0
+    while i < len(lines):
+        if lines[i].strip() != _TRACEBACK_START:
+            result.append(lines[i])
+            i += 1
+            continue
+        end = i + 1
+        while end < len(lines) and lines[end].startswith((" ", "\t")):
+            end += 1
+        end = min(end + 1, len(lines))  # Include the exception line
+        result.extend(_collapse_lines(lines[i:end], config))
+        i = end
+    return result
+
+
+def _deduplicate_lines(text: str, _: CompactionConfig) -> str:
+    """Replace lines repeated one after the other (e.g. in logs) with one line and a repetition count."""
+    result = []
+    previous, repeats = None, 0
+    for line in [*text.split("\n"), None]:  # None flushes the last repetition
+        if line == previous and line.strip():
+            repeats += 1
+            continue
+        if repeats:
+            note = f"[previous line repeated {repeats} more times]"
+            # Short lines are cheaper than the note (each repeat also has its newline)
+            result.extend([note] if len(note) < repeats * (len(previous) + 1) else [previous] * repeats)
+        if line is not None:
+            result.append(line)
+        previous, repeats = line, 0
+    return "\n".join(result)
+
+
+def _apply_to_bodies(issue: dict, comments: list, rule, config: CompactionConfig) -> tuple[dict, list]:
+    """Apply a rule to the body of the issue and of each comment."""
+    issue = {**issue, "body": rule(issue["body"] or "", config)}
+    comments = [{**comment, "body": rule(comment["body"] or "", config)} for comment in comments]
+    return issue, comments
+
+
+def _is_bot(comment: dict) -> bool:
+    """Check if a comment was created by a bot."""
+    user = comment.get("user") or {}
+    return user.get("type") == "Bot" or user.get("login", "").endswith("[bot]")
+
+
+def _fold_bot_and_plus_one_comments(comments: list) -> list:
+    """Remove comments from bots and fold "+1"-style comments into the first one."""
+    result = []
+    first_plus_one, others = None, []
+    for comment in comments:
+        if _is_bot(comment):
+            continue
+        if _PLUS_ONE.match((comment["body"] or "").strip()):
+            if first_plus_one is None:
+                first_plus_one = len(result)
+                result.append(comment)
+            else:
+                others.append(comment["user"]["login"])
+            continue
+        result.append(comment)
+
+    if others:
+        comment = result[first_plus_one]
+        result[first_plus_one] = {**comment, "body": f"{comment['body']} (also from: {', '.join(others)})"}
+    return result
+
+
+def _deduplicate_comments(comments: list) -> list:
+    """Replace the body of comments that repeat an earlier comment with a reference to it."""
+    result = []
+    seen = {}
+    for comment in comments:
+        body = (comment["body"] or "").strip()
+        if body in seen:
+            earlier = seen[body]
+            note = f"[same text as the comment by {earlier['user']['login']} on {earlier['created_at']}]"
+            if len(note) < len(body):  # Short comments are cheaper than the note
+                comment = {**comment, "body": note}
+        elif body:
+            seen[body] = comment
+        result.append(comment)
+    return result
+
+
+def _count_tokens(issue: dict, comments: list) -> int:
+    """Estimate the number of tokens in the parsed issue and comments."""
+    with tracing.suppress():
+        # Add up the lengths of the parts instead of building the whole text - this runs after every rule
+        length = len(github.parse_issue(issue)) + sum(len(text) for text in github.iter_parsed_comments(comments))
+        return llm.estimate_tokens_for_length(length)
+
+
+def compact(issue: dict, comments: list, config: CompactionConfig) -> tuple[dict, list, CompactionReport]:
+    """Apply the compaction rules to an issue and its comments.
+
+    Args:
+        issue (dict): Issue data, as returned by GitHub (the JSON response).
+        comments (list): Comments data, as returned by GitHub (the JSON response).
+        config (CompactionConfig): The rules to apply.
+
+    Returns:
+        tuple: The compacted issue, the compacted comments, and the compaction report. The original data is not
+        changed.
+    """
+    # Each rule has a function for the body text and/or a function for the list of comments
+    # Rules are applied in this order - rules that remove text run before the rule that looks for repetitions
+    rules = [
+        ("quoted replies", config.strip_quoted_replies, _strip_quoted_replies, None),
+        ("template", config.remove_template_boilerplate, _remove_template_boilerplate, None),
+        ("bots and +1", config.fold_bot_and_plus_one_comments, None, _fold_bot_and_plus_one_comments),
+        ("long blocks", config.collapse_long_blocks, _collapse_long_blocks, None),
+        ("duplicates", config.deduplicate, _deduplicate_lines, _deduplicate_comments),
+    ]
+
+    with tracing.span("compact") as attributes:
+        report = CompactionReport()
+        tokens = report.tokens_before = _count_tokens(issue, comments)
+        for name, enabled, text_rule, comments_rule in rules:
+            if not enabled:
+                continue
+            if comments_rule:
+                comments = comments_rule(comments)
+            if text_rule:
+                issue, comments = _apply_to_bodies(issue, comments, text_rule, config)
+            tokens_after_rule = _count_tokens(issue, comments)
+            report.tokens_saved_by_rule[name] = tokens - tokens_after_rule
+            tokens = tokens_after_rule
+        report.tokens_after = tokens
+        attributes["tokens_saved"] = report.tokens_saved
+    tracing.count("compaction_saved_tokens_total", report.tokens_saved)
+    return issue, comments, report
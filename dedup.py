@@ -0,0 +1,130 @@
+"""Find near-duplicate issues, to summarize one issue of each group instead of all of them (see batch.py --dedup).
+
+Repositories get the same problem reported many times (e.g. the same crash, with a different version or path in the
+traceback). Comparing every issue with every other one takes quadratic time, so we compare signatures instead:
+
+- Each issue text gets a SimHash signature: a 64-bit number where similar texts differ in few bits. It's computed from
+  the hashes of overlapping word sequences (shingles) - each bit is set if most shingle hashes have it set.
+- Texts are near-duplicates if their signatures differ in at most `max_distance` bits. Splitting the signatures into
+  `max_distance + 1` bands, near-duplicates must have at least one identical band (the differing bits can't be in all
+  bands). Indexing the signatures by band (locality-sensitive hashing) finds the candidates in expected linear time -
+  only the signatures in the same bucket are compared.
+- The pairs of near-duplicates are merged into groups with a union-find structure, so that A, B, and C are one group
+  when A is similar to B and B to C.
+
+Numbers in the body are ignored: line numbers, versions, memory addresses, and dates change between reports of the same
+problem. Numbers in the title are not - "Drop support for Python 3.8" and "Drop support for Python 3.9" are different
+issues with almost the same text, so texts are near-duplicates only if their titles have the same numbers. Short texts
+(e.g. only a title) are never near-duplicates: a few shared words don't show that two issues are about the same problem.
+"""
+
+import hashlib
+import re
+from collections import Counter
+from collections.abc import Mapping
+
+import tracing
+
+_SIGNATURE_BITS = 64
+# Words in each shingle - sequences keep some of the word order, to tell apart texts with the same words
+_SHINGLE_WORDS = 3
+# Maximum number of different bits for near-duplicates - about 95% of the signature is the same
+_MAX_DISTANCE = 3
+# Texts with fewer shingles than this are too short to compare (see the module docstring)
+_MIN_SHINGLES = 20
+# Words: letters only (see the module docstring about numbers)
+_WORD = re.compile(r"[^\W\d_]+")
+_NUMBER = re.compile(r"\d+")
+
+
+def _shingles(text: str) -> Counter:
+    """Count the shingles (sequences of _SHINGLE_WORDS words) of a text."""
+    words = _WORD.findall(text.lower())
+    return Counter(" ".join(words[i : i + _SHINGLE_WORDS]) for i in range(max(1, len(words) - _SHINGLE_WORDS + 1)))
+
+
+def simhash(text: str | Counter) -> int:
+    """Calculate the SimHash signature of a text, or of the shingles of a text (see the module docstring)."""
+    shingles = _shingles(text) if isinstance(text, str) else text
+    weights = [0] * _SIGNATURE_BITS
+    for shingle, count in shingles.items():
+        # A stable hash - Python's hash() of strings changes in each run
+        digest = hashlib.blake2b(shingle.encode("utf-8"), digest_size=_SIGNATURE_BITS // 8).digest()
+        bits = int.from_bytes(digest, "big")
+        for bit in range(_SIGNATURE_BITS):
+            weights[bit] += count if bits >> bit & 1 else -count
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """Count the bits that are different in two signatures."""
+    return (a ^ b).bit_count()
+
+
+class _UnionFind:
+    """Groups of items that grow by merging pairs. The root of each group is its first item (the lowest index)."""
+
+    def __init__(self, size: int):
+        self._parent = list(range(size))
+
+    def find(self, item: int) -> int:
+        """Get the root of an item's group."""
+        while self._parent[item] != item:
+            self._parent[item] = self._parent[self._parent[item]]  # Shorten the path for the next calls
+            item = self._parent[item]
+        return item
+
+    def union(self, a: int, b: int):
+        """Merge the groups of two items."""
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self._parent[max(a, b)] = min(a, b)
+
+
+def find_duplicates(texts: Mapping[str, str], max_distance: int = _MAX_DISTANCE) -> dict[str, str]:
+    """Find the near-duplicates in a set of texts.
+
+    Args:
+        texts (Mapping[str, str]): The texts, by key (e.g. the issues by URL). The first line of each text is its title.
+        max_distance (int): Maximum number of different bits in the signatures of near-duplicates (0 to 63).
+
+    Returns:
+        dict[str, str]: The key of the representative of each near-duplicate text, by the text's key. The representative
+        is the first text of the group, in the order of `texts` - it's not in the result.
+    """
+    with tracing.span("find_duplicates", texts=len(texts)) as attributes:
+        keys = []
+        signatures = []
+        title_numbers = []
+        for key, text in texts.items():
+            shingles = _shingles(text)
+            if sum(shingles.values()) >= _MIN_SHINGLES:
+                keys.append(key)
+                signatures.append(simhash(shingles))
+                title_numbers.append(tuple(_NUMBER.findall(text.partition("\n")[0])))
+        groups = _UnionFind(len(keys))
+
+        # Identical signatures are merged right away, so that a large group doesn't fill the buckets
+        first_with_signature = {}
+        for index, signature in enumerate(signatures):
+            groups.union(first_with_signature.setdefault((signature, title_numbers[index]), index), index)
+
+        bands = max_distance + 1
+        band_bits = _SIGNATURE_BITS // bands
+        buckets = {}
+        for (signature, numbers), index in first_with_signature.items():
+            for band in range(bands):
+                # The last band takes the remaining bits
+                bits = _SIGNATURE_BITS - band * band_bits if band == bands - 1 else band_bits
+                value = signature >> (band * band_bits) & ((1 << bits) - 1)
+                # Only texts with the same numbers in the title can be near-duplicates
+                bucket = buckets.setdefault((band, value, numbers), [])
+                for other in bucket:
+                    if hamming_distance(signature, signatures[other]) <= max_distance:
+                        groups.union(index, other)
+                bucket.append(index)
+
+        duplicates = {key: keys[groups.find(index)] for index, key in enumerate(keys) if groups.find(index) != index}
+        attributes["duplicates"] = len(duplicates)
+    tracing.count("dedup_duplicates_total", len(duplicates))
+    return duplicates
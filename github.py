@@ -1,5 +1,278 @@
 """Interface to GitHub."""
+import dataclasses
+import math
+import os
+import random
+import re
+import threading
+import time
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from urllib.parse import parse_qs, urlparse
+
 import requests
+from requests.adapters import HTTPAdapter
+
+import llm
+import settings
+import tracing
+from cache import CacheStats, DiskCache
+
+# GitHub returns at most 100 items per page
+_COMMENTS_PER_PAGE = 100
+# Maximum number of comment pages fetched in parallel - keep it small to be a good citizen of the GitHub API
+_MAX_PAGE_WORKERS = 4
+
+# Cache of GitHub responses, used to make conditional requests (see _get_json_and_links())
+_CACHE_DIR = os.path.join(".cache", "github")
+_CACHE_MAX_ENTRIES = 2000
+_http_cache = DiskCache(_CACHE_DIR, max_entries=_CACHE_MAX_ENTRIES)
+# Hits are responses GitHub confirmed we already have (HTTP 304), misses are full downloads
+_cache_stats = CacheStats()
+_cache_stats_lock = threading.Lock()
+
+# Rate limits - see _RateLimiter and _send_request()
+# Pace the requests when the remaining quota falls below this fraction of the limit
+_PACING_THRESHOLD = 0.2
+# Maximum time to wait for the rate limit (seconds) - fail instead of waiting longer (the quota resets every hour)
+_MAX_WAIT = 5 * 60
+# Retries after hitting a secondary rate limit, with exponential backoff (seconds)
+# GitHub recommends waiting at least one minute before retrying
+_MAX_RETRIES = 3
+_BASE_BACKOFF = 60
+_MAX_BACKOFF = _MAX_WAIT
+
+
+def _create_session() -> requests.Session:
+    """Create the HTTP session shared by all requests to reuse connections (and their TLS handshakes)."""
+    session = requests.Session()
+    # Size the pool to keep one connection per parallel page request
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=_MAX_PAGE_WORKERS * 2)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Accept"] = "application/vnd.github+json"
+    return session
+
+
+_session = _create_session()
+
+
+def _get_github_token() -> str:
+    """Get the GitHub token from the environment or the .env file, or an empty string if it's not set."""
+    # Reload the .env file if it changed, to allow changes without restarting the program
+    settings.load_env()
+    return os.getenv("GITHUB_TOKEN", "")
+
+
+@dataclass
+class RateLimitState:
+    """The GitHub rate limit quota, as reported in the headers of the last response.
+
+    GitHub has separate quotas for the REST API ("core" resource) and the GraphQL API ("graphql" resource).
+    See https://docs.github.com/en/rest/using-the-rest-api/rate-limits-for-the-rest-api
+    """
+
+    resource: str = ""
+    limit: int = 0  # Requests (or GraphQL points) per hour - 0 if we didn't get a response yet
+    remaining: int = 0
+    reset_time: float = 0.0  # When the quota is reset, in seconds since the epoch
+    retries: int = 0  # Requests retried after hitting a rate limit
+
+    @property
+    def known(self) -> bool:
+        """Check if we got the quota from GitHub (we didn't if we didn't make a request yet)."""
+        return self.limit > 0
+
+    @property
+    def seconds_until_reset(self) -> float:
+        """Calculate the number of seconds until the quota is reset."""
+        return max(0.0, self.reset_time - time.time())
+
+
+class _RateLimiter:
+    """Schedule the requests to one GitHub resource to stay within its rate limit.
+
+    All threads share the same quota, so they share the same rate limiter. Before a request, a thread calls `wait()`
+    to get a time slot (and sleeps until then). After the request, it calls `finish()`, and `update()` with the
+    response headers.
+
+    The remaining quota is the one GitHub reported minus the requests still in flight (they will use it, but GitHub
+    didn't count them yet). Requests that GitHub doesn't count (e.g. "not modified" answers to conditional requests)
+    give their reservation back when the next response reports the quota.
+
+    Requests are sent as soon as possible while the quota is plentiful. When the remaining quota falls below
+    _PACING_THRESHOLD of the limit, requests are spaced evenly so that the quota lasts until it's reset, instead of
+    using it up and failing all requests until the reset time.
+    """
+
+    def __init__(self, resource: str):
+        self._lock = threading.Lock()
+        self._state = RateLimitState(resource)
+        self._next_request_time = 0.0
+        # Requests sent (or waiting for their time slot) without a response yet
+        self._in_flight = 0
+        # Time until which all requests are paused, after GitHub asked us to slow down
+        self._paused_until = 0.0
+
+    def wait(self):
+        """Wait for the next time slot to send a request."""
+        with self._lock:
+            now = time.time()
+            state = self._state
+            if state.known and now >= state.reset_time:
+                state.remaining = state.limit - self._in_flight  # The quota was reset since the last response
+
+            start = max(now, self._next_request_time, self._paused_until)
+            interval = 0.0
+            if state.known and state.remaining <= 0:
+                start = max(start, state.reset_time)
+            elif state.known and state.remaining < state.limit * _PACING_THRESHOLD:
+                interval = state.seconds_until_reset / state.remaining
+
+            delay = start - now
+            if delay > _MAX_WAIT:
+                raise RuntimeError(
+                    f"GitHub rate limit exceeded -- resets in {delay / 60:.0f} minutes. "
+                    "Set GITHUB_TOKEN to get a higher limit (see README.md)."
+                )
+            self._next_request_time = start + interval
+            # Reserve the request, so that other threads see the quota it will use before its response arrives
+            state.remaining = max(0, state.remaining - 1)
+            self._in_flight += 1
+
+        if delay > 0:
+            with tracing.span("github_rate_limit_wait", resource=self._state.resource):
+                time.sleep(delay)
+
+    def update(self, headers):
+        """Update the quota from the headers of a response."""
+        try:
+            limit = int(headers["X-RateLimit-Limit"])
+            remaining = int(headers["X-RateLimit-Remaining"])
+            reset_time = float(headers["X-RateLimit-Reset"])
+        except (KeyError, ValueError):
+            return  # Not all responses have the headers (e.g. errors from a proxy)
+
+        with self._lock:
+            state = self._state
+            # Ignore the quota of a response from a previous period (responses may arrive out of order)
+            if reset_time >= state.reset_time:
+                state.remaining = max(0, remaining - self._in_flight)
+            state.limit = limit
+            state.reset_time = max(state.reset_time, reset_time)
+
+    def finish(self):
+        """Record the end of a request started with `wait()`, whether it succeeded or not."""
+        with self._lock:
+            self._in_flight = max(0, self._in_flight - 1)
+
+    def pause(self, seconds: float):
+        """Pause all requests for some time, e.g. after hitting a secondary rate limit."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.time() + seconds)
+            self._state.retries += 1
+
+    def state(self) -> RateLimitState:
+        """Get a copy of the quota state."""
+        with self._lock:
+            return dataclasses.replace(self._state)
+
+
+_rate_limiters = {resource: _RateLimiter(resource) for resource in ("core", "graphql")}
+
+
+def _retry_delay(response: requests.Response, attempt: int) -> float | None:
+    """Get how long to wait before retrying a request that hit a rate limit, or None if it shouldn't be retried.
+
+    Follows GitHub's recommendations: wait for the time in the Retry-After header if there is one. Otherwise, if the
+    quota is used up, wait until it's reset. Otherwise, it's a secondary rate limit (too many requests in a short
+    time) - wait with exponential backoff, with jitter so that the threads don't retry all at the same time.
+    """
+    if response.status_code not in (403, 429):
+        return None
+    if "Retry-After" in response.headers:
+        try:
+            return float(response.headers["Retry-After"])
+        except ValueError:
+            pass  # It may be an HTTP date instead of seconds - use the backoff below
+    if response.headers.get("X-RateLimit-Remaining") == "0":
+        return max(0.0, float(response.headers.get("X-RateLimit-Reset", 0)) - time.time()) + 1
+    if response.status_code == 403 and "rate limit" not in response.text.lower():
+        return None  # A permission error, not a rate limit
+    backoff = min(_MAX_BACKOFF, _BASE_BACKOFF * 2**attempt)
+    # The jitter must not push the delay past _MAX_WAIT - the request wouldn't be retried
+    return min(_MAX_WAIT, backoff + random.uniform(0, backoff / 2))
+
+
+def _send_request(method: str, url: str, resource: str = "core", **kwargs) -> requests.Response:
+    """Send a request to GitHub, within the rate limit of the resource, retrying if we hit a rate limit.
+
+    Authenticates with GITHUB_TOKEN if it's set, for a higher rate limit (5,000 instead of 60 requests per hour).
+
+    Args:
+        method (str): HTTP method, e.g. "GET".
+        url (str): Full GitHub API URL.
+        resource (str): The rate limit resource the URL uses ("core" for the REST API, "graphql" for GraphQL).
+        kwargs: Other arguments for requests.Session.request(), e.g. "headers".
+
+    Returns:
+        requests.Response: The response. The caller checks the status code.
+    """
+    rate_limiter = _rate_limiters[resource]
+    headers = kwargs.pop("headers", {})
+    token = _get_github_token()
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+
+    for attempt in range(_MAX_RETRIES + 1):
+        rate_limiter.wait()
+        try:
+            response = _session.request(method, url, headers=headers, timeout=10, **kwargs)
+        finally:
+            rate_limiter.finish()
+        rate_limiter.update(response.headers)
+        delay = _retry_delay(response, attempt)
+        if delay is None or attempt == _MAX_RETRIES or delay > _MAX_WAIT:
+            return response
+        tracing.count("github_retries_total", resource=resource, status=response.status_code)
+        rate_limiter.pause(delay)
+    return response  # Not reached, but makes the type checker happy
+
+
+def rate_limit_state(resource: str = "core", refresh: bool = False) -> RateLimitState:
+    """Get the GitHub rate limit quota, e.g. to check if a batch of requests fits in the remaining quota.
+
+    Args:
+        resource (str): "core" for the REST API, "graphql" for the GraphQL API.
+        refresh (bool): Get the current quota from GitHub. Otherwise, return the quota from the last response, which
+        is not known (`known` is False) before the first request. Checking the quota doesn't use it.
+
+    Returns:
+        RateLimitState: A copy of the quota state.
+    """
+    if refresh:
+        response = _session.get(
+            f"{_get_api_base_url()}/rate_limit",
+            headers={"Authorization": f"Bearer {token}"} if (token := _get_github_token()) else {},
+            timeout=10,
+        )
+        response.raise_for_status()
+        for name, data in response.json()["resources"].items():
+            if name in _rate_limiters:
+                _rate_limiters[name].update(
+                    {
+                        "X-RateLimit-Limit": data["limit"],
+                        "X-RateLimit-Remaining": data["remaining"],
+                        "X-RateLimit-Reset": data["reset"],
+                    }
+                )
+    return _rate_limiters[resource].state()
+
+
+def _get_api_base_url() -> str:
+    """Get the GitHub REST API URL. Set GITHUB_API_URL to use a different server (e.g. for tests and benchmarks)."""
+    return os.getenv("GITHUB_API_URL", "https://api.github.com").rstrip("/")
 
 
 def _get_github_api_url(repo: str) -> str:
@@ -11,7 +284,8 @@ def _get_github_api_url(repo: str) -> str:
     Returns:
         str: GitHub issues API URL for the repository.
     """
-    if repo.startswith("https://api.github.com/repos/"):
+    base_url = _get_api_base_url()
+    if repo.startswith(f"{base_url}/repos/"):
         # Assume it's already a GitHub API URL
         if repo.endswith("/"):
             repo = repo[:-1]
@@ -28,11 +302,81 @@ def _get_github_api_url(repo: str) -> str:
 
     # Create the GitHub API URL from the normalized URL
     if "/" in repo:
-        return f"https://api.github.com/repos/{repo}"
+        return f"{base_url}/repos/{repo}"
 
     raise ValueError("Invalid repository format. Must be in the form 'user/repo' or full repository URL.")
 
 
+def _parse_link_header(link: str) -> dict[str, str]:
+    """Parse the GitHub pagination "Link" header into a dictionary of relation -> URL.
+
+    The header looks like this (in one line):
+        <https://api.github.com/...?page=2>; rel="next", <https://api.github.com/...?page=5>; rel="last"
+    """
+    links = {}
+    for match in re.finditer(r'<([^>]+)>;\s*rel="([^"]+)"', link or ""):
+        url, rel = match.groups()
+        links[rel] = url
+    return links
+
+
+def _get_json_and_links(url: str, use_cache: bool = True) -> tuple:
+    """Request a GitHub API URL and return the JSON response and the pagination links.
+
+    Responses are cached on disk with their ETag and Last-Modified headers. If we have seen the URL before, we make a
+    conditional request. GitHub answers with "304 Not Modified" if the data didn't change, without sending the data
+    again and without counting the request against the rate limit.
+
+    Args:
+        url (str): Full GitHub API URL.
+        use_cache (bool): Use the cache for this URL. Set to False for URLs that are not requested again (e.g. bulk
+        downloads), to keep them from pushing useful entries out of the cache.
+
+    Returns:
+        tuple: The JSON response and a dictionary with the pagination links (see _parse_link_header()).
+    """
+    with tracing.span("github_request") as attributes:
+        cached = _http_cache.get(url) if use_cache else None
+        headers = {}
+        if cached:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        response = _send_request("GET", url, headers=headers)
+        attributes["status"] = response.status_code
+        attributes["bytes"] = len(response.content)
+        tracing.count("github_requests_total", status=response.status_code)
+        tracing.count("github_received_bytes_total", len(response.content))
+        if response.status_code == 304 and cached:
+            with _cache_stats_lock:
+                _cache_stats.hits += 1
+            return cached["data"], cached["links"]
+
+        response.raise_for_status()
+        with _cache_stats_lock:
+            _cache_stats.misses += 1
+
+        data = response.json()
+        links = _parse_link_header(response.headers.get("Link", ""))
+        etag = response.headers.get("ETag", "")
+        last_modified = response.headers.get("Last-Modified", "")
+        if use_cache and (etag or last_modified):
+            _http_cache.put(url, {"etag": etag, "last_modified": last_modified, "links": links, "data": data})
+        return data, links
+
+
+def cache_stats() -> CacheStats:
+    """Get the GitHub response cache statistics.
+
+    A hit is a response GitHub confirmed we already have (no data transferred, no rate limit used). A miss is a full
+    download.
+    """
+    with _cache_stats_lock:
+        return CacheStats(_cache_stats.hits, _cache_stats.misses)
+
+
 def _invoke_github_api(repo: str, endpoint: str) -> dict:
     """Invoke the GitHub API for a repository.
 
@@ -44,9 +388,8 @@ def _invoke_github_api(repo: str, endpoint: str) -> dict:
     if endpoint:
         url = f"{url}/{endpoint}"
 
-    response = requests.get(url, timeout=10)
-    response.raise_for_status()
-    return response.json()
+    data, _ = _get_json_and_links(url)
+    return data
 
 
 def get_issue(repo: str, issue_id: str = "") -> dict:
@@ -60,26 +403,326 @@ def get_issue(repo: str, issue_id: str = "") -> dict:
     Returns:
         dict: Issue data.
     """
+    with tracing.span("get_issue"):
+        if "/issues/" in repo:
+            # Assume it's already a fully-formed GitHub issue API URL
+            return _invoke_github_api(repo, "")
+        return _invoke_github_api(repo, f"issues/{issue_id}")
+
+
+def get_repo_api_url(repo: str) -> str:
+    """Get the GitHub API URL of a repository (the "repository_url" field in the issue data).
+
+    Accepts the same inputs as _get_github_api_url(), including issue URLs (returns the URL of their repository).
+    """
+    return _get_github_api_url(repo).split("/issues/")[0]
+
+
+def get_issue_api_url(repo: str, issue_id: str = "") -> str:
+    """Get the GitHub API URL of an issue, accepting the same arguments as get_issue().
+
+    The API URL is the "url" field in the issue data, so it can be used as a unique key for the issue.
+    """
     if "/issues/" in repo:
-        # Assume it's already a fully-formed GitHub issue API URL
-        return _invoke_github_api(repo, "")
-    return _invoke_github_api(repo, f"issues/{issue_id}")
+        # Assume it's already a fully-formed GitHub issue URL
+        return _get_github_api_url(repo)
+    return f"{_get_github_api_url(repo)}/issues/{issue_id}"
 
 
-def get_issue_comments(issue: dict) -> dict:
-    """Get comments for a specific issue.
+def _comments_page_url(issue: dict, page: int, since: str = "") -> str:
+    """Get the URL for one page of comments, requesting the maximum number of comments per page."""
+    url = f"{issue['comments_url']}?per_page={_COMMENTS_PER_PAGE}&page={page}"
+    if since:
+        url += f"&since={since}"
+    return url
+
+
+def _number_of_comment_pages(issue: dict, links: dict[str, str]) -> int:
+    """Get the number of comment pages for an issue.
+
+    The "last" link from the first page is authoritative. GitHub omits the link header when all comments fit in one
+    page, so we fall back to the comment count in the issue data in that case.
+    """
+    if "last" in links:
+        query = parse_qs(urlparse(links["last"]).query)
+        return int(query.get("page", ["1"])[0])
+    if "next" in links:
+        # Should not happen (GitHub sends "last" with "next"), but don't stop at the first page if it does
+        return max(2, math.ceil(issue.get("comments", 0) / _COMMENTS_PER_PAGE))
+    return 1
+
+
+def iter_issue_comments(issue: dict, max_workers: int = _MAX_PAGE_WORKERS, since: str = "") -> Iterator[list]:
+    """Get comments for a specific issue, one page at a time.
+
+    The first page is requested to find out how many pages there are. The remaining pages are requested in parallel,
+    but yielded in order, so callers can start processing the first pages while the later ones are still in transit.
 
     Args:
         issue (dict): Issue data, as returned by GitHub (the JSON response).
+        max_workers (int): Maximum number of pages to request in parallel.
+        since (str): Get only comments created or updated at or after this time (ISO 8601, e.g. "2024-07-21T10:00:00Z").
+
+    Yields:
+        list: The comments in one page, in the order GitHub returns them (chronological).
+    """
+    if issue.get("comments", 1) == 0:
+        # Save a request - the issue tells us there is nothing to get
+        return
+
+    first_page, links = _get_json_and_links(_comments_page_url(issue, 1, since))
+    yield first_page
+
+    last_page = _number_of_comment_pages(issue, links)
+    if last_page < 2:
+        return
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        # Run in the current context to record the requests in the current trace
+        futures = [
+            executor.submit(tracing.context_runner(), _get_json_and_links, _comments_page_url(issue, page, since))
+            for page in range(2, last_page + 1)
+        ]
+        try:
+            for future in futures:
+                page_comments, _ = future.result()
+                yield page_comments
+        finally:
+            # If the caller stops early (or a request fails), don't wait for pages nobody will use
+            for future in futures:
+                future.cancel()
+
+
+def get_issue_comments(issue: dict, max_workers: int = _MAX_PAGE_WORKERS, since: str = "") -> list:
+    """Get all comments for a specific issue.
+
+    Args:
+        issue (dict): Issue data, as returned by GitHub (the JSON response).
+        max_workers (int): Maximum number of pages to request in parallel.
+        since (str): Get only comments created or updated at or after this time (ISO 8601, e.g. "2024-07-21T10:00:00Z").
 
     Returns:
-        dict: Comments data.
+        list: Comments data, in chronological order.
+    """
+    with tracing.span("get_issue_comments") as attributes:
+        comments = []
+        for page in iter_issue_comments(issue, max_workers, since):
+            comments.extend(page)
+        attributes["comments"] = len(comments)
+        return comments
+
+
+def _iter_pages(url: str) -> Iterator[list]:
+    """Get all pages of a GitHub list, following the "next" links, one page at a time."""
+    while url:
+        page, links = _get_json_and_links(url, use_cache=False)
+        yield page
+        url = links.get("next", "")
+
+
+def iter_repo_issues(repo: str, since: str = "") -> Iterator[list]:
+    """Get all issues in a repository (open and closed), one page at a time.
+
+    Pull requests are not included (the GitHub issues API returns them as issues).
+
+    Args:
+        repo (str): Repository in the form "user/repo" or full repository URL.
+        since (str): Get only issues updated at or after this time (ISO 8601, e.g. "2024-07-21T10:00:00Z").
+
+    Yields:
+        list: The issues in one page, from the least to the most recently updated.
     """
-    url = issue["comments_url"]
-    # Request the maximum number of comments per page
-    # Note that pagination is not supported - if there are more than 100 comments, only the first 100 will be returned
-    url += "?per_page=100"
-    return _invoke_github_api(url, "")
+    url = f"{_get_github_api_url(repo)}/issues?state=all&sort=updated&direction=asc&per_page={_COMMENTS_PER_PAGE}"
+    if since:
+        url += f"&since={since}"
+    for page in _iter_pages(url):
+        yield [issue for issue in page if "pull_request" not in issue]
+
+
+def iter_repo_comments(repo: str, since: str = "") -> Iterator[list]:
+    """Get the comments of all issues (and pull requests) in a repository, one page at a time.
+
+    This is much faster than getting the comments of each issue separately. Use the "issue_url" field to find the
+    issue of each comment.
+
+    Args:
+        repo (str): Repository in the form "user/repo" or full repository URL.
+        since (str): Get only comments created or updated at or after this time (ISO 8601, e.g. "2024-07-21T10:00:00Z").
+
+    Yields:
+        list: The comments in one page, from the least to the most recently updated.
+    """
+    url = f"{_get_github_api_url(repo)}/issues/comments?sort=updated&direction=asc&per_page={_COMMENTS_PER_PAGE}"
+    if since:
+        url += f"&since={since}"
+    yield from _iter_pages(url)
+
+
+# Query for the issue and the first page of comments, with only the fields the parsers use
+# (plus the ones needed to use the REST API functions with the same data, e.g. to get new comments)
+_GRAPHQL_ISSUE_QUERY = """
+query($owner: String!, $name: String!, $number: Int!) {
+  repository(owner: $owner, name: $name) {
+    issue(number: $number) {
+      number
+      title
+      body
+      url
+      state
+      createdAt
+      updatedAt
+      authorAssociation
+      author { login }
+      labels(first: 100) { nodes { name } }
+      comments(first: 100) { ...commentsPage }
+    }
+  }
+}
+"""
+
+# Query for the next pages of comments
+_GRAPHQL_COMMENTS_QUERY = """
+query($owner: String!, $name: String!, $number: Int!, $cursor: String!) {
+  repository(owner: $owner, name: $name) {
+    issue(number: $number) {
+      comments(first: 100, after: $cursor) { ...commentsPage }
+    }
+  }
+}
+"""
+
+_GRAPHQL_COMMENTS_FRAGMENT = """
+fragment commentsPage on IssueCommentConnection {
+  totalCount
+  pageInfo { hasNextPage endCursor }
+  nodes { databaseId body createdAt updatedAt authorAssociation author { login __typename } }
+}
+"""
+
+
+def _get_graphql_url() -> str:
+    """Get the GitHub GraphQL API URL. Set GITHUB_GRAPHQL_URL to use a different server (e.g. for tests)."""
+    return os.getenv("GITHUB_GRAPHQL_URL", "https://api.github.com/graphql")
+
+
+def _parse_issue_reference(repo: str, issue_id: str = "") -> tuple[str, str, int]:
+    """Get the owner, repository name, and issue number from the same arguments get_issue() accepts."""
+    url = _get_github_api_url(repo)
+    parts = url.replace(f"{_get_api_base_url()}/repos/", "").split("/")
+    if len(parts) >= 4 and parts[2] == "issues":
+        return parts[0], parts[1], int(parts[3])
+    if not issue_id:
+        raise ValueError("Missing issue number. Pass it separately or as part of the issue URL.")
+    return parts[0], parts[1], int(issue_id)
+
+
+def _invoke_github_graphql(query: str, variables: dict) -> dict:
+    """Invoke the GitHub GraphQL API and return the data in the response.
+
+    The GraphQL API requires authentication, even for public repositories. Set GITHUB_TOKEN to a personal access
+    token (no scopes needed for public repositories).
+    """
+    token = _get_github_token()
+    if not token:
+        raise OSError("GITHUB_TOKEN environment variable not set -- required for the GitHub GraphQL API")
+
+    with tracing.span("github_graphql_request") as attributes:
+        response = _send_request(
+            "POST",
+            _get_graphql_url(),
+            resource="graphql",
+            json={"query": query + _GRAPHQL_COMMENTS_FRAGMENT, "variables": variables},
+        )
+        attributes["status"] = response.status_code
+        attributes["bytes"] = len(response.content)
+    tracing.count("github_requests_total", status=response.status_code)
+    tracing.count("github_received_bytes_total", len(response.content))
+    response.raise_for_status()
+    result = response.json()
+    # GraphQL reports errors in the response body, with HTTP status 200
+    if result.get("errors"):
+        messages = "; ".join(error.get("message", str(error)) for error in result["errors"])
+        raise ValueError(f"GitHub GraphQL API error: {messages}")
+    return result["data"]
+
+
+def _graphql_login(node: dict) -> str:
+    """Get the login of the author of an issue or comment (deleted accounts show as "ghost" on GitHub)."""
+    return (node.get("author") or {}).get("login", "ghost")
+
+
+def _graphql_to_rest_comment(node: dict) -> dict:
+    """Convert a comment from the GraphQL API to the REST API format (only the fields we use)."""
+    author = node.get("author") or {}
+    return {
+        "id": node["databaseId"],
+        "user": {"login": _graphql_login(node), "type": "Bot" if author.get("__typename") == "Bot" else "User"},
+        "body": node["body"],
+        "created_at": node["createdAt"],
+        "updated_at": node["updatedAt"],
+        "author_association": node["authorAssociation"],
+    }
+
+
+def _graphql_to_rest_issue(node: dict, owner: str, name: str) -> dict:
+    """Convert an issue from the GraphQL API to the REST API format (only the fields we use)."""
+    api_url = f"{_get_github_api_url(f'{owner}/{name}')}/issues/{node['number']}"
+    return {
+        "number": node["number"],
+        "title": node["title"],
+        "body": node["body"],
+        "url": api_url,
+        "html_url": node["url"],
+        "comments_url": f"{api_url}/comments",
+        "comments": node["comments"]["totalCount"],
+        "state": node["state"].lower(),  # GraphQL uses "OPEN" and "CLOSED", REST uses "open" and "closed"
+        "created_at": node["createdAt"],
+        "updated_at": node["updatedAt"],
+        "author_association": node["authorAssociation"],
+        "user": {"login": _graphql_login(node)},
+        "labels": [{"name": label["name"]} for label in node["labels"]["nodes"]],
+    }
+
+
+def get_issue_and_comments_graphql(repo: str, issue_id: str = "") -> tuple[dict, list]:
+    """Get an issue and all its comments with the GitHub GraphQL API.
+
+    The REST API needs at least two requests, one for the issue and one for each page of comments, and returns many
+    fields we don't use. With GraphQL, we get the issue and the first 100 comments in one request, with only the fields
+    we use. Each additional 100 comments take one more request (GraphQL pages must be requested in sequence).
+
+    Args:
+        repo (str): Repository in the form "user/repo" or the full URL to the issue (see get_issue()).
+        issue_id (int): Issue number. Optional if the URL already contains the issue number.
+
+    Returns:
+        tuple: The issue and the comments, in the same format as get_issue() and get_issue_comments() (only with the
+        fields that parse_issue() and parse_comments() use).
+    """
+    with tracing.span("get_issue_and_comments_graphql") as attributes:
+        issue, comments = _get_issue_and_comments_graphql(repo, issue_id)
+        attributes["comments"] = len(comments)
+        return issue, comments
+
+
+def _get_issue_and_comments_graphql(repo: str, issue_id: str) -> tuple[dict, list]:
+    """Get an issue and all its comments with the GitHub GraphQL API (see get_issue_and_comments_graphql())."""
+    owner, name, number = _parse_issue_reference(repo, issue_id)
+    variables = {"owner": owner, "name": name, "number": number}
+
+    data = _invoke_github_graphql(_GRAPHQL_ISSUE_QUERY, variables)
+    node = (data.get("repository") or {}).get("issue")
+    if not node:
+        raise ValueError(f"Issue {number} not found in {owner}/{name}")
+
+    issue = _graphql_to_rest_issue(node, owner, name)
+    page = node["comments"]
+    comments = [_graphql_to_rest_comment(comment) for comment in page["nodes"]]
+    while page["pageInfo"]["hasNextPage"]:
+        data = _invoke_github_graphql(_GRAPHQL_COMMENTS_QUERY, {**variables, "cursor": page["pageInfo"]["endCursor"]})
+        page = data["repository"]["issue"]["comments"]
+        comments.extend(_graphql_to_rest_comment(comment) for comment in page["nodes"])
+    return issue, comments
 
 
 def parse_issue(issue: dict) -> str:
@@ -98,30 +741,74 @@ def parse_issue(issue: dict) -> str:
     Returns:
         str: Parsed issue data.
     """
-    parsed = f"Title: {issue['title']}\n"
-    parsed += f"Body (between '''):\n'''\n{issue['body']}\n'''\n"
-    parsed += f"Submitted by: {issue['user']['login']}\n"
-    parsed += f"Submitted on: {issue['created_at']}\n"
-    parsed += f"Submitter association: {issue['author_association']}\n"
-    parsed += f"State: {issue['state']}\n"
-    parsed += f"Labels: {', '.join([label['name'] for label in issue['labels']])}\n"
-    return parsed
+    with tracing.span("parse_issue"):
+        return _parse_issue(issue)
+
 
+def _parse_issue(issue: dict) -> str:
+    """Parse issue data into a text format (see parse_issue())."""
+    # Build the text in one step - adding to a string copies it (and the body, which can be large) each time
+    return (
+        f"Title: {issue['title']}\n"
+        f"Body (between '''):\n'''\n{issue['body']}\n'''\n"
+        f"Submitted by: {issue['user']['login']}\n"
+        f"Submitted on: {issue['created_at']}\n"
+        f"Submitter association: {issue['author_association']}\n"
+        f"State: {issue['state']}\n"
+        f"Labels: {', '.join([label['name'] for label in issue['labels']])}\n"
+    )
 
-def parse_comments(comments: dict) -> str:
+
+def parse_comments(comments, max_chars: int | None = None, max_tokens: int | None = None) -> str:
     """Parse comments data returned by GitHub into a text format.
 
     See comments for parse_issue() for more details.
 
     Args:
-        comments (dict): Comments data, as returned by GitHub (the JSON response).
+        comments (Iterable[dict]): Comments data, as returned by GitHub (the JSON response). Any iterable works, for
+        example, to parse pages as they arrive from iter_issue_comments():
+            parse_comments(c for page in iter_issue_comments(issue) for c in page)
+        max_chars (int): Stop before the first comment that would make the text longer than this. None for no limit.
+        max_tokens (int): Same as `max_chars`, in tokens (estimated as in llm.estimate_tokens()).
 
     Returns:
-        str: Parsed comments data.
+        str: Parsed comments data (whole comments only when limited).
+    """
+    with tracing.span("parse_comments"):
+        # Joining the parts at the end takes linear time - adding each one to a string copies the text each time
+        return "".join(iter_parsed_comments(comments, max_chars, max_tokens))
+
+
+def iter_parsed_comments(comments, max_chars: int | None = None, max_tokens: int | None = None) -> Iterator[str]:
+    """Parse comments data returned by GitHub into a text format, one comment at a time.
+
+    Joining the parts gives the same text as parse_comments(). Use it to process the text as it's parsed without
+    holding all of it (or all the comments) in memory, e.g. to write it to a file or to count its tokens.
+
+    Args:
+        comments (Iterable[dict]): Comments data, as returned by GitHub (the JSON response). Read one at a time, as
+        the parts are requested.
+        max_chars (int): Stop before the first comment that would make the text longer than this. None for no limit.
+        max_tokens (int): Same as `max_chars`, in tokens (estimated as in llm.estimate_tokens()).
+
+    Yields:
+        str: The text of each comment.
     """
-    parsed = ""
+    limits = [max_chars, None if max_tokens is None else llm.max_chars_for_tokens(max_tokens)]
+    remaining = min((limit for limit in limits if limit is not None), default=None)
     for comment in comments:
-        parsed += f"Comment by: {comment['user']['login']}\n"
-        parsed += f"Comment on: {comment['created_at']}\n"
-        parsed += f"Body (between '''):\n'''\n{comment['body']}\n'''\n"
-    return parsed
+        parsed = _parse_comment(comment)
+        if remaining is not None:
+            if len(parsed) > remaining:
+                return
+            remaining -= len(parsed)
+        yield parsed
+
+
+def _parse_comment(comment: dict) -> str:
+    """Parse one comment into a text format (see parse_comments())."""
+    return (
+        f"Comment by: {comment['user']['login']}\n"
+        f"Comment on: {comment['created_at']}\n"
+        f"Body (between '''):\n'''\n{comment['body']}\n'''\n"
+    )
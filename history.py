@@ -0,0 +1,335 @@
+#! python
+"""Append-only history of the LLM calls, to analyze costs and response times across runs.
+
+Each call to the LLM (including the responses that came from the cache) is recorded in a SQLite database with its
+model, repository, tokens, cost, response time, and hashes of the prompt and input (to find repeated requests without
+storing them). The raw response is stored compressed in a separate table, so the reports read only the small rows
+with the numbers, never the raw responses.
+
+Calls are recorded automatically by llm.py in the database set in the [History] section of llm.ini. The repository
+of a call comes from the issue being summarized - wrap the summary in `with history.issue_context(issue_url):`.
+
+Usage:
+
+    python history.py report --by model,day
+    python history.py report --by repo --since 2024-07-01
+    python history.py slowest --limit 10
+    python history.py raw 42
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING
+
+import settings
+import tracing
+
+if TYPE_CHECKING:
+    import llm
+
+_DEFAULT_PATH = "history.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS calls (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,  -- Unix time when the call was recorded
+    day TEXT NOT NULL,  -- UTC date (YYYY-MM-DD), to group by day
+    model TEXT NOT NULL,
+    repo TEXT NOT NULL,  -- "user/repo" of the issue, empty if unknown
+    issue_url TEXT NOT NULL,
+    cached INTEGER NOT NULL,  -- 1 if the response came from the cache (cost is zero, cost_saved is what it cost)
+    batch INTEGER NOT NULL,  -- 1 if the response came from the OpenAI Batch API (elapsed_time is the batch time)
+    input_tokens INTEGER NOT NULL,
+    output_tokens INTEGER NOT NULL,
+    cost REAL NOT NULL,
+    cost_saved REAL NOT NULL,
+    elapsed_time REAL NOT NULL,
+    time_to_first_token REAL NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    input_hash TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS calls_day ON calls (day);
+-- Kept apart from the calls, so the reports scan only the small rows above
+CREATE TABLE IF NOT EXISTS raw_responses (
+    call_id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL  -- The raw response as JSON, compressed with zlib
+);
+"""
+
+# Columns the reports can group by
+_GROUP_COLUMNS = ("model", "repo", "day")
+_COMPRESSION_LEVEL = 6
+
+# Issue being summarized in the current context (thread or task), to record the repository of the calls
+_issue_url: ContextVar[str] = ContextVar("issue_url", default="")
+
+
+@dataclass
+class ReportRow:
+    """Spend and response times of the calls in one group (e.g. one model on one day)."""
+
+    group: dict[str, str] = field(default_factory=dict)  # The values of the grouping columns, e.g. {"model": "gpt-4o"}
+    calls: int = 0
+    cached_calls: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cost: float = 0.0
+    cost_saved: float = 0.0
+    # Response times of the calls that went to the LLM (not cached and not batched), in seconds
+    p50: float = 0.0
+    p95: float = 0.0
+    p99: float = 0.0
+    max: float = 0.0
+    tokens_per_second: float = 0.0  # Input and output tokens divided by the response time, as shown by the app
+
+
+@dataclass
+class Call:
+    """One recorded call, without the raw response."""
+
+    id: int
+    time: float
+    model: str
+    repo: str
+    issue_url: str
+    cached: bool
+    input_tokens: int
+    output_tokens: int
+    cost: float
+    elapsed_time: float
+
+
+def _hash(text: str) -> str:
+    """Hash a text to find repeated prompts and inputs without storing them."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _repo_from_url(url: str) -> str:
+    """Get "user/repo" from a GitHub issue URL (web or API), or an empty string if it's not one."""
+    match = re.search(r"github\.com/(?:repos/)?([^/]+/[^/]+)/issues", url)
+    return match.group(1) if match else ""
+
+
+@contextmanager
+def issue_context(issue_url: str) -> Iterator[None]:
+    """Record the LLM calls made in this context (and in threads started with tracing.context_runner()) as calls for
+    this issue."""
+    token = _issue_url.set(issue_url)
+    try:
+        yield
+    finally:
+        _issue_url.reset(token)
+
+
+class HistoryStore:
+    """SQLite store of the LLM calls. Safe to use from multiple threads."""
+
+    def __init__(self, path: str = _DEFAULT_PATH):
+        """Open the store, creating it if it doesn't exist.
+
+        Args:
+            path (str): Path to the SQLite database file.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.executescript(_SCHEMA)
+
+    def close(self):
+        """Close the store."""
+        with self._lock:
+            self._db.close()
+
+    def add(self, response: "llm.LLMResponse", issue_url: str = "", batch: bool = False) -> int:
+        """Record a call.
+
+        Args:
+            response (llm.LLMResponse): The response of the call.
+            issue_url (str): URL of the issue summarized in the call, to record its repository.
+            batch (bool): The response came from the OpenAI Batch API.
+
+        Returns:
+            int: The ID of the call, to get its raw response with get_raw_response().
+        """
+        now = time.time()
+        row = (
+            now,
+            time.strftime("%Y-%m-%d", time.gmtime(now)),
+            response.model,
+            _repo_from_url(issue_url),
+            issue_url,
+            response.cached,
+            batch,
+            response.input_tokens,
+            response.output_tokens,
+            response.cost,
+            response.cost_saved,
+            response.elapsed_time,
+            response.time_to_first_token,
+            _hash(response.prompt),
+            _hash(response.user_input),
+        )
+        # Compress outside of the lock - it's the slowest part
+        # Cached responses repeat a raw response we already have (the call that put it in the cache)
+        raw = None if response.cached else zlib.compress(json.dumps(response.raw_response).encode(), _COMPRESSION_LEVEL)
+        with self._lock, self._db:
+            cursor = self._db.execute(f"INSERT INTO calls VALUES (NULL, {', '.join('?' * len(row))})", row)
+            if raw is not None:
+                self._db.execute("INSERT INTO raw_responses (call_id, data) VALUES (?, ?)", (cursor.lastrowid, raw))
+        return cursor.lastrowid
+
+    def get_raw_response(self, call_id: int) -> dict | None:
+        """Get the raw response of a call, or None if it was not stored (e.g. the response came from the cache)."""
+        with self._lock:
+            row = self._db.execute("SELECT data FROM raw_responses WHERE call_id = ?", (call_id,)).fetchone()
+        return json.loads(zlib.decompress(row[0])) if row else None
+
+    def report(self, group_by: list[str], since: str = "", until: str = "") -> list[ReportRow]:
+        """Add up the spend and calculate the response time percentiles of the calls, by group.
+
+        The calls are read one group at a time, without the raw responses, to keep the memory use low.
+
+        Args:
+            group_by (list[str]): Columns to group by: "model", "repo", and/or "day". Empty for one row with all calls.
+            since (str): First day to include (YYYY-MM-DD). Empty for no limit.
+            until (str): Last day to include (YYYY-MM-DD). Empty for no limit.
+
+        Returns:
+            list[ReportRow]: One row per group, ordered by the grouping columns.
+        """
+        invalid = [c for c in group_by if c not in _GROUP_COLUMNS]
+        if invalid:
+            raise ValueError(f"Invalid report columns: {', '.join(invalid)} (use {', '.join(_GROUP_COLUMNS)})")
+
+        columns = "".join(f"{c}, " for c in group_by)
+        sql = (
+            f"SELECT {columns}cached, batch, input_tokens, output_tokens, cost, cost_saved, elapsed_time FROM calls"
+            " WHERE day >= ? AND day <= ?"
+        )
+        if group_by:
+            sql += f" ORDER BY {', '.join(group_by)}"
+
+        rows = []
+        with self._lock:
+            cursor = self._db.execute(sql, (since, until or "9999-99-99"))
+            for group, calls in itertools.groupby(cursor, key=lambda call: call[: len(group_by)]):
+                row = ReportRow(group=dict(zip(group_by, group)))
+                latencies, timed_tokens = [], 0
+                for call in calls:
+                    cached, batch, input_tokens, output_tokens, cost, cost_saved, elapsed_time = call[len(group_by) :]
+                    row.calls += 1
+                    row.cached_calls += cached
+                    row.input_tokens += input_tokens
+                    row.output_tokens += output_tokens
+                    row.cost += max(0.0, cost)
+                    row.cost_saved += cost_saved
+                    if not cached and not batch:
+                        latencies.append(elapsed_time)
+                        timed_tokens += input_tokens + output_tokens
+                row.p50, row.p95, row.p99, row.max = (tracing.percentile(latencies, p) for p in (50, 95, 99, 100))
+                row.tokens_per_second = timed_tokens / sum(latencies) if sum(latencies) > 0 else 0.0
+                rows.append(row)
+        return rows
+
+    def slowest(self, limit: int = 10, since: str = "") -> list[Call]:
+        """Get the calls that took the longest to respond (not cached and not batched), slowest first."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, time, model, repo, issue_url, cached, input_tokens, output_tokens, cost, elapsed_time"
+                " FROM calls WHERE cached = 0 AND batch = 0 AND day >= ? ORDER BY elapsed_time DESC LIMIT ?",
+                (since, limit),
+            ).fetchall()
+        return [Call(*row[:5], bool(row[5]), *row[6:]) for row in rows]
+
+
+# Store used to record the calls automatically, opened when the first call is recorded (see record())
+_store: HistoryStore | None = None
+_store_lock = threading.Lock()
+
+
+def _get_store() -> HistoryStore | None:
+    """Get the store set in llm.ini, opening it if the setting changed, or None if the history is disabled."""
+    global _store
+    config = settings.read_config()
+    path = config.get("History", "path", fallback=_DEFAULT_PATH)
+    enabled = config.getboolean("History", "enabled", fallback=True)
+    with _store_lock:
+        if not enabled or not path:
+            return None
+        if _store is None or _store.path != path:
+            # Don't close the previous store - another thread may be using it
+            _store = HistoryStore(path)
+        return _store
+
+
+def record(response: "llm.LLMResponse", batch: bool = False):
+    """Record a call in the history, for the issue set with issue_context(), if the history is enabled in llm.ini."""
+    store = _get_store()
+    if store is not None:
+        store.add(response, _issue_url.get(), batch)
+
+
+def show_report(rows: list[ReportRow], group_by: list[str]):
+    """Show a report as a table."""
+    header = [c.capitalize() for c in group_by] + ["Calls", "Cached", "Tokens", "Cost", "Saved"]
+    header += ["p50", "p95", "p99", "Max", "Tokens/s"]
+    lines = [header]
+    for r in rows:
+        line = [r.group[c] or "(unknown)" for c in group_by]
+        line += [f"{r.calls:,}", f"{r.cached_calls:,}", f"{r.input_tokens + r.output_tokens:,}"]
+        line += [f"${r.cost:.4f}", f"${r.cost_saved:.4f}"]
+        line += [f"{v:.2f}s" for v in (r.p50, r.p95, r.p99, r.max)] + [f"{r.tokens_per_second:,.0f}"]
+        lines.append(line)
+    widths = [max(len(line[i]) for line in lines) for i in range(len(header))]
+    for line in lines:
+        print("  ".join(value.ljust(width) for value, width in zip(line, widths)).rstrip())
+
+
+def main():
+    """Show reports of the LLM calls from the command line."""
+    parser = argparse.ArgumentParser(description="Analyze the costs and response times of the LLM calls.")
+    parser.add_argument("--db", default=_DEFAULT_PATH, help="SQLite database file")
+    commands = parser.add_subparsers(dest="command", required=True)
+    report = commands.add_parser("report", help="spend and response times by model, repository, and/or day")
+    report.add_argument("--by", default="model,day", help="columns to group by, separated by commas (model,repo,day)")
+    report.add_argument("--since", default="", help="first day to include (YYYY-MM-DD)")
+    report.add_argument("--until", default="", help="last day to include (YYYY-MM-DD)")
+    slowest = commands.add_parser("slowest", help="the calls that took the longest to respond")
+    slowest.add_argument("--limit", type=int, default=10, help="number of calls to show")
+    slowest.add_argument("--since", default="", help="first day to include (YYYY-MM-DD)")
+    raw = commands.add_parser("raw", help="show the raw response of a call")
+    raw.add_argument("id", type=int, help="call ID (from the slowest command)")
+    args = parser.parse_args()
+
+    store = HistoryStore(args.db)
+    if args.command == "report":
+        group_by = [c.strip() for c in args.by.split(",") if c.strip()]
+        try:
+            show_report(store.report(group_by, args.since, args.until), group_by)
+        except ValueError as ex:
+            parser.error(str(ex))
+    elif args.command == "slowest":
+        for c in store.slowest(args.limit, args.since):
+            when = time.strftime("%Y-%m-%d %H:%M", time.gmtime(c.time))
+            print(f"#{c.id} {when} {c.model} {c.elapsed_time:.2f}s - {c.input_tokens + c.output_tokens:,} tokens")
+            print(f"    {c.issue_url or '(unknown issue)'}")
+    else:
+        response = store.get_raw_response(args.id)
+        print(json.dumps(response, indent=2) if response else f"No raw response for call {args.id}")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
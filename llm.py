@@ -4,13 +4,28 @@ It currently uses OpenAI. The intention of this module is to abstract away the L
 with a different LLM later if needed.
 """
 
+import dataclasses
+import functools
+import hashlib
+import json
 import os
+import re
+import sqlite3
+import sys
+import threading
 import time
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from dataclasses import dataclass, field
 
-import dotenv
 from openai import OpenAI
 
+import history
+import settings
+import tracing
+from cache import DiskCache
+
 
 @dataclass
 class LLMResponse:
@@ -28,6 +43,10 @@ class LLMResponse:
     cost: float = 0.0
     raw_response: dict = field(default_factory=dict)
     elapsed_time: float = 0.0
+    time_to_first_token: float = 0.0  # Same as elapsed_time if the response was not streamed
+    cached: bool = False  # True if the response came from the cache instead of the LLM
+    cost_saved: float = 0.0  # Cost of the original request when the response came from the cache
+    routing_reason: str = ""  # Why the model was chosen, when it was chosen automatically (see route_model())
 
     @property
     def total_tokens(self):
@@ -36,31 +55,113 @@ class LLMResponse:
 
 
 # Support models and costs from https://openai.com/pricing
+# Context window sizes (in tokens) from https://platform.openai.com/docs/models
+# Speeds (tokens per second to read the input and to generate the output) are rough values to start with - the model
+# router replaces them with the speeds measured in the responses as they arrive
 _COST_UNIT = 1_000_000  # Prices are per 1,000,000 token for each model
 _MODEL_DATA = {
-    "gpt-3.5-turbo": {"input": 0.5, "output": 1.5},
-    "gpt-4o": {"input": 5.0, "output": 15.0},
-    "gpt-4o-mini": {"input": 0.15, "output": 0.6},
+    "gpt-3.5-turbo": {
+        "input": 0.5,
+        "output": 1.5,
+        "context_window": 16_385,
+        "input_tokens_per_second": 8_000,
+        "output_tokens_per_second": 80,
+    },
+    "gpt-4o": {
+        "input": 5.0,
+        "output": 15.0,
+        "context_window": 128_000,
+        "input_tokens_per_second": 4_000,
+        "output_tokens_per_second": 60,
+    },
+    "gpt-4o-mini": {
+        "input": 0.15,
+        "output": 0.6,
+        "context_window": 128_000,
+        "input_tokens_per_second": 6_000,
+        "output_tokens_per_second": 80,
+    },
 }
 
+# Rough number of characters per token, used to estimate the number of tokens without calling a tokenizer
+# English text averages about four characters per token, but code and logs (common in issues) have more tokens, so we
+# use a lower number to err on the side of overestimating
+_CHARS_PER_TOKEN = 3
+
+# The OpenAI Batch API completes requests within 24 hours, at half the price
+# See https://platform.openai.com/docs/guides/batch
+_BATCH_DISCOUNT = 0.5
+_BATCH_ENDPOINT = "/v1/chat/completions"
+_BATCH_COMPLETION_WINDOW = "24h"
+_BATCH_FINAL_STATES = ("completed", "failed", "expired", "cancelled")
+
+# Defaults for the request settings in the [LLM] section of llm.ini (see _request_settings())
+_DEFAULT_TIMEOUT = 60.0
+_DEFAULT_HEDGE_PERCENTILE = 95.0
+# Hedged requests: a duplicate request is sent when a response takes longer than most past responses
+# Response times of the last requests for each model, to calculate the time to wait before sending the duplicate
+_LATENCY_SAMPLES = 200
+_HEDGE_MIN_SAMPLES = 20  # Don't hedge until we know what a slow response is
+_latencies: dict[str, deque] = {}
+_latencies_lock = threading.Lock()
+_hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm-hedge")
+# Tokens reserved for the model's response - the context window includes the input and the output
+OUTPUT_TOKENS = 4096
+
+# Automatic model selection: use AUTO_MODEL as the model name to choose the model for each request (see route_model())
+AUTO_MODEL = "auto"
+_DEFAULT_LATENCY_TARGET = 30.0
+# Expected response length, to estimate the response time and cost before the request (summaries are about this long)
+_ROUTER_OUTPUT_TOKENS = 1000
+# Speeds (input and output tokens per second) of the last responses of each model - the router uses the median once it
+# has enough of them
+_THROUGHPUT_SAMPLES = 50
+_THROUGHPUT_MIN_SAMPLES = 3
+_throughputs: dict[tuple[str, str], deque] = {}  # Keyed by model and "input" or "output"
+_throughputs_lock = threading.Lock()
+
+# Cache of LLM responses, keyed by the model, prompt, and user input
+# We request completions with temperature=0.0, so the same input gives (nearly) the same output - no need to pay again
+_CACHE_DIR = os.path.join(".cache", "llm")
+_CACHE_MAX_ENTRIES = 500
+_CACHE_TTL = 7 * 24 * 60 * 60  # Expire after a week to eventually pick up model updates
+_response_cache = DiskCache(_CACHE_DIR, max_entries=_CACHE_MAX_ENTRIES, ttl=_CACHE_TTL)
+
+
+# Client shared by all requests (and threads), to reuse its connections instead of opening new ones for each request
+# It's rebuilt when the configuration files change, to pick up changes without restarting the program
+_client: OpenAI | None = None
+_client_version: tuple = ()
+_client_lock = threading.Lock()
+
 
 def _get_openai_client() -> OpenAI:
-    """Get a client for OpenAI."""
-    # Always override the environment variables with the .env file to allow key changes without restarting the program
-    dotenv.load_dotenv(override=True)
-    api_key = os.getenv("OPENAI_API_KEY")
+    """Get the client for OpenAI, creating a new one if the configuration changed since the last one was created."""
+    global _client, _client_version
+    settings.load_env()
+    version = settings.version()
+    with _client_lock:
+        if _client is not None and version == _client_version:
+            return _client
 
-    if not api_key:
-        raise EnvironmentError("OPENAI_API_KEY environment variable not set -- see README.md for instructions")
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise EnvironmentError("OPENAI_API_KEY environment variable not set -- see README.md for instructions")
 
-    return OpenAI(api_key=api_key)
+        # Don't close the previous client - other threads may still be using it
+        # Its connections are closed when it's garbage collected
+        _client = OpenAI(api_key=api_key)
+        _client_version = version
+        return _client
 
 
-def _openai_cost(input_tokens: int, output_tokens: int, model: str) -> float:
+def _openai_cost(input_tokens: int, output_tokens: int, model: str, batch: bool = False) -> float:
     """Calculate the cost of the completion.
 
     IMPORTANT: OpenAI may change pricing at any time. Consult https://openai.com/pricing and
     update this function accordingly.
+
+    Set `batch` for completions from the Batch API, which costs less.
     """
     if model not in _MODEL_DATA:
         # Flag the error, but don't interrupt the program
@@ -68,47 +169,261 @@ def _openai_cost(input_tokens: int, output_tokens: int, model: str) -> float:
 
     input_cost = input_tokens * _MODEL_DATA[model]["input"] / _COST_UNIT
     output_cost = output_tokens * _MODEL_DATA[model]["output"] / _COST_UNIT
-    return input_cost + output_cost
+    discount = _BATCH_DISCOUNT if batch else 1.0
+    return (input_cost + output_cost) * discount
+
+
+def _openai_messages(prompt: str, user_input: str) -> list[dict]:
+    """Create the messages for an OpenAI chat completion."""
+    return [
+        {"role": "system", "content": prompt},
+        {"role": "user", "content": user_input},
+    ]
+
+
+def _openai_request_body(model: str, prompt: str, user_input: str) -> dict:
+    """Create the body of an OpenAI chat completion request.
+
+    All requests use it (interactive and batch), so the same input gets the same response from all of them.
+    """
+    return {
+        "model": model,
+        "messages": _openai_messages(prompt, user_input),
+        "temperature": 0.0,  # We want precise and repeatable results
+    }
+
+
+def _fill_response(response: LLMResponse, completion: dict, batch: bool = False):
+    """Fill in the response text, tokens, and costs from an OpenAI chat completion (as a dictionary)."""
+    response.llm_response = completion["choices"][0]["message"]["content"]
+
+    # This is not exactly the raw response, but it's close enough
+    response.raw_response = completion
+
+    # Record the number of tokens used for input and output
+    response.input_tokens = completion["usage"]["prompt_tokens"]
+    response.output_tokens = completion["usage"]["completion_tokens"]
+
+    # Records costs (depends on the tokens and model - set them first)
+    response.cost = _openai_cost(response.input_tokens, response.output_tokens, response.model, batch)
+
+
+def _llm_setting(name: str, default: float) -> float:
+    """Get a number from the [LLM] section of llm.ini, or the default if it's not there."""
+    return settings.read_config().getfloat("LLM", name, fallback=default)
+
+
+def _request_settings() -> tuple[float, float]:
+    """Get the timeout (seconds) and the hedge percentile from the [LLM] section of llm.ini."""
+    return _llm_setting("timeout", _DEFAULT_TIMEOUT), _llm_setting("hedge_percentile", _DEFAULT_HEDGE_PERCENTILE)
 
 
 def _openai_chat_completion(model: str, prompt: str, user_input: str) -> LLMResponse:
     """Get a chat completion from OpenAI."""
-    # Always instantiate a new client to pick up configuration changes without restarting the program
     client = _get_openai_client()
+    timeout, _ = _request_settings()
 
     start_time = time.time()
-    completion = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": prompt},
-            {"role": "user", "content": user_input},
-        ],
-        temperature=0.0,  # We want precise and repeatable results
-    )
+    completion = client.chat.completions.create(**_openai_request_body(model, prompt, user_input), timeout=timeout)
     elapsed_time = time.time() - start_time
-    client.close()
 
     # Record the request and the response
     response = LLMResponse()
     response.elapsed_time = elapsed_time
+    response.time_to_first_token = elapsed_time
     response.model = model
     response.prompt = prompt
     response.user_input = user_input
-    response.llm_response = completion.choices[0].message.content  # type: ignore
+    # The completion object is a pydantic.BaseModel class - convert to a dictionary, as in the batch results
+    _fill_response(response, completion.model_dump())
 
-    # This is not exactly the raw response, but it's close enough
-    # It assumes the completion object is a pydantic.BaseModel class, which has the `dict()`
-    # method we need here
-    response.raw_response = completion.model_dump()
+    return response
 
-    # Record the number of tokens used for input and output
-    response.input_tokens = completion.usage.prompt_tokens  # type: ignore
-    response.output_tokens = completion.usage.completion_tokens  # type: ignore
 
-    # Records costs (depends on the tokens and model - set them first)
-    response.cost = _openai_cost(response.input_tokens, response.output_tokens, model)
+def _record_latency(future: Future):
+    """Record the response time of a completed request, to calculate the time to wait before hedging."""
+    if future.cancelled() or future.exception():
+        return
+    response = future.result()
+    with _latencies_lock:
+        _latencies.setdefault(response.model, deque(maxlen=_LATENCY_SAMPLES)).append(response.elapsed_time)
 
-    return response
+
+def _hedge_delay(model: str) -> float | None:
+    """Get how long to wait for a response before sending a duplicate request, or None to not send one."""
+    _, hedge_percentile = _request_settings()
+    with _latencies_lock:
+        samples = list(_latencies.get(model, ()))
+    if hedge_percentile <= 0 or len(samples) < _HEDGE_MIN_SAMPLES:
+        return None
+    return tracing.percentile(samples, hedge_percentile)
+
+
+def _record_duplicate(future: Future) -> float:
+    """Record a duplicate request that completed after the response we used - we pay for it too.
+
+    Returns:
+        float: The cost of the request (0 if it failed).
+    """
+    if future.cancelled() or future.exception():
+        return 0.0
+    response = future.result()
+    _record_usage(response, {})
+    tracing.count("llm_duplicate_cost_dollars_total", max(0.0, response.cost), model=response.model)
+    return response.cost
+
+
+def _submit_request(model: str, prompt: str, user_input: str) -> tuple[Future, threading.Event]:
+    """Send a chat completion request in the background.
+
+    Returns:
+        tuple[Future, threading.Event]: The response, and an event that is set when the request starts.
+    """
+    started = threading.Event()
+
+    def request() -> LLMResponse:
+        started.set()
+        return _openai_chat_completion(model, prompt, user_input)
+
+    # Run in the current context to record the requests in the current trace
+    future = _hedge_executor.submit(tracing.context_runner(), request)
+    future.add_done_callback(_record_latency)
+    return future, started
+
+
+def _openai_chat_completion_hedged(model: str, prompt: str, user_input: str) -> tuple[LLMResponse, float]:
+    """Get a chat completion from OpenAI, sending a duplicate request if the first one is slower than usual.
+
+    Most responses take about the same time, but a few take much longer (e.g. the request landed on a busy server).
+    Sending a second request when the first one is slower than most (a percentile of the past response times) and
+    using the first response that arrives cuts these long waits, at the cost of paying for the duplicate requests
+    (only for the slowest requests - 5% of them with the default 95th percentile).
+
+    The duplicate requests are recorded (usage counters and history) when they complete, even after we return.
+
+    Returns:
+        tuple[LLMResponse, float]: The response, and the cost of the duplicate requests that completed before it
+        was returned (the cost of the others is only recorded).
+    """
+    first, started = _submit_request(model, prompt, user_input)
+    futures = [first]
+
+    delay = _hedge_delay(model)
+    if delay is not None:
+        # Count the delay from when the request was sent - it may wait for a free thread when many callers are busy
+        started.wait()
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            second, _ = _submit_request(model, prompt, user_input)
+            futures.append(second)
+            tracing.count("llm_hedged_requests_total", model=model)
+
+    # Use the first successful response - fail only if all requests failed
+    pending, winner, error, duplicate_cost = set(futures), None, None, 0.0
+    while pending and winner is None:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception():
+                error = future.exception()
+            elif winner is None:
+                winner = future
+            else:
+                duplicate_cost += _record_duplicate(future)
+    if winner is None:
+        raise error  # type: ignore
+    for future in pending:
+        # Record it in the current context, for the issue of the history records (see history.issue_context())
+        future.add_done_callback(functools.partial(tracing.context_runner(), _record_duplicate))
+    return winner.result(), duplicate_cost
+
+
+def _openai_chat_completion_stream(response: LLMResponse) -> Iterator[str]:
+    """Stream a chat completion from OpenAI, filling in the response as the tokens arrive.
+
+    The request is taken from the model, prompt, and user input in the response. The other fields are set when the
+    stream ends.
+    """
+    client = _get_openai_client()
+    # For streams, the timeout is the maximum time to wait for each part of the response
+    timeout, _ = _request_settings()
+
+    start_time = time.time()
+    stream = client.chat.completions.create(
+        **_openai_request_body(response.model, response.prompt, response.user_input),
+        timeout=timeout,
+        stream=True,
+        # Ask for an extra chunk at the end with the token usage (not sent by default when streaming)
+        stream_options={"include_usage": True},
+    )
+    try:
+        tokens = []
+        last_chunk = None
+        for chunk in stream:
+            last_chunk = chunk
+            if not chunk.choices:
+                continue  # The usage chunk doesn't have choices
+            token = chunk.choices[0].delta.content
+            if token:
+                if not tokens:
+                    response.time_to_first_token = time.time() - start_time
+                tokens.append(token)
+                yield token
+        response.elapsed_time = time.time() - start_time
+    finally:
+        # Return the connection to the client's pool, also when the caller stops reading before the end
+        stream.close()
+
+    response.llm_response = "".join(tokens)
+    if last_chunk is not None:
+        # Not the raw response (it was split into chunks) - keep the last one, which has the usage data
+        response.raw_response = last_chunk.model_dump()
+        if last_chunk.usage:
+            response.input_tokens = last_chunk.usage.prompt_tokens
+            response.output_tokens = last_chunk.usage.completion_tokens
+    response.cost = _openai_cost(response.input_tokens, response.output_tokens, response.model)
+
+
+class StreamedCompletion:
+    """A completion from the LLM that is streamed as it's generated.
+
+    Iterate over it to get the tokens as they arrive. Once all tokens have been read, `response` has the complete LLM
+    response, including token usage and costs.
+    """
+
+    def __init__(self, response: LLMResponse, tokens: Iterator[str]):
+        self.response = response
+        self._tokens = tokens
+
+    def __iter__(self) -> Iterator[str]:
+        return self._tokens
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens in a text (overestimates it in most cases)."""
+    return estimate_tokens_for_length(len(text))
+
+
+def estimate_tokens_for_length(length: int) -> int:
+    """Estimate the number of tokens in a text from its length, e.g. to count the tokens without building the text."""
+    return length // _CHARS_PER_TOKEN + 1
+
+
+def max_chars_for_tokens(max_tokens: int) -> int:
+    """Get the number of characters in at most a number of tokens, as estimate_tokens() counts them."""
+    # estimate_tokens() counts one more token than the whole characters per token
+    return max(0, max_tokens - 1) * _CHARS_PER_TOKEN
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Truncate a text to approximately a number of tokens (consistent with estimate_tokens())."""
+    return text[: max_chars_for_tokens(max_tokens)]
+
+
+def context_window(model: str) -> int:
+    """Get the context window size of a model, in tokens."""
+    if model not in _MODEL_DATA:
+        raise ValueError(f"Unsupported model: {model}")
+    return _MODEL_DATA[model]["context_window"]
 
 
 def models():
@@ -117,9 +432,442 @@ def models():
     return list(_MODEL_DATA.keys())
 
 
-def chat_completion(model, prompt: str, user_input: str) -> LLMResponse:
-    """Get a completion from the LLM."""
+def _record_usage(response: LLMResponse, attributes: dict, batch: bool = False):
+    """Record the tokens and costs of a response in the span attributes, in the usage counters, and in the history.
+
+    Set `batch` for responses from the Batch API (their elapsed time is the time to complete the batch).
+    """
+    attributes.update(
+        cached=response.cached,
+        input_tokens=response.input_tokens,
+        output_tokens=response.output_tokens,
+        cost=response.cost,
+        time_to_first_token=response.time_to_first_token,
+    )
+    labels = {"model": response.model}
+    tracing.count("llm_requests_total", cached=response.cached, **labels)
+    tracing.count("llm_input_tokens_total", response.input_tokens, **labels)
+    tracing.count("llm_output_tokens_total", response.output_tokens, **labels)
+    tracing.count("llm_cost_dollars_total", max(0.0, response.cost), **labels)
+    tracing.count("llm_cost_saved_dollars_total", response.cost_saved, **labels)
+    try:
+        history.record(response, batch)
+    except sqlite3.Error as ex:
+        # The call was already paid for - don't lose its response because the history database is locked or full
+        print(f"Couldn't record the call in the history: {ex}", file=sys.stderr)
+        tracing.count("history_errors_total")
+
+
+def _add_throughput(model: str, kind: str, tokens: int, seconds: float):
+    """Record the speed of one part of a response ("input" or "output")."""
+    if tokens > 0 and seconds > 0:
+        with _throughputs_lock:
+            _throughputs.setdefault((model, kind), deque(maxlen=_THROUGHPUT_SAMPLES)).append(tokens / seconds)
+
+
+def _record_throughput(response: LLMResponse):
+    """Record the speeds of a response that came from the LLM (not from the cache), for the model router."""
+    if response.cached or response.model not in _MODEL_DATA:
+        return
+    if response.time_to_first_token < response.elapsed_time:
+        # Streamed: the input is read before the first token, the output is generated after it
+        _add_throughput(response.model, "input", response.input_tokens, response.time_to_first_token)
+        output_time = response.elapsed_time - response.time_to_first_token
+    else:
+        # Not streamed: we only have the total time - subtract the time to read the input at the current speed
+        input_speed, _ = _tokens_per_second(response.model, "input")
+        output_time = response.elapsed_time - response.input_tokens / input_speed
+    _add_throughput(response.model, "output", response.output_tokens, output_time)
+
+
+def _tokens_per_second(model: str, kind: str) -> tuple[float, bool]:
+    """Get the speed of a model to read the input or generate the output ("input" or "output"), in tokens per second.
+
+    Returns:
+        tuple: The tokens per second and True if it was measured (there are enough responses), False if it's the
+        rough value in _MODEL_DATA.
+    """
+    with _throughputs_lock:
+        samples = list(_throughputs.get((model, kind), ()))
+    if len(samples) < _THROUGHPUT_MIN_SAMPLES:
+        return _MODEL_DATA[model][f"{kind}_tokens_per_second"], False
+    return tracing.percentile(samples, 50), True
+
+
+@dataclass
+class ModelEstimate:
+    """Estimated cost and response time of a request with one model."""
+
+    model: str
+    fits: bool  # The request fits in the model's context window, with room for the response
+    cost: float
+    seconds: float
+    # The speeds were measured in previous responses (otherwise they are the rough values in _MODEL_DATA)
+    measured: bool
+
+
+@dataclass
+class RoutingDecision:
+    """The model chosen for a request, why it was chosen, and the estimates for all models."""
+
+    model: str
+    reason: str
+    input_tokens: int
+    estimates: list[ModelEstimate] = field(default_factory=list)
+
+
+def route_model(prompt: str, user_input: str, latency_target: float | None = None) -> RoutingDecision:
+    """Choose the cheapest model that fits a request and is expected to respond within the latency target.
+
+    The number of tokens is estimated from the text (before sending the request) and the response time from the speed
+    of the previous responses of each model.
+
+    Args:
+        prompt (str): The system prompt.
+        user_input (str): The user input (the parsed issue and comments).
+        latency_target (float): Maximum expected response time, in seconds. None to use the `latency_target` in
+        llm.ini.
+
+    Returns:
+        RoutingDecision: The model and the reason for choosing it. If no model responds within the target, it's the
+        fastest that fits. If no model fits, it's the one with the largest context window (summarize.py splits the
+        issue into chunks).
+    """
+    if latency_target is None:
+        latency_target = _llm_setting("latency_target", _DEFAULT_LATENCY_TARGET)
+
+    with tracing.span("route_model") as attributes:
+        input_tokens = estimate_tokens(prompt) + estimate_tokens(user_input)
+        estimates = []
+        for model in _MODEL_DATA:
+            input_speed, input_measured = _tokens_per_second(model, "input")
+            output_speed, output_measured = _tokens_per_second(model, "output")
+            estimates.append(
+                ModelEstimate(
+                    model=model,
+                    fits=input_tokens + OUTPUT_TOKENS <= context_window(model),
+                    cost=_openai_cost(input_tokens, _ROUTER_OUTPUT_TOKENS, model),
+                    seconds=input_tokens / input_speed + _ROUTER_OUTPUT_TOKENS / output_speed,
+                    measured=input_measured or output_measured,
+                )
+            )
+
+        fits = [e for e in estimates if e.fits]
+        fast = [e for e in fits if e.seconds <= latency_target]
+        if fast:
+            best = min(fast, key=lambda e: e.cost)
+            reason = (
+                f"cheapest model that fits {input_tokens:,} tokens and is expected to respond within {latency_target:g}"
+                f" seconds ({best.seconds:.1f} seconds, US ${best.cost:.4f})"
+            )
+        elif fits:
+            best = min(fits, key=lambda e: e.seconds)
+            reason = (
+                f"no model that fits {input_tokens:,} tokens is expected to respond within {latency_target:g} seconds"
+                f" - fastest one ({best.seconds:.1f} seconds, US ${best.cost:.4f})"
+            )
+        else:
+            best = max(estimates, key=lambda e: (context_window(e.model), -e.cost))
+            reason = (
+                f"{input_tokens:,} tokens don't fit in any model - largest context window, to summarize the issue in"
+                " as few chunks as possible"
+            )
+        if fits and not best.measured:
+            reason += " - speed not measured yet"
+
+        attributes.update(model=best.model, input_tokens=input_tokens, reason=reason)
+        tracing.count("llm_routed_total", model=best.model)
+    return RoutingDecision(best.model, reason, input_tokens, estimates)
+
+
+def _cache_key(model: str, prompt: str, user_input: str) -> str:
+    """Get the cache key for a request: a hash of everything that affects the response."""
+    hasher = hashlib.sha256()
+    for part in (model, prompt, user_input):
+        hasher.update(part.encode("utf-8"))
+        hasher.update(b"\0")  # Separator, so that moving text from one part to the next changes the hash
+    return hasher.hexdigest()
+
+
+def response_from_dict(data: dict) -> LLMResponse:
+    """Create a response from its fields, as stored with dataclasses.asdict() (e.g. in a cache)."""
+    # Ignore fields that are no longer in the class (data stored by an older version of the code)
+    names = {f.name for f in dataclasses.fields(LLMResponse)}
+    return LLMResponse(**{name: value for name, value in data.items() if name in names})
+
+
+def _get_cached_response(key: str) -> LLMResponse | None:
+    """Get a response from the cache, marked as a cache hit, or None if it's not in the cache."""
+    cached = _response_cache.get(key)
+    if cached is None:
+        return None
+
+    response = response_from_dict(cached)
+    response.cached = True
+    response.cost_saved = response.cost
+    response.cost = 0.0  # We didn't pay for it this time
+    return response
+
+
+def missing_sections(text: str, sections: list[str]) -> list[str]:
+    """Get the markdown sections (headings) that are missing from a text, e.g. an LLM response.
+
+    Args:
+        text (str): The markdown text.
+        sections (list[str]): The section names, e.g. ["Summary", "Details"]. The case doesn't matter.
+
+    Returns:
+        list[str]: The sections that are not in the text, in the same order.
+    """
+    return [
+        section
+        for section in sections
+        if not re.search(rf"^#{{1,6}}\s*\**{re.escape(section)}\b", text, flags=re.IGNORECASE | re.MULTILINE)
+    ]
+
+
+def _cheaper_model(model: str, prompt: str, user_input: str) -> str | None:
+    """Get the cheapest model that costs less than the given one and fits the request, or None if there is none."""
+
+    def price(name: str) -> float:
+        return _MODEL_DATA[name]["input"] + _MODEL_DATA[name]["output"]
+
+    tokens = estimate_tokens(prompt) + estimate_tokens(user_input) + OUTPUT_TOKENS
+    if model not in _MODEL_DATA:
+        return None
+    candidates = [m for m in _MODEL_DATA if price(m) < price(model) and context_window(m) >= tokens]
+    return min(candidates, key=price, default=None)
+
+
+def _chat_completion(model, prompt: str, user_input: str, use_cache: bool) -> LLMResponse:
+    """Get a completion from one model (see chat_completion())."""
+    with tracing.span("chat_completion", model=model) as attributes:
+        key = _cache_key(model, prompt, user_input)
+        response = _get_cached_response(key) if use_cache else None
+        duplicate_cost = 0.0
+        if not response:
+            response, duplicate_cost = _openai_chat_completion_hedged(model, prompt, user_input)
+            _response_cache.put(key, dataclasses.asdict(response))
+            _record_throughput(response)
+        _record_usage(response, attributes)
+    # The duplicate requests were recorded on their own - the cost of the response includes them (as with the cascade)
+    response.cost += duplicate_cost
+    return response
+
+
+def chat_completion(
+    model, prompt: str, user_input: str, use_cache: bool = True, required_sections: list[str] | None = None
+) -> LLMResponse:
+    """Get a completion from the LLM.
+
+    Requests time out after the `timeout` in llm.ini. Requests that take longer than most (the `hedge_percentile` of
+    past response times in llm.ini) are sent again and the first response is used.
+
+    Args:
+        model (str): The model to use.
+        prompt (str): The system prompt.
+        user_input (str): The user input (the parsed issue and comments).
+        use_cache (bool): Return a previous response for the same model, prompt, and user input, if we have one. Set to
+        False to always get a new response from the LLM. The new response is cached in both cases.
+        required_sections (list[str]): Markdown sections the response must have. If set, a cheaper model is tried
+        first, and the requested model is used only if the cheaper model's response is missing any of the sections
+        (a cascade). The tokens and costs of the response include both requests in that case.
+
+    Returns:
+        LLMResponse: The LLM response. `cached` is True if it came from the cache. `model` is the model that created
+        the response (a cheaper model if it passed the checks).
+    """
     # Only one LLM is currently supported. This function can be extended to support multiple LLMs later.
-    if model.startswith("gpt"):
-        return _openai_chat_completion(model, prompt, user_input)
-    raise ValueError(f"Unsupported model: {model}")
+    if not model.startswith("gpt"):
+        raise ValueError(f"Unsupported model: {model}")
+
+    cheaper_model = _cheaper_model(model, prompt, user_input) if required_sections else None
+    if not cheaper_model:
+        return _chat_completion(model, prompt, user_input, use_cache)
+
+    with tracing.span("cascade", model=model, cheaper_model=cheaper_model) as attributes:
+        first = _chat_completion(cheaper_model, prompt, user_input, use_cache)
+        missing = missing_sections(first.llm_response, required_sections)  # type: ignore
+        attributes["missing_sections"] = ", ".join(missing)
+        tracing.count("llm_cascade_total", outcome="escalated" if missing else "accepted", model=cheaper_model)
+        if not missing:
+            return first
+
+        response = _chat_completion(model, prompt, user_input, use_cache)
+        # Account for the cheaper model's request in the total cost
+        response.input_tokens += first.input_tokens
+        response.output_tokens += first.output_tokens
+        response.cost += first.cost
+        response.cost_saved += first.cost_saved
+        response.cached = response.cached and first.cached
+    return response
+
+
+def chat_completion_stream(model, prompt: str, user_input: str, use_cache: bool = True) -> StreamedCompletion:
+    """Get a completion from the LLM, streaming the tokens as they are generated.
+
+    See chat_completion() for the arguments. A response from the cache is returned as a single token.
+
+    Example:
+        completion = chat_completion_stream(model, prompt, user_input)
+        for token in completion:
+            print(token, end="")
+        print(completion.response.cost)
+    """
+    if not model.startswith("gpt"):
+        raise ValueError(f"Unsupported model: {model}")
+
+    key = _cache_key(model, prompt, user_input)
+    if use_cache:
+        response = _get_cached_response(key)
+        if response:
+            with tracing.span("chat_completion", model=model, streamed=True) as attributes:
+                _record_usage(response, attributes)
+            return StreamedCompletion(response, iter([response.llm_response]))
+
+    response = LLMResponse(model=model, prompt=prompt, user_input=user_input)
+
+    def tokens() -> Iterator[str]:
+        with tracing.span("chat_completion", model=model, streamed=True) as attributes:
+            yield from _openai_chat_completion_stream(response)
+            _record_usage(response, attributes)
+            _record_throughput(response)
+        # Cache only complete responses (the caller may stop reading before the end)
+        _response_cache.put(key, dataclasses.asdict(response))
+
+    return StreamedCompletion(response, tokens())
+
+
+def get_cached_response(model: str, prompt: str, user_input: str) -> LLMResponse | None:
+    """Get the response for a request from the cache, or None if it's not in the cache (see chat_completion())."""
+    return _get_cached_response(_cache_key(model, prompt, user_input))
+
+
+@dataclass
+class BatchRequest:
+    """One request in an OpenAI batch: the arguments of chat_completion(), with an ID to find its response."""
+
+    custom_id: str
+    model: str
+    prompt: str
+    user_input: str
+
+
+def write_batch_file(path: str, requests: list[BatchRequest]):
+    """Write the requests to a JSONL file in the OpenAI Batch API format, one request per line.
+
+    The file can be checked before submitting it with submit_batch().
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        for request in requests:
+            line = {
+                "custom_id": request.custom_id,
+                "method": "POST",
+                "url": _BATCH_ENDPOINT,
+                "body": _openai_request_body(request.model, request.prompt, request.user_input),
+            }
+            f.write(json.dumps(line) + "\n")
+
+
+def submit_batch(path: str) -> str:
+    """Upload a batch file created with write_batch_file() and start the batch.
+
+    Set OPENAI_BASE_URL to use a different server (e.g. a local test server).
+
+    Returns:
+        str: The batch ID, to check its status and get the results (also later, from another process).
+    """
+    client = _get_openai_client()
+    with open(path, "rb") as f:
+        batch_file = client.files.create(file=f, purpose="batch")
+    batch = client.batches.create(
+        input_file_id=batch_file.id, endpoint=_BATCH_ENDPOINT, completion_window=_BATCH_COMPLETION_WINDOW
+    )
+    return batch.id
+
+
+def get_batch_status(batch_id: str) -> dict:
+    """Get the status of a batch (the batch object from OpenAI, as a dictionary).
+
+    The most useful fields are `status` and `request_counts` (total, completed, and failed requests).
+    """
+    return _get_openai_client().batches.retrieve(batch_id).model_dump()
+
+
+def wait_for_batch(batch_id: str, poll_interval: float = 60.0, timeout: float | None = None, progress=None) -> dict:
+    """Wait for a batch to end (completed or not).
+
+    Args:
+        batch_id (str): The batch ID from submit_batch().
+        poll_interval (float): Seconds between status checks.
+        timeout (float): Maximum seconds to wait. None to wait until the batch ends (up to its completion window).
+        progress (Callable): Called with the batch status (see get_batch_status()) after each check.
+
+    Returns:
+        dict: The final status of the batch. Check its `status` field - it may have failed or expired.
+    """
+    start_time = time.time()
+    while True:
+        status = get_batch_status(batch_id)
+        if progress:
+            progress(status)
+        if status["status"] in _BATCH_FINAL_STATES:
+            return status
+        if timeout is not None and time.time() - start_time + poll_interval > timeout:
+            raise TimeoutError(f"Batch {batch_id} did not end in {timeout:.0f} seconds (status: {status['status']})")
+        time.sleep(poll_interval)
+
+
+def _read_batch_file(client: OpenAI, file_id: str | None) -> list[dict]:
+    """Read a JSONL file from OpenAI (batch input, output, or errors)."""
+    if not file_id:
+        return []
+    return [json.loads(line) for line in client.files.content(file_id).text.splitlines() if line.strip()]
+
+
+def get_batch_results(batch_id: str) -> tuple[dict[str, LLMResponse], dict[str, str]]:
+    """Get the responses of a batch, with their costs at the batch price.
+
+    Batches that expired or were cancelled have the responses for the requests that completed before that. The
+    responses are also cached, so an interactive request for the same input gets the response from the batch.
+
+    Args:
+        batch_id (str): The batch ID from submit_batch().
+
+    Returns:
+        tuple: A dictionary of custom_id -> LLMResponse for successful requests, and a dictionary of custom_id -> error
+        message for failed requests.
+    """
+    client = _get_openai_client()
+    batch = client.batches.retrieve(batch_id)
+    # The results have only the completions - the prompt and user input are in the batch file
+    requests = {line["custom_id"]: line["body"] for line in _read_batch_file(client, batch.input_file_id)}
+    # The Batch API doesn't report the time of each request - use the time the batch took
+    elapsed_time = float((batch.completed_at or batch.expired_at or batch.cancelled_at or 0) - batch.created_at)
+    elapsed_time = max(0.0, elapsed_time)
+
+    responses, errors = {}, {}
+    with tracing.span("batch_results", batch_id=batch_id) as attributes:
+        lines = _read_batch_file(client, batch.output_file_id) + _read_batch_file(client, batch.error_file_id)
+        for line in lines:
+            custom_id = line["custom_id"]
+            result = line.get("response") or {}
+            if line.get("error") or result.get("status_code") != 200:
+                error = line.get("error") or result.get("body", {}).get("error") or {}
+                errors[custom_id] = error.get("message", f"HTTP status {result.get('status_code')}")
+                continue
+
+            body = requests[custom_id]
+            response = LLMResponse(model=body["model"], elapsed_time=elapsed_time, time_to_first_token=elapsed_time)
+            response.prompt = body["messages"][0]["content"]
+            response.user_input = body["messages"][1]["content"]
+            _fill_response(response, result["body"], batch=True)
+            _response_cache.put(
+                _cache_key(response.model, response.prompt, response.user_input), dataclasses.asdict(response)
+            )
+            # batch.py uses the issue URLs as custom IDs - record the calls for their repositories
+            with history.issue_context(custom_id):
+                _record_usage(response, {}, batch=True)
+            responses[custom_id] = response
+        attributes.update(responses=len(responses), errors=len(errors))
+    return responses, errors
@@ -0,0 +1,232 @@
+#! python
+"""HTTP service that summarizes GitHub issues, shared by all users of the Streamlit app.
+
+Without the service, each user session runs all the steps (get the issue from GitHub, parse it, and summarize it with
+the LLM). When many users open the same issue at the same time (e.g. a popular issue), each one pays for the same
+GitHub requests and LLM calls. The service runs the steps once for all of them:
+
+- Coalescing ("single flight"): concurrent requests for the same summary wait for the first one, instead of repeating
+  the work.
+- Shared cache: completed summaries are kept in memory for a short time, for requests that arrive after the first one
+  completed. After that, the GitHub and LLM caches still avoid most of the work: GitHub confirms the issue didn't
+  change without sending it again, and the LLM response comes from the cache if the input is the same.
+
+Start the service, then point the Streamlit app to it with the SUMMARY_SERVICE_URL environment variable (it can also
+be set in the .env file):
+
+    python service.py --port 8502
+    SUMMARY_SERVICE_URL=http://localhost:8502 streamlit run app.py
+
+Endpoints:
+
+    POST /summarize - JSON body: {"issue_url": "...", "model": "...", "prompt": "...", "use_cache": true}
+        Optional: "compaction" with the fields of compaction.CompactionConfig (default: the rules in llm.ini)
+    GET /metrics - the tracing metrics, in the Prometheus text format
+"""
+
+import argparse
+import dataclasses
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import compaction
+import github
+import history
+import summarize
+import tracing
+from cache import MemoryCache
+
+# How long completed summaries are kept in memory (seconds) and how many - enough to absorb bursts of requests for the
+# same issue, short enough to pick up new comments soon
+_RESULT_TTL = 60
+_RESULT_MAX_ENTRIES = 200
+# Time to wait for the service to summarize an issue - large issues take a while
+_CLIENT_TIMEOUT = 300
+
+
+class _SingleFlight:
+    """Run a function once for concurrent calls with the same key - the other callers wait and share the result."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict[str, dict] = {}
+
+    def do(self, key: str, function) -> tuple:
+        """Call the function, or wait for the call in flight with the same key.
+
+        Returns:
+            tuple: The result of the function (or the exception it raised is raised) and True if the result came from
+            a call made by another caller.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {"done": threading.Event(), "result": None, "error": None}
+
+        if not leader:
+            call["done"].wait()
+        else:
+            try:
+                call["result"] = function()
+            except Exception as ex:  # Give the error to all callers
+                call["error"] = ex
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call["done"].set()
+
+        if call["error"]:
+            raise call["error"]
+        return call["result"], not leader
+
+
+_single_flight = _SingleFlight()
+_results = MemoryCache(_RESULT_MAX_ENTRIES, _RESULT_TTL)
+
+
+def request_key(issue_url: str, model: str, prompt: str, config: compaction.CompactionConfig, use_cache: bool) -> str:
+    """Get the key for a summary request: a hash of everything that affects the result."""
+    data = [issue_url, model, prompt, dataclasses.asdict(config), use_cache]
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _summarize(issue_url: str, model: str, prompt: str, config: compaction.CompactionConfig, use_cache: bool) -> dict:
+    """Run all steps to summarize an issue (see summarize_issue())."""
+    with tracing.trace() as trace, history.issue_context(issue_url):
+        issue = github.get_issue(issue_url)
+        comments = github.get_issue_comments(issue)
+        compact_issue, compact_comments, report = compaction.compact(issue, comments, config)
+        parsed_issue = github.parse_issue(compact_issue)
+        parsed_comments = github.parse_comments(compact_comments)
+        user_input = f"{parsed_issue}\n\n{parsed_comments}"
+        response = summarize.summarize_issue(model, prompt, compact_issue, compact_comments, user_input, use_cache)
+    return {
+        "issue": issue,
+        "comments": comments,
+        "parsed_issue": parsed_issue,
+        "parsed_comments": parsed_comments,
+        "compaction": dataclasses.asdict(report),
+        "response": dataclasses.asdict(response),
+        "spans": [dataclasses.asdict(span) for span in trace.spans],
+    }
+
+
+def summarize_issue(
+    issue_url: str,
+    model: str,
+    prompt: str,
+    config: compaction.CompactionConfig | None = None,
+    use_cache: bool = True,
+) -> dict:
+    """Summarize an issue, sharing the work with concurrent and recent requests for the same summary.
+
+    Args:
+        issue_url (str): The issue URL.
+        model (str): The model to use.
+        prompt (str): The system prompt.
+        config (compaction.CompactionConfig): The compaction rules. None to use the rules in llm.ini.
+        use_cache (bool): Use cached results (recent results and LLM responses). The GitHub data is always checked.
+
+    Returns:
+        dict: The GitHub data ("issue", "comments"), the parsed data ("parsed_issue", "parsed_comments"), the
+        compaction report ("compaction"), the LLM response ("response"), and the steps that produced them ("spans"),
+        all as JSON-compatible values. "coalesced" is True if the result was shared with another request and "cached"
+        is True if it came from the recent results.
+    """
+    config = config or compaction.load_config()
+    key = request_key(issue_url, model, prompt, config, use_cache)
+    result = _results.get(key) if use_cache else None
+    if result is not None:
+        tracing.count("service_requests_total", outcome="cached")
+        return {**result, "coalesced": False, "cached": True}
+
+    result, coalesced = _single_flight.do(key, lambda: _summarize(issue_url, model, prompt, config, use_cache))
+    if not coalesced:
+        _results.put(key, result)
+    tracing.count("service_requests_total", outcome="coalesced" if coalesced else "summarized")
+    return {**result, "coalesced": coalesced, "cached": False}
+
+
+def summarize_remote(
+    service_url: str,
+    issue_url: str,
+    model: str,
+    prompt: str,
+    config: compaction.CompactionConfig | None = None,
+    use_cache: bool = True,
+) -> dict:
+    """Summarize an issue with the service running at the given URL. See summarize_issue() for the arguments."""
+    body = {"issue_url": issue_url, "model": model, "prompt": prompt, "use_cache": use_cache}
+    if config:
+        body["compaction"] = dataclasses.asdict(config)
+    response = requests.post(f"{service_url.rstrip('/')}/summarize", json=body, timeout=_CLIENT_TIMEOUT)
+    if response.status_code != 200:
+        try:
+            error = response.json()["error"]
+        except (ValueError, KeyError):
+            error = response.text
+        raise RuntimeError(f"Summary service error (HTTP {response.status_code}): {error}")
+    return response.json()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Handle the HTTP requests to the service."""
+
+    def _send(self, status: int, body: str, content_type: str = "application/json"):
+        """Send a response."""
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        """Handle GET requests (metrics)."""
+        if self.path == "/metrics":
+            self._send(200, tracing.export_prometheus(), "text/plain; version=0.0.4")
+        else:
+            self._send(404, json.dumps({"error": "Not found"}))
+
+    def do_POST(self):
+        """Handle POST requests (summaries)."""
+        if self.path != "/summarize":
+            self._send(404, json.dumps({"error": "Not found"}))
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            config = compaction.CompactionConfig(**body["compaction"]) if "compaction" in body else None
+            args = (body["issue_url"], body["model"], body["prompt"], config, body.get("use_cache", True))
+        except (ValueError, KeyError, TypeError) as ex:
+            self._send(400, json.dumps({"error": f"Invalid request: {ex}"}))
+            return
+        try:
+            self._send(200, json.dumps(summarize_issue(*args)))
+        except Exception as ex:  # Report the error to the client and keep serving
+            self._send(500, json.dumps({"error": f"{type(ex).__name__}: {ex}"}))
+
+
+def main():
+    """Run the service."""
+    parser = argparse.ArgumentParser(description="Summarize GitHub issues as an HTTP service.")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8502, help="port to listen on")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), _Handler)
+    server.daemon_threads = True
+    print(f"Summary service listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
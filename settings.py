@@ -0,0 +1,68 @@
+"""Read the configuration files (.env and llm.ini) only when they change.
+
+The programs allow changing the configuration without restarting them (e.g. changing the API key in the .env file or
+the prompt in llm.ini). Reading and parsing the files before each request is wasteful, especially when summarizing
+many issues concurrently, so we check the modification time of the files and read them again only when it changes.
+"""
+
+import configparser
+import os
+import threading
+
+import dotenv
+
+_ENV_FILE = ".env"
+_CONFIG_FILE = "llm.ini"
+
+_lock = threading.Lock()
+# Modification time of the .env file when it was loaded, or None if it was not loaded yet
+_env_mtime: int | None = None
+# Parsed .ini files, with the modification time of the file when it was parsed, keyed by the file path
+_configs: dict[str, tuple[int | None, configparser.ConfigParser]] = {}
+
+
+def file_mtime(path: str) -> int | None:
+    """Get the modification time of a file in nanoseconds, or None if the file doesn't exist."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def load_env():
+    """Load the .env file into the environment variables if it changed since it was last loaded.
+
+    The values in the .env file override the environment variables, to allow key changes without restarting the
+    program.
+    """
+    global _env_mtime
+    mtime = file_mtime(_ENV_FILE)
+    with _lock:
+        if mtime is None or mtime == _env_mtime:
+            return
+        dotenv.load_dotenv(_ENV_FILE, override=True)
+        _env_mtime = mtime
+
+
+def read_config(path: str = _CONFIG_FILE) -> configparser.ConfigParser:
+    """Get the parsed .ini file, reading it again only if it changed since it was last read.
+
+    The parsed file is shared by all callers. Don't change it.
+    """
+    mtime = file_mtime(path)
+    with _lock:
+        cached = _configs.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        config = configparser.ConfigParser()
+        config.read(path)
+        _configs[path] = (mtime, config)
+        return config
+
+
+def version() -> tuple[int | None, int | None]:
+    """Get the modification times of the .env and llm.ini files - changes when any of them changes.
+
+    Use it to rebuild objects that depend on the configuration (e.g. the LLM client) only when it changes.
+    """
+    return file_mtime(_ENV_FILE), file_mtime(_CONFIG_FILE)
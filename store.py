@@ -0,0 +1,303 @@
+#! python
+"""Local store of GitHub issues and comments, to search and summarize them without requesting them from GitHub.
+
+The store is a SQLite database. It's filled by ingesting whole repositories: all issues (open and closed) and their
+comments are downloaded in bulk, 100 per request, instead of one issue at a time. Later ingests of the same repository
+get only the issues and comments updated since the previous one.
+
+The issues and comments are stored as GitHub returns them (the JSON response), so they can be used with the same
+functions that use the GitHub data, e.g. github.parse_issue() and summarize.summarize_issue(). A full-text index over
+the issue titles and bodies allows searching thousands of issues in milliseconds, to choose which ones to summarize.
+
+Usage:
+
+    python store.py ingest openai/openai-python
+    python store.py search "streaming timeout" --repo openai/openai-python
+    python store.py search "streaming timeout" --urls > issues.txt
+    python batch.py issues.txt --store issues.db
+
+Limitations: deleted issues and comments stay in the store (GitHub doesn't report deletions). Pull requests are not
+stored.
+"""
+
+import argparse
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+
+import github
+
+_DEFAULT_PATH = "issues.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS issues (
+    url TEXT PRIMARY KEY,  -- GitHub API URL of the issue
+    repo TEXT NOT NULL,  -- GitHub API URL of the repository (the "repository_url" field of the issue)
+    number INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    state TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    data TEXT NOT NULL  -- The issue as returned by GitHub (JSON)
+);
+CREATE TABLE IF NOT EXISTS comments (
+    id INTEGER PRIMARY KEY,  -- GitHub comment ID
+    issue_url TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    data TEXT NOT NULL  -- The comment as returned by GitHub (JSON)
+);
+CREATE INDEX IF NOT EXISTS comments_issue_url ON comments (issue_url, created_at);
+-- Last update time of the most recent issue and comment ingested, to start the next ingest from there
+CREATE TABLE IF NOT EXISTS sync (
+    repo TEXT PRIMARY KEY,
+    issues_since TEXT NOT NULL DEFAULT '',
+    comments_since TEXT NOT NULL DEFAULT ''
+);
+-- The rowid of each row is the rowid of the issue in the issues table
+CREATE VIRTUAL TABLE IF NOT EXISTS issues_fts USING fts5(url UNINDEXED, title, body);
+"""
+# Stored in the database (PRAGMA user_version) - stores created by older versions are upgraded when they're opened
+# 1: the full-text index rows have the rowid of their issue (they were found by URL, which scans the whole index)
+_SCHEMA_VERSION = 1
+
+# Weight of matches in the title relative to matches in the body when ranking search results
+_TITLE_WEIGHT = 10.0
+
+
+@dataclass
+class IngestResult:
+    """Number of issues and comments added or updated by an ingest."""
+
+    issues: int = 0
+    comments: int = 0
+    elapsed_time: float = 0.0
+
+
+@dataclass
+class SearchResult:
+    """An issue that matches a search."""
+
+    url: str  # GitHub API URL - use it to get the issue from the store or from GitHub
+    html_url: str
+    number: int
+    title: str
+    state: str
+    updated_at: str
+    snippet: str  # Part of the title or body that matches, with the matching words in [brackets]
+
+
+class IssueStore:
+    """SQLite store of GitHub issues and comments. Safe to use from multiple threads."""
+
+    def __init__(self, path: str = _DEFAULT_PATH):
+        """Open the store, creating it if it doesn't exist.
+
+        Args:
+            path (str): Path to the SQLite database file.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.executescript(_SCHEMA)
+            if self._db.execute("PRAGMA user_version").fetchone()[0] < _SCHEMA_VERSION:
+                self._rebuild_search_index()
+                self._db.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+
+    def _rebuild_search_index(self):
+        """Index all issues for full-text search again. Must be called with the lock held, in a transaction."""
+        self._db.execute("DELETE FROM issues_fts")
+        self._db.execute(
+            "INSERT INTO issues_fts (rowid, url, title, body)"
+            " SELECT rowid, url, title, coalesce(json_extract(data, '$.body'), '') FROM issues"
+        )
+
+    def close(self):
+        """Close the store."""
+        with self._lock:
+            self._db.close()
+
+    def _put_issue(self, issue: dict):
+        """Add or update an issue. Must be called with the lock held, in a transaction."""
+        url = issue["url"]
+        # Update in place (INSERT OR REPLACE would delete the row and give it a new rowid, the key of the search index)
+        self._db.execute(
+            "INSERT INTO issues (url, repo, number, title, state, updated_at, data) VALUES (?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (url) DO UPDATE SET repo = excluded.repo, number = excluded.number, title = excluded.title,"
+            " state = excluded.state, updated_at = excluded.updated_at, data = excluded.data",
+            (
+                url,
+                issue["repository_url"],
+                issue["number"],
+                issue["title"],
+                issue["state"],
+                issue["updated_at"],
+                json.dumps(issue),
+            ),
+        )
+        (rowid,) = self._db.execute("SELECT rowid FROM issues WHERE url = ?", (url,)).fetchone()
+        self._db.execute("DELETE FROM issues_fts WHERE rowid = ?", (rowid,))
+        self._db.execute(
+            "INSERT INTO issues_fts (rowid, url, title, body) VALUES (?, ?, ?, ?)",
+            (rowid, url, issue["title"], issue["body"] or ""),
+        )
+
+    def _put_comment(self, comment: dict) -> bool:
+        """Add or update a comment, if its issue is in the store. Must be called with the lock held, in a transaction.
+
+        Returns:
+            bool: True if the comment was stored, False if its issue is not in the store (e.g. it's a pull request).
+        """
+        cursor = self._db.execute(
+            "INSERT OR REPLACE INTO comments (id, issue_url, created_at, data)"
+            " SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM issues WHERE url = ?)",
+            (comment["id"], comment["issue_url"], comment["created_at"], json.dumps(comment), comment["issue_url"]),
+        )
+        return cursor.rowcount > 0
+
+    def _update_sync(self, repo: str, column: str, since: str):
+        """Record the update time to start the next ingest from. Must be called with the lock held, in a transaction."""
+        self._db.execute("INSERT OR IGNORE INTO sync (repo) VALUES (?)", (repo,))
+        self._db.execute(f"UPDATE sync SET {column} = ? WHERE repo = ?", (since, repo))
+
+    def _get_sync(self, repo: str) -> tuple[str, str]:
+        """Get the update times to start the next ingest from (empty strings if the repository was not ingested)."""
+        with self._lock:
+            row = self._db.execute("SELECT issues_since, comments_since FROM sync WHERE repo = ?", (repo,)).fetchone()
+        return row or ("", "")
+
+    def ingest_repo(self, repo: str, full: bool = False) -> IngestResult:
+        """Download the issues and comments of a repository into the store.
+
+        Each page is saved as it arrives, so an interrupted ingest keeps what it downloaded and the next one continues
+        from there.
+
+        Args:
+            repo (str): Repository in the form "user/repo" or full repository URL.
+            full (bool): Download all issues and comments. Otherwise, download only the ones updated since the
+            previous ingest of the repository (all of them if it's the first one).
+
+        Returns:
+            IngestResult: Number of issues and comments added or updated.
+        """
+        start_time = time.time()
+        result = IngestResult()
+        repo_url = github.get_repo_api_url(repo)
+        issues_since, comments_since = ("", "") if full else self._get_sync(repo_url)
+
+        # Issues first - comments are stored only for issues in the store
+        for page in github.iter_repo_issues(repo, issues_since):
+            with self._lock, self._db:
+                for issue in page:
+                    self._put_issue(issue)
+                    issues_since = max(issues_since, issue["updated_at"])
+                self._update_sync(repo_url, "issues_since", issues_since)
+            result.issues += len(page)
+
+        for page in github.iter_repo_comments(repo, comments_since):
+            with self._lock, self._db:
+                for comment in page:
+                    result.comments += self._put_comment(comment)
+                    comments_since = max(comments_since, comment["updated_at"])
+                self._update_sync(repo_url, "comments_since", comments_since)
+
+        result.elapsed_time = time.time() - start_time
+        return result
+
+    def get_issue(self, repo: str, issue_id: str = "") -> dict | None:
+        """Get an issue from the store, accepting the same arguments as github.get_issue().
+
+        Returns:
+            dict: Issue data, as returned by GitHub, or None if the issue is not in the store.
+        """
+        url = github.get_issue_api_url(repo, issue_id)
+        with self._lock:
+            row = self._db.execute("SELECT data FROM issues WHERE url = ?", (url,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_issue_comments(self, issue: dict) -> list:
+        """Get the comments of an issue from the store.
+
+        Args:
+            issue (dict): Issue data, as returned by GitHub or by get_issue().
+
+        Returns:
+            list: Comments data, in chronological order (same as github.get_issue_comments()).
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT data FROM comments WHERE issue_url = ? ORDER BY created_at, id", (issue["url"],)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def search(self, query: str, repo: str = "", limit: int = 20) -> list[SearchResult]:
+        """Search the titles and bodies of the issues in the store.
+
+        Args:
+            query (str): Words to search for, in the SQLite FTS5 query syntax, e.g. `streaming timeout` (both words),
+            `"read timeout"` (phrase), `timeout OR hang`, `stream*` (prefix).
+            repo (str): Search only this repository ("user/repo" or full repository URL). Empty to search all.
+            limit (int): Maximum number of results.
+
+        Returns:
+            list[SearchResult]: Matching issues, best matches first.
+        """
+        sql = (
+            "SELECT i.url, json_extract(i.data, '$.html_url'), i.number, i.title, i.state, i.updated_at,"
+            " snippet(issues_fts, -1, '[', ']', '...', 16)"
+            " FROM issues_fts JOIN issues i ON i.rowid = issues_fts.rowid"
+            " WHERE issues_fts MATCH ?"
+        )
+        params: list = [query]
+        if repo:
+            sql += " AND i.repo = ?"
+            params.append(github.get_repo_api_url(repo))
+        sql += f" ORDER BY bm25(issues_fts, 0, {_TITLE_WEIGHT}, 1.0) LIMIT ?"
+        params.append(limit)
+
+        try:
+            with self._lock:
+                rows = self._db.execute(sql, params).fetchall()
+        except sqlite3.OperationalError as ex:
+            raise ValueError(f"Invalid search query: {query} ({ex})") from ex
+        return [SearchResult(*row) for row in rows]
+
+
+def main():
+    """Ingest and search issues from the command line."""
+    parser = argparse.ArgumentParser(description="Store GitHub issues locally and search them.")
+    parser.add_argument("--db", default=_DEFAULT_PATH, help="SQLite database file")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest = commands.add_parser("ingest", help="download the issues and comments of repositories")
+    ingest.add_argument("repos", nargs="+", help="repositories in the form user/repo")
+    ingest.add_argument("--full", action="store_true", help="download everything, not only what changed")
+    search = commands.add_parser("search", help="search the issues in the store")
+    search.add_argument("query", help='words to search for, e.g. "streaming timeout"')
+    search.add_argument("--repo", default="", help="search only this repository")
+    search.add_argument("--limit", type=int, default=20, help="maximum number of results")
+    search.add_argument("--urls", action="store_true", help="show only the issue URLs (e.g. to use with batch.py)")
+    args = parser.parse_args()
+
+    store = IssueStore(args.db)
+    if args.command == "ingest":
+        for repo in args.repos:
+            print(f"Ingesting {repo}...")
+            r = store.ingest_repo(repo, args.full)
+            print(f"{r.issues:,} issues and {r.comments:,} comments added or updated in {r.elapsed_time:.1f} seconds")
+    else:
+        start_time = time.time()
+        results = store.search(args.query, args.repo, args.limit)
+        elapsed_time = time.time() - start_time
+        for r in results:
+            if args.urls:
+                print(r.html_url)
+            else:
+                print(f"#{r.number} [{r.state}] {r.title}\n    {r.html_url}\n    {r.snippet}")
+        if not args.urls:
+            print(f"{len(results)} results in {elapsed_time * 1000:.0f} ms")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
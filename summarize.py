@@ -0,0 +1,395 @@
+"""Summarize issues that may not fit in the model's context window.
+
+Issues that fit in the context window are summarized in one request, as usual. Larger issues are summarized with a
+map-reduce approach:
+
+1. Map: split the comments into chunks that fit in the context window (at comment boundaries, never in the middle of a
+   comment) and summarize each chunk in parallel. Each chunk includes the issue to give the LLM context.
+2. Reduce: summarize the issue and the chunk summaries with the original prompt, producing the same sections as a
+   summary done in one request. If there are too many chunk summaries for one request, they are summarized in chunks
+   again (in levels) until they fit.
+
+This allows summarizing large issues with smaller (cheaper and faster) models, at the cost of more requests.
+
+Issues that were summarized before can be summarized incrementally: we send the previous summary and only the comments
+added or edited since then, and ask the LLM to update the summary.
+"""
+
+import dataclasses
+import os
+import time
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+import github
+import llm
+import settings
+import tracing
+from cache import DiskCache
+
+# Number of chunks summarized in parallel
+_MAX_MAP_WORKERS = 4
+
+# The reduce step uses the original prompt, so the map step must preserve what it asks for in the comments section
+_MAP_PROMPT = """You are an experienced developer familiar with GitHub issues.
+    The following text was parsed from a GitHub issue and some of its comments.
+    Summarize only the comments, in chronological order. For each comment, list the date/time, the author, and a
+    summary of the comment in one or two sentences. Quote code snippets if they are relevant.
+    Don't waste words. Use short, clear, complete sentences. Use active voice."""
+
+# Appended to the user's prompt when updating a previous summary with new comments
+_UPDATE_INSTRUCTIONS = """
+    The text has a summary you created earlier from the issue and its comments, followed by the comments added or
+    edited after you created that summary.
+    Update the summary with the information in these comments. Keep the same sections and format.
+    Add the new comments to the comments table. Keep everything in the earlier summary that is still accurate."""
+
+# The last summary of each issue, to update it incrementally
+_SUMMARIES_DIR = os.path.join(".cache", "summaries")
+_SUMMARIES_MAX_ENTRIES = 5000
+_summaries = DiskCache(_SUMMARIES_DIR, max_entries=_SUMMARIES_MAX_ENTRIES)
+
+_TRUNCATED = "\n[...truncated to fit in the context window...]"
+
+
+def _input_budget(model: str, prompt: str) -> int:
+    """Get the number of tokens available for the user input, for a model and prompt."""
+    return llm.context_window(model) - llm.estimate_tokens(prompt) - llm.OUTPUT_TOKENS
+
+
+def fits_context(model: str, prompt: str, user_input: str) -> bool:
+    """Check if a request fits in the context window of a model, leaving room for the response."""
+    return llm.estimate_tokens(user_input) <= _input_budget(model, prompt)
+
+
+def _truncate_body(data: dict, budget: int, parse) -> dict:
+    """Truncate the body of an issue or comment so that its parsed text fits in the token budget.
+
+    Args:
+        data (dict): Issue or comment data, as returned by GitHub (the JSON response).
+        budget (int): Maximum number of tokens in the parsed text.
+        parse (Callable): The function that parses the data (github.parse_issue or a function that parses a comment).
+    """
+    overhead = llm.estimate_tokens(parse({**data, "body": _TRUNCATED}))
+    body = llm.truncate_to_tokens(data["body"] or "", budget - overhead)
+    return {**data, "body": body + _TRUNCATED}
+
+
+def _parse_comment(comment: dict) -> str:
+    """Parse one comment (to count its tokens - iter_parsed_comments() isn't recorded as a step)."""
+    return "".join(github.iter_parsed_comments([comment]))
+
+
+def _parse_issue_for_chunks(model: str, issue: dict) -> str:
+    """Parse the issue to include in each chunk, truncating it to leave at least half of the context for comments."""
+    with tracing.suppress():
+        parsed_issue = github.parse_issue(issue)
+        budget = _input_budget(model, _MAP_PROMPT) // 2
+        if llm.estimate_tokens(parsed_issue) <= budget:
+            return parsed_issue
+        return github.parse_issue(_truncate_body(issue, budget, github.parse_issue))
+
+
+def split_comments(comments: list, budget: int) -> list[list]:
+    """Split the comments into chunks that fit in the token budget, without splitting comments.
+
+    Comments that don't fit in the budget by themselves are truncated.
+
+    Args:
+        comments (list): Comments data, as returned by GitHub (the JSON response).
+        budget (int): Maximum number of tokens in each chunk (after parsing the comments).
+
+    Returns:
+        list[list]: The chunks, in the same order as the comments.
+    """
+    chunks = []
+    chunk, chunk_tokens = [], 0
+    for comment in comments:
+        tokens = llm.estimate_tokens(_parse_comment(comment))
+        if tokens > budget:
+            comment = _truncate_body(comment, budget, _parse_comment)
+            tokens = llm.estimate_tokens(_parse_comment(comment))
+        if chunk and chunk_tokens + tokens > budget:
+            chunks.append(chunk)
+            chunk, chunk_tokens = [], 0
+        chunk.append(comment)
+        chunk_tokens += tokens
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def split_summaries(summaries: list[str], budget: int) -> list[list[str]]:
+    """Split the chunk summaries into groups that fit in the token budget, as split_comments() does with comments."""
+    groups = []
+    group, group_tokens = [], 0
+    for summary in summaries:
+        summary = llm.truncate_to_tokens(summary, budget)
+        tokens = llm.estimate_tokens(summary)
+        if group and group_tokens + tokens > budget:
+            groups.append(group)
+            group, group_tokens = [], 0
+        group.append(summary)
+        group_tokens += tokens
+    if group:
+        groups.append(group)
+    return groups
+
+
+def _summaries_input(parsed_issue: str, summaries: list[str]) -> str:
+    """Create the user input with the issue and the summaries of its comments."""
+    joined = "\n".join(summaries)
+    return (
+        f"{parsed_issue}\n"
+        f"The comments were too long to include. These are their summaries, in chronological order (between '''):\n"
+        f"'''\n{joined}\n'''\n"
+    )
+
+
+def _summarize_all(model: str, inputs: list[str], use_cache: bool) -> list[llm.LLMResponse]:
+    """Summarize the inputs with the map prompt, in parallel."""
+    with ThreadPoolExecutor(max_workers=_MAX_MAP_WORKERS) as executor:
+        # Run in the current context to record the requests in the current trace
+        futures = [
+            executor.submit(tracing.context_runner(), llm.chat_completion, model, _MAP_PROMPT, user_input, use_cache)
+            for user_input in inputs
+        ]
+        return [future.result() for future in futures]
+
+
+def _map(model: str, prompt: str, issue: dict, comments: list, use_cache: bool) -> tuple[str, list[llm.LLMResponse]]:
+    """Summarize the comments in chunks and create the user input for the reduce step.
+
+    If the chunk summaries don't fit in the reduce request (with `prompt`), they are summarized in chunks again, until
+    they fit.
+
+    Returns:
+        tuple: The user input for the reduce step and the LLM responses for the chunks (of all levels).
+    """
+    parsed_issue = _parse_issue_for_chunks(model, issue)
+    budget = _input_budget(model, _MAP_PROMPT) - llm.estimate_tokens(parsed_issue)
+    chunks = split_comments(comments, budget)
+    inputs = [f"{parsed_issue}\n{github.parse_comments(chunk)}" for chunk in chunks]
+    responses = _summarize_all(model, inputs, use_cache)
+
+    summaries = [r.llm_response for r in responses]
+    reduce_input = _summaries_input(parsed_issue, summaries)
+    # Leave room for the text that introduces the summaries
+    summaries_budget = budget - llm.estimate_tokens(_summaries_input("", []))
+    while not fits_context(model, prompt, reduce_input):
+        groups = split_summaries(summaries, summaries_budget)
+        if len(groups) == len(summaries):
+            # Each summary fills a chunk by itself - summarizing them again wouldn't make them fewer
+            reduce_budget = _input_budget(model, prompt) - llm.estimate_tokens(_summaries_input(parsed_issue, []))
+            reduce_input = _summaries_input(parsed_issue, [llm.truncate_to_tokens("\n".join(summaries), reduce_budget)])
+            break
+        level = _summarize_all(model, [_summaries_input(parsed_issue, group) for group in groups], use_cache)
+        responses += level
+        summaries = [r.llm_response for r in level]
+        reduce_input = _summaries_input(parsed_issue, summaries)
+    return reduce_input, responses
+
+
+def _combine(response: llm.LLMResponse, map_responses: list[llm.LLMResponse], start_time: float):
+    """Add the usage and costs of the map step to the response of the reduce step."""
+    reduce_ttft = response.time_to_first_token - response.elapsed_time  # Negative offset from the end of the reduce
+    response.elapsed_time = time.time() - start_time
+    response.time_to_first_token = max(0.0, response.elapsed_time + reduce_ttft)
+    for r in map_responses:
+        response.input_tokens += r.input_tokens
+        response.output_tokens += r.output_tokens
+        response.cost += r.cost
+        response.cost_saved += r.cost_saved
+    response.cached = response.cached and all(r.cached for r in map_responses)
+    response.raw_response = {"map": [r.raw_response for r in map_responses], "reduce": response.raw_response}
+
+
+def choose_model(model: str, prompt: str, user_input: str) -> tuple[str, str]:
+    """Choose the model for a request if the model is llm.AUTO_MODEL (see llm.route_model()).
+
+    Returns:
+        tuple: The model to use and why it was chosen (empty if it was not chosen automatically).
+    """
+    if model != llm.AUTO_MODEL:
+        return model, ""
+    decision = llm.route_model(prompt, user_input)
+    return decision.model, decision.reason
+
+
+def _required_sections(prompt: str) -> list[str] | None:
+    """Get the sections the summary must have to accept it from a cheaper model (see llm.chat_completion()).
+
+    Returns:
+        list[str]: The `required_sections` in llm.ini that the prompt asks for, or None if the cascade is disabled.
+        Sections the prompt doesn't mention are skipped, in case the user changed the prompt.
+    """
+    config = settings.read_config()
+    if "LLM" not in config or not config["LLM"].getboolean("cascade", fallback=False):
+        return None
+    sections = [s.strip() for s in config["LLM"].get("required_sections", "").split(",") if s.strip()]
+    return [s for s in sections if s.lower() in prompt.lower()] or None
+
+
+def summarize_issue(
+    model: str, prompt: str, issue: dict, comments: list, user_input: str = "", use_cache: bool = True
+) -> llm.LLMResponse:
+    """Summarize an issue and its comments, splitting them into chunks if they don't fit in the context window.
+
+    Args:
+        model (str): The model to use, or llm.AUTO_MODEL to choose it based on the size of the issue.
+        prompt (str): The system prompt.
+        issue (dict): Issue data, as returned by GitHub (the JSON response).
+        comments (list): Comments data, as returned by GitHub (the JSON response).
+        user_input (str): The parsed issue and comments, if the caller already has them.
+        use_cache (bool): See llm.chat_completion().
+
+    Returns:
+        llm.LLMResponse: The LLM response. If the issue was split into chunks, the tokens and costs include all
+        requests and `user_input` is the input of the final (reduce) request.
+    """
+    user_input = user_input or f"{github.parse_issue(issue)}\n{github.parse_comments(comments)}"
+    model, routing_reason = choose_model(model, prompt, user_input)
+    sections = _required_sections(prompt)
+    if fits_context(model, prompt, user_input):
+        response = llm.chat_completion(model, prompt, user_input, use_cache, sections)
+    else:
+        start_time = time.time()
+        reduce_input, map_responses = _map(model, prompt, issue, comments, use_cache)
+        response = llm.chat_completion(model, prompt, reduce_input, use_cache, sections)
+        _combine(response, map_responses, start_time)
+    response.routing_reason = routing_reason
+    return response
+
+
+def summarize_issue_stream(
+    model: str, prompt: str, issue: dict, comments: list, user_input: str = "", use_cache: bool = True
+) -> llm.StreamedCompletion:
+    """Summarize an issue and its comments, streaming the response.
+
+    See summarize_issue() for the arguments. If the issue is split into chunks, the chunks are summarized when the
+    caller starts reading the tokens and the final (reduce) request is streamed.
+    """
+    user_input = user_input or f"{github.parse_issue(issue)}\n{github.parse_comments(comments)}"
+    model, routing_reason = choose_model(model, prompt, user_input)
+    if fits_context(model, prompt, user_input):
+        completion = llm.chat_completion_stream(model, prompt, user_input, use_cache)
+        completion.response.routing_reason = routing_reason
+        return completion
+
+    response = llm.LLMResponse(model=model, prompt=prompt, routing_reason=routing_reason)
+
+    def tokens() -> Iterator[str]:
+        start_time = time.time()
+        reduce_input, map_responses = _map(model, prompt, issue, comments, use_cache)
+        completion = llm.chat_completion_stream(model, prompt, reduce_input, use_cache)
+        yield from completion
+        # Copy into the response the caller already has
+        for name, value in vars(completion.response).items():
+            setattr(response, name, value)
+        response.routing_reason = routing_reason
+        _combine(response, map_responses, start_time)
+
+    return llm.StreamedCompletion(response, tokens())
+
+
+def _summary_key(model: str, prompt: str, issue: dict) -> str:
+    """Get the key for the last summary of an issue - a summary can be updated only with the same model and prompt."""
+    return f"{issue['url']}\0{model}\0{prompt}"
+
+
+def _comment_time(comment: dict) -> str:
+    """Get the time a comment was last changed (ISO 8601 strings in UTC - they can be compared as strings)."""
+    return comment.get("updated_at") or comment["created_at"]
+
+
+def _save_summary(model: str, prompt: str, issue: dict, response: llm.LLMResponse, last_comment_at: str):
+    """Save the summary of an issue to update it incrementally later."""
+    summary = {
+        "response": dataclasses.asdict(response),
+        "last_comment_at": last_comment_at,
+        "issue_updated_at": issue.get("updated_at", ""),
+    }
+    _summaries.put(_summary_key(model, prompt, issue), summary)
+
+
+def get_new_comments(model: str, prompt: str, issue: dict, comments: list | None = None) -> tuple[list, dict | None]:
+    """Get the comments added or edited since the last time the issue was summarized with this model and prompt.
+
+    Args:
+        model (str): The model to use.
+        prompt (str): The system prompt.
+        issue (dict): Issue data, as returned by GitHub (the JSON response).
+        comments (list): All comments of the issue, if we already have them (e.g. from the local issue store). The new
+        comments are selected from them instead of requesting them from GitHub.
+
+    Returns:
+        tuple: The comments and the previous summary. If the issue was not summarized before, the previous summary is
+        None and the comments are all comments.
+    """
+    previous = _summaries.get(_summary_key(model, prompt, issue))
+    if previous is None or not previous["last_comment_at"]:
+        # Not summarized before or had no comments - there is no time to start from
+        return (github.get_issue_comments(issue) if comments is None else comments), previous
+
+    since = previous["last_comment_at"]
+    if comments is None:
+        comments = github.get_issue_comments(issue, since=since)
+    # GitHub includes comments changed at the "since" time - we already have those
+    return [c for c in comments if _comment_time(c) > since], previous
+
+
+def summarize_issue_incremental(
+    model: str,
+    prompt: str,
+    issue: dict,
+    comments: list,
+    previous: dict | None,
+    use_cache: bool = True,
+    all_comments: list | None = None,
+) -> llm.LLMResponse:
+    """Summarize an issue, updating the previous summary with the new comments if there is one.
+
+    Args:
+        model (str): The model to use.
+        prompt (str): The system prompt.
+        issue (dict): Issue data, as returned by GitHub (the JSON response).
+        comments (list): Comments from get_new_comments().
+        previous (dict): Previous summary from get_new_comments().
+        use_cache (bool): See llm.chat_completion().
+        all_comments (list): All comments of the issue, if we already have them (e.g. from the local issue store).
+        They are used instead of requesting them from GitHub if there are too many new comments to update the summary.
+
+    Returns:
+        llm.LLMResponse: The LLM response. If nothing changed since the previous summary, it's the previous response,
+        marked as cached.
+    """
+    last_comment_at = max((_comment_time(c) for c in comments), default="")
+
+    if previous is None:
+        response = summarize_issue(model, prompt, issue, comments, use_cache=use_cache)
+        _save_summary(model, prompt, issue, response, last_comment_at)
+        return response
+
+    previous_response = llm.response_from_dict(previous["response"])
+    if not comments and issue.get("updated_at", "") == previous["issue_updated_at"]:
+        previous_response.cached = True
+        previous_response.cost_saved = previous_response.cost
+        previous_response.cost = 0.0
+        return previous_response
+
+    update_prompt = prompt + _UPDATE_INSTRUCTIONS
+    user_input = (
+        f"{github.parse_issue(issue)}\n"
+        f"Earlier summary (between '''):\n'''\n{previous_response.llm_response}\n'''\n"
+        f"New and edited comments:\n{github.parse_comments(comments)}"
+    )
+    update_model, routing_reason = choose_model(model, update_prompt, user_input)
+    if not fits_context(update_model, update_prompt, user_input):
+        # Too many new comments to update the summary in one request - start over with all comments
+        comments = github.get_issue_comments(issue) if all_comments is None else all_comments
+        return summarize_issue_incremental(model, prompt, issue, comments, None, use_cache)
+
+    response = llm.chat_completion(update_model, update_prompt, user_input, use_cache, _required_sections(prompt))
+    response.routing_reason = routing_reason
+    _save_summary(model, prompt, issue, response, last_comment_at or previous["last_comment_at"])
+    return response
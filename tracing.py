@@ -0,0 +1,212 @@
+"""Lightweight tracing and metrics for the steps of summarizing an issue.
+
+Each step (getting the issue from GitHub, parsing it, getting the LLM response, showing it) is recorded as a span with
+its duration and attributes (e.g. the number of bytes received or tokens used). Spans are:
+
+- Grouped by request, to show where the time went for one summary. Wrap the request in `with tracing.trace() as t:`
+  and read `t.spans` at the end.
+- Aggregated into latency histograms, one per step, across all requests.
+
+Counters add up other values of interest across requests (e.g. tokens, costs, bytes, retries).
+
+The aggregated data can be exported in the Prometheus text format, and the individual spans as JSONL.
+"""
+
+import contextvars
+import json
+import math
+import threading
+import time
+from collections import deque
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+
+# Histogram buckets (upper bounds in seconds) - from fast local steps (parsing) to slow LLM responses
+_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Maximum number of spans kept for the JSONL export - older spans are discarded first
+_MAX_SPANS = 10_000
+
+
+@dataclass
+class Span:
+    """One step of a request."""
+
+    name: str
+    start_time: float = 0.0
+    duration: float = 0.0
+    attributes: dict = field(default_factory=dict)
+    trace_id: str = ""
+
+
+@dataclass
+class Trace:
+    """The spans of one request, in the order they ended."""
+
+    trace_id: str = ""
+    spans: list[Span] = field(default_factory=list)
+
+
+@dataclass
+class _Histogram:
+    """Latency histogram, with cumulative buckets (as in Prometheus)."""
+
+    bucket_counts: list[int] = field(default_factory=lambda: [0] * len(_BUCKETS))
+    count: int = 0
+    total: float = 0.0
+
+    def observe(self, value: float):
+        """Add a value to the histogram."""
+        self.count += 1
+        self.total += value
+        for i, bound in enumerate(_BUCKETS):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+
+
+_current_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("current_trace", default=None)
+_suppressed: contextvars.ContextVar[bool] = contextvars.ContextVar("suppressed", default=False)
+_lock = threading.Lock()
+_histograms: dict[str, _Histogram] = {}
+_counters: dict[tuple[str, tuple], float] = {}
+_spans: deque[Span] = deque(maxlen=_MAX_SPANS)
+_trace_count = 0
+
+
+@contextmanager
+def trace() -> Iterator[Trace]:
+    """Group the spans recorded in the block (in this thread or in threads that copy the context) into a trace."""
+    global _trace_count
+    with _lock:
+        _trace_count += 1
+        trace_id = f"{int(time.time())}-{_trace_count}"
+    current = Trace(trace_id)
+    token = _current_trace.set(current)
+    try:
+        yield current
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[dict]:
+    """Record the duration of a block of code as a step.
+
+    The block can add attributes to the dictionary it receives, e.g. the size of the response.
+
+    Example:
+        with tracing.span("get_issue", url=url) as attributes:
+            response = requests.get(url)
+            attributes["bytes"] = len(response.content)
+    """
+    if _suppressed.get():
+        yield attributes
+        return
+
+    start_time = time.time()
+    start = time.perf_counter()
+    try:
+        yield attributes
+    except BaseException as ex:
+        attributes["error"] = type(ex).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        current = _current_trace.get()
+        recorded = Span(name, start_time, duration, attributes, current.trace_id if current else "")
+        if current:
+            current.spans.append(recorded)
+        with _lock:
+            _histograms.setdefault(name, _Histogram()).observe(duration)
+            _spans.append(recorded)
+
+
+@contextmanager
+def suppress() -> Iterator[None]:
+    """Don't record spans in the block.
+
+    Use it when calling instrumented functions for internal purposes, e.g. parsing comments only to count their tokens,
+    to keep the traces and histograms about the actual steps of the request.
+    """
+    token = _suppressed.set(True)
+    try:
+        yield
+    finally:
+        _suppressed.reset(token)
+
+
+def count(name: str, value: float = 1, **labels):
+    """Add a value to a counter. By convention, counter names end in "_total"."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def context_runner():
+    """Get a function that runs another function in the current context, to keep the current trace in other threads.
+
+    Example:
+        executor.submit(tracing.context_runner(), function, *args)
+    """
+    return contextvars.copy_context().run
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """Calculate a percentile (0 to 100) of a list of values, interpolating between the closest values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    lower, upper = math.floor(rank), math.ceil(rank)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def _format_labels(labels: dict) -> str:
+    """Format labels for the Prometheus text format."""
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def export_prometheus() -> str:
+    """Export the histograms and counters in the Prometheus text format."""
+    with _lock:
+        histograms = {name: _Histogram(list(h.bucket_counts), h.count, h.total) for name, h in _histograms.items()}
+        counters = dict(_counters)
+
+    lines = [
+        "# HELP span_duration_seconds Duration of each step of summarizing an issue.",
+        "# TYPE span_duration_seconds histogram",
+    ]
+    for name, histogram in sorted(histograms.items()):
+        for bound, bucket_count in zip(_BUCKETS, histogram.bucket_counts):
+            lines.append(f"span_duration_seconds_bucket{_format_labels({'span': name, 'le': bound})} {bucket_count}")
+        lines.append(f"span_duration_seconds_bucket{_format_labels({'span': name, 'le': '+Inf'})} {histogram.count}")
+        lines.append(f"span_duration_seconds_sum{_format_labels({'span': name})} {histogram.total}")
+        lines.append(f"span_duration_seconds_count{_format_labels({'span': name})} {histogram.count}")
+
+    typed = set()
+    for (name, labels), value in sorted(counters.items()):
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        lines.append(f"{name}{_format_labels(dict(labels))} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def export_jsonl(path: str):
+    """Append the spans recorded since the last export to a JSONL file, one span per line."""
+    with _lock:
+        spans = list(_spans)
+        _spans.clear()
+    with open(path, "a", encoding="utf-8") as f:
+        f.writelines(json.dumps(asdict(recorded), default=str) + "\n" for recorded in spans)
+
+
+def reset():
+    """Discard all recorded data."""
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _spans.clear()